@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Benchmarks streaming mini-batch k-means on synthetic embeddings.
+
+The vectors are written to an on-disk embedding store and clustered through
+its memory map, as the catalog is. For each corpus size, reports the fit and
+assignment throughput in vectors/second and the resulting inertia (mean
+squared distance to the nearest centroid), next to the inertia of the
+k-means++ seeding alone for reference.
+
+Usage:
+    python benchmarks/clustering_bench.py --sizes 100000 500000 --k 256
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import tempfile
+import time
+import numpy as np
+from src.map.clustering import MiniBatchKMeans
+from src.storage.embedding_store import EmbeddingStore
+from benchmarks.similarity_index_bench import synthetic_embeddings
+
+def bench_size(n: int, k: int, batch_size: int, epochs: int) -> dict:
+    """
+    Runs the benchmark at one corpus size.
+
+    Returns:
+        dict: The measurements.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = EmbeddingStore.write(os.path.join(tmp_dir, 'bench'), np.arange(n).astype(str).tolist(), synthetic_embeddings(n))
+        matrix = store.matrix()
+        results = {'n': n, 'k': k, 'batch_size': batch_size, 'epochs': epochs}
+
+        model = MiniBatchKMeans(k, batch_size)
+        start = time.perf_counter()
+        model.partial_fit(matrix[:batch_size])
+        results['seed_s'] = time.perf_counter() - start
+        results['seed_inertia'] = model.inertia(matrix)
+
+        model = MiniBatchKMeans(k, batch_size)
+        start = time.perf_counter()
+        rng = np.random.default_rng(0)
+        starts = np.arange(0, n, batch_size)
+        for _ in range(epochs):
+            for batch_start in rng.permutation(starts):
+                model.partial_fit(matrix[batch_start:batch_start + batch_size])
+        elapsed = time.perf_counter() - start
+        results['fit_vectors_per_s'] = n * epochs / elapsed
+
+        start = time.perf_counter()
+        _, sq_dist = model.assign(matrix)
+        results['assign_vectors_per_s'] = n / (time.perf_counter() - start)
+        results['inertia'] = float(sq_dist.mean())
+
+        new_rows = synthetic_embeddings(batch_size, seed=2)
+        start = time.perf_counter()
+        model.update(new_rows)
+        results['update_vectors_per_s'] = len(new_rows) / (time.perf_counter() - start)
+        del matrix, store
+    return results
+
+def print_results(results: dict):
+    print(f"{Style.BRIGHT}[ClusteringBench]: {Style.NORMAL}{Fore.CYAN}n={results['n']:,}, k={results['k']}, batch={results['batch_size']}, epochs={results['epochs']}{Style.RESET_ALL}")
+    print(f"    k-means++ seeding: {results['seed_s']:.2f}s, inertia {results['seed_inertia']:.2f}")
+    print(f"    fit:    {results['fit_vectors_per_s']:>12,.0f} vectors/s, inertia {results['inertia']:.2f}")
+    print(f"    assign: {results['assign_vectors_per_s']:>12,.0f} vectors/s")
+    print(f"    update: {results['update_vectors_per_s']:>12,.0f} vectors/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark mini-batch k-means on synthetic embeddings.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 500000], help="Corpus sizes to benchmark.")
+    parser.add_argument('--k', type=int, default=256, help="Number of clusters.")
+    parser.add_argument('--batch-size', type=int, default=4096, help="Vectors per mini-batch.")
+    parser.add_argument('--epochs', type=int, default=1, help="Passes over the corpus.")
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        print_results(bench_size(n, args.k, args.batch_size, args.epochs))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Benchmarks compressed embedding storage on synthetic embeddings.
+
+For each codec, reports the bytes held per vector, the implied corpus size
+that fits in a given RAM budget, the search QPS and the recall@10 against
+exact float32 search, with and without re-scoring the shortlist against the
+full vectors. Codecs:
+    - scalar/vggish: uint8 over VGGish's fixed [-2, 2] quantization range
+    - scalar/fitted: uint8 over per-dimension ranges fitted to the data
+    - pq/<m>: product quantization with m bytes per vector
+
+The synthetic vectors carry independent noise in every dimension, which is a
+worst case for product quantization; its recall on real embeddings, whose
+dimensions are correlated, is higher.
+
+Usage:
+    python benchmarks/compression_bench.py --sizes 100000 1000000 --m 8 16 32
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import time
+import numpy as np
+from src.map.similarity_index import ExactIndex
+from src.storage.compression import CompressedIndex, ProductQuantizer, ScalarQuantizer
+from benchmarks.similarity_index_bench import synthetic_embeddings, recall_at_k
+
+def _measure(index: CompressedIndex, query_vectors: np.ndarray, truth: np.ndarray, k: int, rerank: np.ndarray | None) -> tuple[float, float]:
+    start = time.perf_counter()
+    _, found = index.search_rows(query_vectors, k, rerank=rerank)
+    qps = len(query_vectors) / (time.perf_counter() - start)
+    return qps, recall_at_k(found, truth)
+
+def bench_size(n: int, queries: int, k: int, ms: list, ram_gb: float) -> dict:
+    """
+    Runs the benchmark at one corpus size.
+
+    Returns:
+        dict: The measurements.
+    """
+    vectors = synthetic_embeddings(n)
+    query_vectors = synthetic_embeddings(queries, seed=1)
+    ids = np.arange(n).astype(str).tolist()
+    results = {'n': n, 'queries': queries, 'k': k, 'codecs': {}}
+
+    exact = ExactIndex()
+    exact.add(ids, vectors)
+    start = time.perf_counter()
+    _, truth = exact.search_positions(query_vectors, k)
+    results['exact_qps'] = queries / (time.perf_counter() - start)
+
+    codecs = {'scalar/vggish': ScalarQuantizer(), 'scalar/fitted': ScalarQuantizer.fit(vectors)}
+    codecs.update({f"pq/{m}": ProductQuantizer(vectors.shape[1], m) for m in ms})
+    for name, codec in codecs.items():
+        index = CompressedIndex(codec)
+        start = time.perf_counter()
+        index.train(vectors)
+        index.add(np.arange(n), vectors)
+        build_s = time.perf_counter() - start
+        bytes_per_vector = index.nbytes / n
+        qps, recall = _measure(index, query_vectors, truth, k, None)
+        rerank_qps, rerank_recall = _measure(index, query_vectors, truth, k, vectors)
+        results['codecs'][name] = {
+            'build_s': build_s,
+            'bytes_per_vector': bytes_per_vector,
+            'tracks_in_budget': int(ram_gb * 2**30 / bytes_per_vector),
+            'qps': qps,
+            'recall': recall,
+            'rerank_qps': rerank_qps,
+            'rerank_recall': rerank_recall
+        }
+    return results
+
+def print_results(results: dict, ram_gb: float):
+    print(f"{Style.BRIGHT}[CompressionBench]: {Style.NORMAL}{Fore.CYAN}n={results['n']:,}, {results['queries']} queries, k={results['k']}{Style.RESET_ALL}")
+    print(f"    float32 exact: 512 B/vector, {int(ram_gb * 2**30 / 512):>13,} tracks in {ram_gb:g} GB, {results['exact_qps']:>8,.0f} QPS")
+    for name, r in results['codecs'].items():
+        print(
+            f"    {name:<13}: {r['bytes_per_vector']:>3.0f} B/vector, {r['tracks_in_budget']:>13,} tracks in {ram_gb:g} GB, "
+            f"{r['qps']:>8,.0f} QPS, recall@{results['k']} {r['recall']:.3f} "
+            f"(re-scored: {r['rerank_qps']:,.0f} QPS, recall {r['rerank_recall']:.3f}), built in {r['build_s']:.1f}s"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compressed embedding storage on synthetic embeddings.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help="Corpus sizes to benchmark.")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per measurement.")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours per query.")
+    parser.add_argument('--m', type=int, nargs='+', default=[8, 16, 32], help="Product quantizer code sizes in bytes.")
+    parser.add_argument('--ram-gb', type=float, default=8.0, help="RAM budget used to report how many tracks fit.")
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        print_results(bench_size(n, args.queries, args.k, args.m, args.ram_gb), args.ram_gb)
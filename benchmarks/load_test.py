@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Load-tests the map query service.
+
+Worker threads hold keep-alive connections and send a weighted mix of
+requests, either as fast as they can or paced to a target request rate.
+Reports the achieved QPS, error count and latency percentiles per endpoint.
+
+Track IDs and collection names for the requests come from the catalog. With
+--synthetic N, the service is instead started in a child process over N
+synthetic embeddings (with a random layout and playlists), so the test runs
+self-contained. That child uses Werkzeug's development server, so its
+latencies aren't the production figure; point --url at the service hosted
+under gunicorn (see map_service.py) for that.
+
+Usage:
+    python benchmarks/load_test.py --synthetic 200000 --rate 300 --duration 20
+    python benchmarks/load_test.py --url http://127.0.0.1:8890 --concurrency 32
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import http.client
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlparse
+import numpy as np
+from src.interface.map_service import MAP_SERVICE_PORT
+
+DEFAULT_MIX = 'knn=0.6,batch=0.15,coordinates=0.15,similarity=0.1'
+
+def _synthetic_service(n: int, tmp_dir: str, ready: multiprocessing.Queue):
+    """
+    Builds a service over synthetic data and serves it on a free port (child process).
+    """
+    import logging
+    from werkzeug.serving import make_server # type: ignore
+    from benchmarks.similarity_index_bench import synthetic_embeddings
+    from src.interface.map_service import MapService, create_app
+    from src.map.similarity_index import IVFIndex
+    from src.storage.embedding_store import EmbeddingStore
+    from src.storage.track_catalog import TrackCatalog
+    from src.utils.tsv_reader import TrackRecord
+
+    ids = [f"track{i:07d}" for i in range(n)]
+    catalog = TrackCatalog(os.path.join(tmp_dir, 'catalog.db'), os.path.join(tmp_dir, 'store'))
+    catalog.upsert_records([TrackRecord(t, t, '', '', '', 200.0, None, None) for t in ids])
+    catalog.store.append(ids, synthetic_embeddings(n))
+    index = IVFIndex()
+    for start in range(0, n, 65536):
+        index.add(ids[start:start + 65536], catalog.store.matrix()[start:start + 65536])
+    rng = np.random.default_rng(0)
+    layout = EmbeddingStore.write(os.path.join(tmp_dir, 'layout'), ids, rng.uniform(-50, 50, (n, 2)))
+    for p in range(100):
+        catalog.set_collection(f"playlist{p}", 'playlist', [ids[i] for i in rng.choice(n, 100, replace=False)])
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, create_app(MapService(catalog.store, index, layout, catalog)), threaded=True)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+def _catalog_targets(sample_size: int = 10000) -> tuple[list, list]:
+    """
+    Samples track IDs and collection names from the catalog.
+    """
+    from src.storage.track_catalog import TrackCatalog
+    catalog = TrackCatalog()
+    rng = np.random.default_rng(0)
+    ids = catalog.store.ids
+    track_ids = [ids[i] for i in rng.choice(len(ids), min(len(ids), sample_size), replace=False)]
+    names = [r[0] for r in catalog.conn.execute("SELECT name FROM collections")]
+    return track_ids, names
+
+def _request_for(kind: str, rng: np.random.Generator, track_ids: list, names: list, batch_size: int, k: int, binary: bool) -> tuple[str, str, bytes | None]:
+    """
+    Builds one (method, path, body) request of a kind.
+    """
+    suffix = '&format=npy' if binary else ''
+    if kind == 'knn':
+        return 'GET', f"/tracks/{quote(track_ids[rng.integers(len(track_ids))])}/neighbours?k={k}{suffix}", None
+    if kind == 'batch':
+        batch = [track_ids[i] for i in rng.integers(len(track_ids), size=batch_size)]
+        return 'POST', f"/neighbours?{suffix[1:]}", json.dumps({'ids': batch, 'k': k}).encode()
+    if kind == 'coordinates':
+        return 'GET', f"/collections/{quote(names[rng.integers(len(names))])}/coordinates?{suffix[1:]}", None
+    pair = [names[i] for i in rng.choice(len(names), 2, replace=False)]
+    return 'POST', f"/similarity?{suffix[1:]}", json.dumps({'names': pair, 'method': 'mean'}).encode()
+
+def run_load(host: str, port: int, track_ids: list, names: list, mix: dict, duration: float, concurrency: int, rate: float, batch_size: int, k: int, binary: bool) -> dict:
+    """
+    Sends requests from worker threads for a fixed duration.
+
+    Args:
+        host (str): Service host.
+        port (int): Service port.
+        track_ids (list): Track IDs to query.
+        names (list): Collection names to query.
+        mix (dict): Relative weight of each request kind.
+        duration (float): Seconds to run for.
+        concurrency (int): Worker threads, each with its own connection.
+        rate (float): Target total requests per second; 0 for as fast as possible.
+        batch_size (int): IDs per batched k-NN request.
+        k (int): Neighbours per query.
+        binary (bool): Ask for NumPy instead of JSON responses.
+
+    Returns:
+        dict: Latencies (seconds) and error counts per request kind, and the elapsed time.
+    """
+    kinds = [kind for kind, weight in mix.items() if weight > 0 and (kind in ('knn', 'batch') or len(names) >= 2)]
+    weights = np.array([mix[kind] for kind in kinds], dtype=np.float64)
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker(seed: int):
+        rng = np.random.default_rng(seed)
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        interval = concurrency / rate if rate > 0 else 0.0
+        next_send = time.perf_counter() + rng.uniform(0, interval)
+        local = {kind: [] for kind in kinds}
+        local_errors = {kind: 0 for kind in kinds}
+        while True:
+            if interval:
+                # Open loop: a late request is timed from when it was due
+                now = time.perf_counter()
+                if next_send > now:
+                    time.sleep(next_send - now)
+                sent_at = next_send
+                next_send += interval
+            else:
+                sent_at = time.perf_counter()
+            if sent_at >= deadline:
+                break
+            kind = kinds[rng.choice(len(kinds), p=weights / weights.sum())]
+            method, path, body = _request_for(kind, rng, track_ids, names, batch_size, k, binary)
+            try:
+                conn.request(method, path, body, {'Content-Type': 'application/json'} if body else {})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=10)
+                ok = False
+            local[kind].append(time.perf_counter() - sent_at)
+            local_errors[kind] += not ok
+        conn.close()
+        with lock:
+            for kind in kinds:
+                latencies[kind].extend(local[kind])
+                errors[kind] += local_errors[kind]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'latencies': latencies, 'errors': errors, 'elapsed': time.perf_counter() - start}
+
+def print_results(results: dict, target_p99_ms: float):
+    elapsed = results['elapsed']
+    all_latencies = np.concatenate([np.asarray(v) for v in results['latencies'].values()] or [np.empty(0)])
+    print(f"{Style.BRIGHT}[LoadTest]: {Style.NORMAL}{Fore.CYAN}{len(all_latencies):,} requests in {elapsed:.1f}s ({len(all_latencies) / elapsed:,.0f} QPS){Style.RESET_ALL}")
+    for kind, values in [*results['latencies'].items(), ('all', all_latencies)]:
+        if len(values) == 0:
+            continue
+        p50, p90, p99 = np.percentile(np.asarray(values) * 1000, [50, 90, 99])
+        errors = sum(results['errors'].values()) if kind == 'all' else results['errors'][kind]
+        print(f"    {kind:<12} {len(values):>8,} req, {len(values) / elapsed:>7,.0f} QPS, p50 {p50:6.2f} ms, p90 {p90:6.2f} ms, p99 {p99:6.2f} ms, max {np.max(values) * 1000:7.2f} ms, {errors} errors")
+    p99 = np.percentile(all_latencies * 1000, 99) if len(all_latencies) else float('inf')
+    color = Fore.GREEN if p99 <= target_p99_ms else Fore.RED
+    print(f"{Style.BRIGHT}[LoadTest]: {Style.NORMAL}{color}Overall p99 {p99:.2f} ms against a {target_p99_ms:g} ms target.{Style.RESET_ALL}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the map query service.")
+    parser.add_argument('--url', default=f"http://127.0.0.1:{MAP_SERVICE_PORT}", help="Base URL of a running service.")
+    parser.add_argument('--synthetic', type=int, default=0, help="Start a service over this many synthetic tracks instead.")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run for.")
+    parser.add_argument('--concurrency', type=int, default=16, help="Worker threads.")
+    parser.add_argument('--rate', type=float, default=300.0, help="Target requests per second; 0 for as fast as possible.")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Request kinds and weights, e.g. 'knn=0.6,batch=0.15,coordinates=0.15,similarity=0.1'.")
+    parser.add_argument('--batch-size', type=int, default=32, help="IDs per batched k-NN request.")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours per query.")
+    parser.add_argument('--binary', action='store_true', help="Request NumPy instead of JSON responses.")
+    parser.add_argument('--target-p99-ms', type=float, default=20.0, help="p99 latency target to check against.")
+    args = parser.parse_args()
+
+    mix = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+    server = None
+    if args.synthetic:
+        tmp_dir = tempfile.TemporaryDirectory()
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_synthetic_service, args=(args.synthetic, tmp_dir.name, ready), daemon=True)
+        server.start()
+        while server.is_alive() and ready.empty():
+            time.sleep(0.1)
+        if ready.empty():
+            print(f"{Style.BRIGHT}[LoadTest]: {Style.NORMAL}{Fore.RED}Error: The synthetic service failed to start.{Style.RESET_ALL}")
+            sys.exit(1)
+        host, port = '127.0.0.1', ready.get()
+        track_ids = [f"track{i:07d}" for i in range(args.synthetic)]
+        names = [f"playlist{p}" for p in range(100)]
+    else:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+        track_ids, names = _catalog_targets()
+    if not track_ids:
+        print(f"{Style.BRIGHT}[LoadTest]: {Style.NORMAL}{Fore.RED}Error: No embedded tracks to query.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    try:
+        results = run_load(host, port, track_ids, names, mix, args.duration, args.concurrency, args.rate, args.batch_size, args.k, args.binary)
+        print_results(results, args.target_p99_ms)
+    finally:
+        if server is not None:
+            server.terminate()
+            tmp_dir.cleanup()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Benchmarks each stage of the embedding pipeline on synthetic audio.
+
+Runs offline: the audio, log-mel inputs, PCA parameters, playlist TSVs and
+embeddings are all generated. The benchmarks are:
+    - log_mel: mel_features.log_mel_spectrogram on a 16 kHz clip
+    - resample/<filter>: resampy from 44.1 kHz to 16 kHz
+    - waveform_to_examples: vggish_input.waveform_to_examples on a 44.1 kHz clip
+    - vggish/batch_<n>: one sess.run of VGGish on n examples (needs TensorFlow
+      and the checkpoint; skipped otherwise)
+    - postprocess: Postprocessor.postprocess (PCA) on a batch of raw embeddings
+    - maxpool: max-pooling each track's example embeddings
+    - tsv_read: streaming a playlist TSV into TrackRecords
+    - store_append: appending embeddings to an EmbeddingStore one track at a time
+    - store_get: looking up embeddings by track ID
+    - knn/exact, knn/ivf: similarity index queries
+
+Every benchmark is timed over several runs after a warm-up run. The median,
+minimum and maximum are written as JSON along with the environment (Python,
+NumPy and TensorFlow versions, CPU, git commit). Given a baseline written by
+an earlier run, each median is compared with it and slowdowns beyond the
+tolerance are flagged. A baseline only means something on the machine that
+recorded it.
+
+Usage:
+    python benchmarks/pipeline_bench.py --output results.json
+    python benchmarks/pipeline_bench.py --baseline results.json --fail-on-regression
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+from benchmarks.similarity_index_bench import synthetic_embeddings
+
+SOURCE_RATE = 44100
+FILTERS = ('kaiser_best', 'kaiser_fast')
+
+def synthetic_audio(seconds: float, sample_rate: int = SOURCE_RATE, seed: int = 0) -> np.ndarray:
+    """
+    Generates a mono clip of gliding tones over noise, in [-1.0, 1.0].
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    tones = sum(0.2 * np.sin(2 * np.pi * f * t * (1 + 0.05 * np.sin(t))) for f in (220.0, 440.0, 1760.0))
+    return (tones + 0.05 * rng.standard_normal(len(t))).astype(np.float64)
+
+def time_runs(fn, runs: int, warmup: int = 1) -> list:
+    """
+    Times a function over several runs after warming it up.
+
+    Returns:
+        list: Seconds per run.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times: list, work: float, unit: str) -> dict:
+    """
+    Summarizes run times, with the rate at which `work` units are processed per run.
+    """
+    median = float(np.median(times))
+    return {
+        'median_s': median,
+        'min_s': float(np.min(times)),
+        'max_s': float(np.max(times)),
+        'runs': len(times),
+        'rate': work / median if median > 0 else float('inf'),
+        'unit': unit
+    }
+
+def environment() -> dict:
+    """
+    Describes the machine and software the benchmarks ran on.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_root, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        commit = None
+    tf_version = sys.modules['tensorflow'].__version__ if 'tensorflow' in sys.modules else None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'tensorflow': tf_version,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count()
+    }
+
+def bench_features(clip_seconds: float, runs: int) -> dict:
+    """
+    Benchmarks resampling, the log-mel spectrogram and example framing.
+    """
+    import resampy
+    from src.embeddings.vgg import mel_features, vggish_input, vggish_params
+
+    audio = synthetic_audio(clip_seconds)
+    audio_16k = resampy.resample(audio, SOURCE_RATE, vggish_params.SAMPLE_RATE)
+    results = {}
+    for name in FILTERS:
+        times = time_runs(lambda: resampy.resample(audio, SOURCE_RATE, vggish_params.SAMPLE_RATE, filter=name), runs)
+        results[f"resample/{name}"] = summarize(times, clip_seconds, 'audio s/s')
+
+    def log_mel():
+        mel_features.log_mel_spectrogram(
+            audio_16k,
+            audio_sample_rate=vggish_params.SAMPLE_RATE,
+            log_offset=vggish_params.LOG_OFFSET,
+            window_length_secs=vggish_params.STFT_WINDOW_LENGTH_SECONDS,
+            hop_length_secs=vggish_params.STFT_HOP_LENGTH_SECONDS,
+            num_mel_bins=vggish_params.NUM_MEL_BINS,
+            lower_edge_hertz=vggish_params.MEL_MIN_HZ,
+            upper_edge_hertz=vggish_params.MEL_MAX_HZ
+        )
+    results['log_mel'] = summarize(time_runs(log_mel, runs), clip_seconds, 'audio s/s')
+    times = time_runs(lambda: vggish_input.waveform_to_examples(audio, SOURCE_RATE), runs)
+    results['waveform_to_examples'] = summarize(times, clip_seconds, 'audio s/s')
+    return results
+
+def bench_vggish(batch_sizes: list, runs: int) -> dict:
+    """
+    Benchmarks VGGish inference, or records why it was skipped.
+    """
+    from src.embeddings.vgg import vggish_params
+    from src.embeddings.vgg_maxpool import CHECKPOINT_PATH, PCA_PARAMS_PATH
+
+    if not (os.path.exists(CHECKPOINT_PATH) and os.path.exists(PCA_PARAMS_PATH)):
+        return {'vggish': {'skipped': f"No VGGish checkpoint at {CHECKPOINT_PATH}"}}
+    try:
+        from src.embeddings.vgg_maxpool import EmbeddingEngine
+        engine = EmbeddingEngine()
+    except ImportError as e:
+        return {'vggish': {'skipped': f"TensorFlow unavailable: {e}"}}
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for batch_size in batch_sizes:
+        examples = rng.uniform(-4.0, 2.0, (batch_size, vggish_params.NUM_FRAMES, vggish_params.NUM_BANDS)).astype(np.float32)
+        feed = {engine.features_tensor: examples}
+        times = time_runs(lambda: engine.sess.run(engine.embedding_tensor, feed_dict=feed), runs)
+        results[f"vggish/batch_{batch_size}"] = summarize(times, batch_size, 'examples/s')
+    engine.close()
+    return results
+
+def bench_postprocess(tracks: int, examples_per_track: int, runs: int, tmp_dir: str) -> dict:
+    """
+    Benchmarks the PCA postprocessing and max-pooling of a batch of tracks.
+    """
+    from src.embeddings.vgg import vggish_params, vggish_postprocess
+
+    # Random orthonormal PCA parameters, so the real ones aren't needed
+    rng = np.random.default_rng(0)
+    pca_path = os.path.join(tmp_dir, 'pca_params.npz')
+    matrix, _ = np.linalg.qr(rng.standard_normal((vggish_params.EMBEDDING_SIZE, vggish_params.EMBEDDING_SIZE)))
+    np.savez(pca_path, **{vggish_params.PCA_EIGEN_VECTORS_NAME: matrix, vggish_params.PCA_MEANS_NAME: rng.standard_normal(vggish_params.EMBEDDING_SIZE)})
+    pproc = vggish_postprocess.Postprocessor(pca_path)
+
+    raw = rng.standard_normal((tracks * examples_per_track, vggish_params.EMBEDDING_SIZE)).astype(np.float32)
+    times = time_runs(lambda: pproc.postprocess(raw), runs)
+    results = {'postprocess': summarize(times, len(raw), 'examples/s')}
+    per_track = pproc.postprocess(raw).reshape(tracks, examples_per_track, vggish_params.EMBEDDING_SIZE)
+    times = time_runs(lambda: [np.max(batch, axis=0) for batch in per_track], runs)
+    results['maxpool'] = summarize(times, tracks, 'tracks/s')
+    return results
+
+def bench_io(tracks: int, runs: int, tmp_dir: str) -> dict:
+    """
+    Benchmarks reading playlist TSVs and writing and reading embeddings.
+    """
+    from src.storage.embedding_store import EmbeddingStore
+    from src.utils.tsv_reader import read_track_chunks
+
+    tsv_path = os.path.join(tmp_dir, 'playlist.tsv')
+    with open(tsv_path, 'w') as f:
+        f.write("Track ID\tTrack Name\tTrack Url\tArtists\tAlbum\tSong Length (s)\tMetrics\tAdded At\n")
+        for i in range(tracks):
+            f.write(f"track{i:07d}\tSong {i}\thttps://open.spotify.com/track/{i}\tArtist {i % 997}\tAlbum {i % 4999}\t{180 + i % 120}.5\t{{\"energy\": 0.5}}\t2024-01-01T00:00:00Z\n")
+    times = time_runs(lambda: sum(len(chunk) for chunk in read_track_chunks(tsv_path)), runs)
+    results = {'tsv_read': summarize(times, tracks, 'rows/s')}
+
+    ids = [f"track{i:07d}" for i in range(tracks)]
+    embeddings = synthetic_embeddings(tracks)
+    appended = min(tracks, 2000)
+
+    def append():
+        store = EmbeddingStore.staging(os.path.join(tmp_dir, 'append'))
+        for i in range(appended):
+            store.append(ids[i:i + 1], embeddings[i:i + 1])
+    results['store_append'] = summarize(time_runs(append, runs), appended, 'tracks/s')
+
+    store = EmbeddingStore.write(os.path.join(tmp_dir, 'store'), ids, embeddings)
+    lookup = [ids[i] for i in np.random.default_rng(0).integers(0, tracks, 1000)]
+    results['store_get'] = summarize(time_runs(lambda: store.get(lookup), runs), len(lookup), 'tracks/s')
+    return results
+
+def bench_knn(n: int, queries: int, k: int, runs: int) -> dict:
+    """
+    Benchmarks exact and IVF similarity search.
+    """
+    from src.map.similarity_index import ExactIndex, IVFIndex
+
+    vectors = synthetic_embeddings(n)
+    query_vectors = synthetic_embeddings(queries, seed=1)
+    ids = np.arange(n).astype(str).tolist()
+    results = {}
+    for name, index in (('exact', ExactIndex()), ('ivf', IVFIndex())):
+        index.add(ids, vectors)
+        if name == 'ivf' and not index.is_trained:
+            index.train()
+        times = time_runs(lambda: index.search_positions(query_vectors, k), runs)
+        results[f"knn/{name}"] = summarize(times, queries, 'queries/s')
+    return results
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stages = {
+            'features': lambda: bench_features(args.clip_seconds, args.runs),
+            'vggish': lambda: bench_vggish(args.batch_sizes, args.runs),
+            'postprocess': lambda: bench_postprocess(args.tracks // 10, 30, args.runs, tmp_dir),
+            'io': lambda: bench_io(args.tracks, args.runs, tmp_dir),
+            'knn': lambda: bench_knn(args.knn_size, args.queries, 10, args.runs)
+        }
+        for stage in args.only or stages:
+            print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.CYAN}Running {stage} benchmarks...{Style.RESET_ALL}")
+            results.update(stages[stage]())
+    return {'environment': environment(), 'settings': vars(args), 'benchmarks': results}
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares medians with a baseline run.
+
+    Returns:
+        list: The names of the benchmarks that got slower by more than the tolerance.
+    """
+    env, base_env = results['environment'], baseline['environment']
+    if any(env[key] != base_env.get(key) for key in ('machine', 'processor', 'cpu_count')):
+        print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.YELLOW}Warning: The baseline was recorded on a different machine ({base_env.get('cpu_count')} CPUs, {base_env.get('processor') or base_env.get('machine')}); differences may not be regressions.{Style.RESET_ALL}")
+
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None or 'median_s' not in base or 'median_s' not in result:
+            continue
+        ratio = result['median_s'] / base['median_s']
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            color = Fore.RED
+        elif ratio < 1 - tolerance:
+            color = Fore.GREEN
+        else:
+            color = ''
+        print(f"    {name:<24} {base['median_s'] * 1000:>10.2f} ms -> {result['median_s'] * 1000:>10.2f} ms  {color}{ratio:5.2f}x{Style.RESET_ALL}")
+    return regressions
+
+def print_results(results: dict):
+    env = results['environment']
+    print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.CYAN}Python {env['python']}, NumPy {env['numpy']}, TensorFlow {env['tensorflow'] or '-'}, {env['cpu_count']} CPUs, commit {(env['git_commit'] or '-')[:10]}{Style.RESET_ALL}")
+    for name, r in results['benchmarks'].items():
+        if 'skipped' in r:
+            print(f"    {name:<24} {Fore.YELLOW}skipped: {r['skipped']}{Style.RESET_ALL}")
+            continue
+        print(f"    {name:<24} median {r['median_s'] * 1000:>10.2f} ms (min {r['min_s'] * 1000:.2f}, max {r['max_s'] * 1000:.2f}), {r['rate']:>12,.1f} {r['unit']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the embedding pipeline on synthetic data.")
+    parser.add_argument('--only', nargs='+', choices=['features', 'vggish', 'postprocess', 'io', 'knn'], help="Benchmark groups to run (default: all).")
+    parser.add_argument('--runs', type=int, default=5, help="Timed runs per benchmark.")
+    parser.add_argument('--clip-seconds', type=float, default=30.0, help="Length of the synthetic audio clip.")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128], help="VGGish batch sizes, in examples.")
+    parser.add_argument('--tracks', type=int, default=20000, help="Rows in the synthetic TSV and embedding store.")
+    parser.add_argument('--knn-size', type=int, default=100000, help="Tracks in the similarity index.")
+    parser.add_argument('--queries', type=int, default=100, help="Queries per k-NN run.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare with the results in this JSON file.")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Relative slowdown flagged as a regression.")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 if anything regressed.")
+    args = parser.parse_args()
+
+    if args.baseline and not os.path.exists(args.baseline):
+        print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.RED}Error: Baseline file not found.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    results = run_benchmarks(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.GREEN}Results written to {args.output}.{Style.RESET_ALL}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.CYAN}Compared with {args.baseline} (commit {(baseline['environment'].get('git_commit') or '-')[:10]}):{Style.RESET_ALL}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.RED}{len(regressions)} benchmarks are more than {args.tolerance:.0%} slower: {', '.join(regressions)}{Style.RESET_ALL}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print(f"{Style.BRIGHT}[PipelineBench]: {Style.NORMAL}{Fore.GREEN}No regressions beyond {args.tolerance:.0%}.{Style.RESET_ALL}")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Fault-injection test of the distributed embedding queue.
+
+Runs the job queue and queue workers (see job_queue.py, queue_worker.py)
+against a throwaway database and catalog, with downloads and inference
+replaced by stubs, and checks that:
+    - a worker that stalls past its lease can't complete the jobs another
+      worker took over, and each embedding is committed exactly once
+    - a track whose download always fails ends up failed after the maximum
+      number of attempts, without stopping the other tracks
+    - an interrupted worker releases its jobs without using up an attempt
+    - a crashing worker uses up an attempt, so a job that keeps crashing
+      workers ends up failed
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python benchmarks/queue_fault_test.py
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import asyncio
+import sqlite3
+import tempfile
+import time
+import traceback
+import numpy as np
+import yt_dlp # type: ignore
+from src.embeddings import queue_worker
+from src.embeddings.queue_worker import QueueWorker
+from src.storage.job_queue import JobQueue
+from src.storage.track_catalog import TrackCatalog
+from src.utils import download_songs
+from src.utils.tsv_reader import TrackRecord
+
+POISON_ID = 'poison'
+
+def _records(count: int, prefix: str = 'track') -> list:
+    return [TrackRecord(f"{prefix}{i}", f"Song {i}", None, 'Artist', None, 180.0, None, None) for i in range(count)]
+
+def _install_stubs(audio_dir: str):
+    """
+    Replaces audio paths, downloads and inference with stubs: tracks download
+    into audio_dir (except POISON_ID, whose download always fails) and embed
+    to a vector filled with the track's number.
+    """
+    def audio_path_for(track_id: str) -> str:
+        return os.path.join(audio_dir, f"sp_id_{track_id}.mp3")
+
+    async def find_best_link(search_query: str, target_length: float, threshold: int) -> str:
+        return 'https://www.youtube.com/watch?v=stub'
+
+    async def download_one_by_url(track_id: str, url: str):
+        if track_id == POISON_ID:
+            raise yt_dlp.utils.DownloadError("ERROR: Video unavailable")
+        with open(audio_path_for(track_id), 'wb') as f:
+            f.write(b'audio')
+
+    def extract_one_embedding(path: str) -> np.ndarray:
+        number = ''.join(c for c in os.path.basename(path) if c.isdigit())
+        return np.full(128, float(number or 0), dtype=np.float32)
+
+    queue_worker.audio_path_for = audio_path_for
+    queue_worker.extract_one_embedding = extract_one_embedding
+    download_songs.find_best_link = find_best_link
+    download_songs.download_one_by_url = download_one_by_url
+
+def _state(queue: JobQueue, track_id: str) -> tuple:
+    return queue.conn.execute("SELECT state, attempts, error FROM jobs WHERE track_id=?", (track_id,)).fetchone()
+
+def check_expired_lease(tmp_dir: str):
+    """
+    A stalled worker's late results are rejected, and each embedding is committed once.
+    """
+    queue = JobQueue(os.path.join(tmp_dir, 'expired.db'), lease_seconds=0.2)
+    catalog = TrackCatalog(os.path.join(tmp_dir, 'expired_catalog.db'), os.path.join(tmp_dir, 'expired_store'))
+    records = _records(20)
+    catalog.upsert_records(records)
+    queue.enqueue(records)
+
+    stalled = queue.lease('stalled', len(records))
+    time.sleep(0.3)
+    taken = queue.lease('fresh', len(records))
+    assert sorted(j.track.track_id for j in taken) == sorted(r.track_id for r in records), "Expired leases weren't handed out again."
+    assert not any(queue.complete(job, np.zeros(128), 'stub') for job in stalled), "A result was accepted from an expired lease."
+    assert all(queue.complete(job, np.ones(128), 'stub') for job in taken), "A result was rejected from the current lease."
+    assert queue.commit_results(catalog) == len(records)
+
+    assert not any(queue.complete(job, np.zeros(128), 'stub') for job in stalled), "A late result was accepted after the commit."
+    assert queue.commit_results(catalog) == 0, "Results were committed twice."
+    assert len(catalog.store) == len(records), f"Expected {len(records)} stored embeddings, got {len(catalog.store)}."
+    embeddings = catalog.get_embeddings([r.track_id for r in records])
+    assert all(np.all(np.asarray(e) == 1.0) for e in embeddings.values()), "A stalled worker's embedding reached the catalog."
+    catalog.close()
+    queue.close()
+
+def check_poison_job(tmp_dir: str):
+    """
+    A track that can't be downloaded is failed after max_attempts; the rest of its batch is embedded.
+    """
+    queue = JobQueue(os.path.join(tmp_dir, 'poison.db'), max_attempts=3)
+    records = _records(4) + [TrackRecord(POISON_ID, 'Gone', None, 'Artist', None, 180.0, None, None)]
+    queue.enqueue(records)
+
+    stats = asyncio.run(QueueWorker(queue, batch_size=len(records), download_concurrency=2).run(poll_interval=0.1))
+    counts = queue.counts()
+    assert counts['done'] == 4 and counts['failed'] == 1 and counts['pending'] + counts['leased'] == 0, f"Unexpected counts {counts}."
+    state, attempts, error = _state(queue, POISON_ID)
+    assert attempts == 3 and error.startswith('download failed'), f"Poison job ended {state} after {attempts} attempts: {error}"
+    assert stats['embedded'] == 4 and stats['failed'] == 3
+    queue.close()
+
+def check_interrupted_worker(tmp_dir: str):
+    """
+    Cancelling a worker mid-batch releases its jobs without using up an attempt.
+    """
+    queue = JobQueue(os.path.join(tmp_dir, 'interrupted.db'))
+    records = _records(3, 'slow')
+    queue.enqueue(records)
+    extract = queue_worker.extract_one_embedding
+
+    def slow_extract(path: str) -> np.ndarray:
+        time.sleep(0.5)
+        return extract(path)
+
+    async def interrupt():
+        worker = QueueWorker(queue, batch_size=len(records))
+        task = asyncio.create_task(worker.run())
+        while not worker.active:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    queue_worker.extract_one_embedding = slow_extract
+    try:
+        asyncio.run(interrupt())
+    finally:
+        queue_worker.extract_one_embedding = extract
+    states = [_state(queue, r.track_id)[:2] for r in records]
+    assert all(state == ('pending', 0) for state in states), f"Interrupted jobs weren't released: {states}"
+    queue.close()
+
+def check_crashed_worker(tmp_dir: str):
+    """
+    A worker that crashes fails its unfinished jobs, so repeated crashes end in 'failed'.
+    """
+    queue = JobQueue(os.path.join(tmp_dir, 'crashed.db'), max_attempts=2)
+    records = _records(2, 'crash')
+    queue.enqueue(records)
+
+    class BrokenQueue(JobQueue):
+        def complete(self, *args, **kwargs) -> bool:
+            raise sqlite3.OperationalError("disk I/O error")
+
+    broken = BrokenQueue(queue.db_path, max_attempts=2)
+    for crash in range(2):
+        try:
+            asyncio.run(QueueWorker(broken, batch_size=len(records)).run())
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError("The injected error didn't reach the caller.")
+        states = [_state(queue, r.track_id)[:2] for r in records]
+        expected = ('pending', 1) if crash == 0 else ('failed', 2)
+        assert all(state == expected for state in states), f"After crash {crash + 1}, expected {expected}, got {states}."
+
+    # With nothing left to lease, a healthy worker stops straight away
+    stats = asyncio.run(QueueWorker(queue).run())
+    assert stats['embedded'] == 0 and queue.counts()['failed'] == len(records)
+    broken.close()
+    queue.close()
+
+CHECKS = [check_expired_lease, check_poison_job, check_interrupted_worker, check_crashed_worker]
+
+if __name__ == "__main__":
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _install_stubs(tmp_dir)
+        for check in CHECKS:
+            try:
+                check(tmp_dir)
+            except Exception:
+                failed += 1
+                print(f"{Style.BRIGHT}[QueueFaultTest]: {Style.NORMAL}{Fore.RED}FAIL {check.__name__}{Style.RESET_ALL}")
+                traceback.print_exc()
+            else:
+                print(f"{Style.BRIGHT}[QueueFaultTest]: {Style.NORMAL}{Fore.GREEN}PASS {check.__name__}{Style.RESET_ALL}")
+    sys.exit(1 if failed else 0)
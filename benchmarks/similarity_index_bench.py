@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Benchmarks the similarity index on synthetic embeddings.
+
+For each database size, reports the build time, the QPS of exact search and
+the QPS and recall@10 of the IVF index at several nprobe settings. Recall is
+measured against exact search. The synthetic vectors are drawn around random
+cluster centres so that, like real embeddings, they have structure for the
+coarse quantizer to find.
+
+Usage:
+    python benchmarks/similarity_index_bench.py --sizes 10000 100000 1000000
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import time
+import numpy as np
+from src.map.similarity_index import ExactIndex, IVFIndex
+
+def synthetic_embeddings(n: int, dim: int = 128, clusters: int = 1000, seed: int = 0) -> np.ndarray:
+    """
+    Draws n float32 vectors around random cluster centres.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, 100000):
+        stop = min(start + 100000, n)
+        vectors[start:stop] = centres[rng.integers(0, clusters, stop - start)]
+        vectors[start:stop] += 0.5 * rng.standard_normal((stop - start, dim), dtype=np.float32)
+    return vectors
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """
+    Fraction of the true neighbours that were found, averaged over queries.
+    """
+    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+def bench_size(n: int, queries: int, k: int, nprobes: list, metric: str) -> dict:
+    """
+    Runs the benchmark at one database size.
+
+    Returns:
+        dict: The measurements.
+    """
+    vectors = synthetic_embeddings(n)
+    query_vectors = synthetic_embeddings(queries, seed=1)
+    ids = np.arange(n).astype(str).tolist()
+    results = {'n': n, 'queries': queries, 'k': k, 'metric': metric}
+
+    exact = ExactIndex(metric=metric)
+    start = time.perf_counter()
+    exact.add(ids, vectors)
+    results['exact_build_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, truth = exact.search_positions(query_vectors, k)
+    results['exact_qps'] = queries / (time.perf_counter() - start)
+    del exact
+
+    ivf = IVFIndex(metric=metric)
+    start = time.perf_counter()
+    ivf.add(ids, vectors)
+    if not ivf.is_trained:
+        ivf.train()
+    results['ivf_build_s'] = time.perf_counter() - start
+    results['ivf_nlist'] = ivf.nlist
+    # Warm up so the first timing doesn't include building the cell lists
+    ivf.search_positions(query_vectors[:1], k)
+
+    results['ivf'] = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        _, found = ivf.search_positions(query_vectors, k, nprobe=nprobe)
+        elapsed = time.perf_counter() - start
+        results['ivf'].append({
+            'nprobe': nprobe,
+            'qps': queries / elapsed,
+            'recall': recall_at_k(found, truth)
+        })
+    return results
+
+def print_results(results: dict):
+    print(f"{Style.BRIGHT}[SimilarityBench]: {Style.NORMAL}{Fore.CYAN}n={results['n']:,} ({results['metric']}, k={results['k']}, {results['queries']} queries){Style.RESET_ALL}")
+    print(f"    exact: build {results['exact_build_s']:.2f}s, {results['exact_qps']:,.0f} QPS, recall@{results['k']} 1.000")
+    print(f"    ivf:   build {results['ivf_build_s']:.2f}s, nlist={results['ivf_nlist']}")
+    for row in results['ivf']:
+        print(f"        nprobe={row['nprobe']:<4} {row['qps']:>10,.0f} QPS   recall@{results['k']} {row['recall']:.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the similarity index on synthetic embeddings.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="Database sizes to benchmark.")
+    parser.add_argument('--queries', type=int, default=1000, help="Number of queries per size.")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours per query.")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64], help="IVF nprobe values to try.")
+    parser.add_argument('--metric', choices=['cosine', 'l2'], default='cosine')
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        print_results(bench_size(n, args.queries, args.k, args.nprobe, args.metric))
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Non-interactive command line for unattended pipeline runs.
+
+Unlike main.py, nothing here prompts or opens a browser. Spotify is
+authenticated from the cached token, so run `python cli.py login` once on a
+machine with a browser. All the jobs of a run share one event loop, one
+worker thread pool, one Spotify client and one embedding engine, so the
+model is loaded once per run. The similarity index, clusters, map layout and
+tiles are updated once at the end rather than after every playlist.
+
+Commands:
+    login               Authenticate with Spotify in a browser and cache the token.
+    sync-likes          Save the liked songs to a TSV and embed them.
+    sync-playlists      Save playlists (by URI or name) to TSVs and embed them.
+    ingest-baseline     Fetch and embed the baseline genre playlists, then rebuild the genre model and projection.
+    embed [TSV ...]     Embed the pending tracks of TSVs (default: every playlist TSV).
+    build               Update the similarity index, clusters, map layout and tiles.
+    enqueue [TSV ...]   Queue the pending tracks of TSVs (or --catalog: the whole catalog) for distributed embedding.
+    work                Lease, download and embed queued tracks until the queue is drained.
+    commit              Move embeddings finished by remote workers into the catalog.
+    queue-status        Show the job queue's counts, active workers and recent failures.
+    calibrate           Find the fastest inference batch size and thread counts for this machine.
+    batch FILE          Run the commands listed in a file, one per line ('#' starts a comment).
+
+Options given before the command (concurrency, --force, ...) apply to every job of a batch.
+
+Distributed embedding: run `enqueue` once, then `work` in as many processes
+as wanted, on this machine or others that can open the queue database (pass
+the same --queue path, on a shared filesystem). Remote workers should use
+`work --no-commit`; their results are committed here by `commit` (see
+src/storage/job_queue.py).
+
+Stage metrics (YouTube search, download, decode, inference, Spotify requests)
+are collected when --metrics, --metrics-port or --trace is given (see
+src/utils/metrics.py), and a per-stage latency summary is printed at the end.
+
+Usage:
+    python cli.py sync-playlists --names "Road Trip" "Focus" --download-concurrency 16
+    python cli.py --workers 16 batch nightly.jobs
+    python cli.py enqueue --catalog && python cli.py work
+    python cli.py --metrics-port 9464 --trace data/metrics/trace.jsonl sync-likes
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import asyncio
+import copy
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.config import config
+
+PLAYLISTS_PATH = os.path.join(os.path.dirname(__file__), config['paths']['playlists_path'][1:])
+SPOTIFY_CONCURRENCY = config['settings']['spotify_concurrency']
+DOWNLOAD_CONCURRENCY = config['settings']['download_concurrency']
+JOB_QUEUE_PATH = os.path.join(os.path.dirname(__file__), config['paths']['job_queue_path'][1:])
+JOB_BATCH_SIZE = config['settings']['job_batch_size']
+
+def playlist_file_name(name: str) -> str:
+    """
+    Returns the TSV file name a playlist is saved under.
+    """
+    return f"{name.lower().replace(' ', '_').replace(os.sep, '_')}.tsv"
+
+def pending_tsvs(directory: str = PLAYLISTS_PATH) -> list:
+    """
+    Lists the playlist TSVs in a directory, leaving out results logs.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith('.tsv') and not name.endswith('.results.tsv')
+    )
+
+class PipelineRun:
+    def __init__(self, options: argparse.Namespace):
+        """
+        Holds what the jobs of one run share.
+
+        Args:
+            options (argparse.Namespace): The parsed global options.
+        """
+        self.options = options
+        self.failed = []
+        self.embedded = 0
+        self.stale_artifacts = False
+        self._catalog = None
+        self._spotify = None
+        self._queue = None
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            from src.storage.track_catalog import TrackCatalog
+            self._catalog = TrackCatalog()
+        return self._catalog
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            from src.storage.job_queue import JobQueue
+            self._queue = JobQueue(self.options.queue)
+        return self._queue
+
+    def spotify(self):
+        """
+        Returns the Spotify client, authenticated from the cached token.
+
+        Raises:
+            RuntimeError: If no token is cached.
+        """
+        if self._spotify is None:
+            from src.interface.spotify_utils import sp
+            if not sp.authenticate_cached():
+                raise RuntimeError("No cached Spotify token. Run 'python cli.py login' first.")
+            self._spotify = sp
+        return self._spotify
+
+    def embed_options(self, job: argparse.Namespace) -> dict:
+        return {
+            'force': job.force,
+            'chunk_size': job.chunk_size,
+            'update_index': False,
+            'download_concurrency': job.download_concurrency
+        }
+
+    async def embed(self, job: argparse.Namespace, tsv_path: str, **kwargs):
+        from src.embeddings.generator import download_and_embed_tsv
+        self.embedded += await download_and_embed_tsv(tsv_path, catalog=self.catalog, **kwargs, **self.embed_options(job))
+        self.stale_artifacts = True
+
+    async def sync_likes(self, job: argparse.Namespace):
+        sp = self.spotify()
+        os.makedirs(os.path.dirname(os.path.abspath(job.output)), exist_ok=True)
+        await asyncio.to_thread(sp.load_likes_to_tsv, job.output)
+        if not job.no_embed:
+            await self.embed(job, job.output, collection='likes', kind='likes')
+
+    async def sync_playlists(self, job: argparse.Namespace):
+        sp = self.spotify()
+        names = list(job.names or [])
+        if job.names_file:
+            with open(job.names_file, 'r') as f:
+                names += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+        # Names are resolved one at a time, so the playlist index is refreshed at most once
+        targets = [(uri if uri.startswith('spotify:playlist:') else f"spotify:playlist:{uri}", None) for uri in job.uris or []]
+        for name in names:
+            uri = await asyncio.to_thread(sp.get_playlist_uri_for_name, name)
+            if uri is None:
+                print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.RED}Error: Could not find playlist with name '{name}'.{Style.RESET_ALL}")
+                self.failed.append(f"sync-playlists {name}")
+                continue
+            targets.append((uri, name))
+
+        os.makedirs(job.output_dir, exist_ok=True)
+        semaphore = asyncio.Semaphore(job.spotify_concurrency)
+
+        def fetch(uri: str, name: str | None) -> str:
+            if name is None:
+                name = sp.get_playlist_name(uri)
+            tracks = sp.get_playlist_tracks(uri)
+            metrics = sp.get_spotify_metrics_batch([track['track_id'] for track in tracks])
+            tsv_path = os.path.join(job.output_dir, playlist_file_name(name))
+            sp.write_tracks_to_tsv(tracks, metrics, tsv_path)
+            return tsv_path
+
+        async def fetch_limited(uri: str, name: str | None) -> tuple[str, str | None]:
+            async with semaphore:
+                try:
+                    return uri, await asyncio.to_thread(fetch, uri, name)
+                except Exception as e:
+                    print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.RED}Error: Could not load playlist {name or uri}: {e}{Style.RESET_ALL}")
+                    return uri, None
+
+        # Each playlist is embedded as soon as it's saved, while the rest are still being fetched
+        for fetched in asyncio.as_completed([fetch_limited(uri, name) for uri, name in targets]):
+            uri, tsv_path = await fetched
+            if tsv_path is None:
+                self.failed.append(f"sync-playlists {uri}")
+                continue
+            print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.CYAN}Saved {uri} to {tsv_path}.{Style.RESET_ALL}")
+            if not job.no_embed:
+                await self.embed(job, tsv_path)
+
+    async def ingest_baseline(self, job: argparse.Namespace):
+        from src.map.baseline_data import ingest_baseline
+        self.spotify()
+        await ingest_baseline(job.spotify_concurrency, **self.embed_options(job))
+        self.stale_artifacts = True
+
+    async def embed_tsvs(self, job: argparse.Namespace):
+        tsv_paths = job.tsvs or pending_tsvs()
+        if not tsv_paths:
+            print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.YELLOW}Warning: No TSVs to embed.{Style.RESET_ALL}")
+        for tsv_path in tsv_paths:
+            await self.embed(job, tsv_path)
+
+    async def build(self, job: argparse.Namespace):
+        from src.embeddings.generator import update_catalog_artifacts
+        if job.refit_projection:
+            from src.map.projection import fit_baseline_projection
+            await asyncio.to_thread(fit_baseline_projection, self.catalog)
+        await asyncio.to_thread(update_catalog_artifacts, self.catalog.store)
+        self.stale_artifacts = False
+
+    async def enqueue(self, job: argparse.Namespace):
+        from src.embeddings.queue_worker import enqueue_tsv, enqueue_catalog
+        if job.catalog:
+            queued = await asyncio.to_thread(enqueue_catalog, self.queue, self.catalog)
+        else:
+            queued = 0
+            for tsv_path in job.tsvs or pending_tsvs():
+                queued += await asyncio.to_thread(enqueue_tsv, self.queue, self.catalog, tsv_path, force=job.force, chunk_size=job.chunk_size)
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.GREEN}Queued {queued} tracks; {self.queue.counts()['pending']} pending in {self.queue.db_path}.{Style.RESET_ALL}")
+
+    async def work(self, job: argparse.Namespace):
+        from src.embeddings.queue_worker import QueueWorker
+        worker = QueueWorker(
+            self.queue,
+            catalog=None if job.no_commit else self.catalog,
+            batch_size=job.batch_size,
+            download_concurrency=job.download_concurrency
+        )
+        stats = await worker.run(follow=job.follow, max_jobs=job.max_jobs)
+        self.embedded += stats['embedded']
+        if stats['committed']:
+            self.stale_artifacts = True
+
+    async def commit(self, job: argparse.Namespace):
+        from src.map.dedupe import DuplicateIndex
+        duplicates = await asyncio.to_thread(DuplicateIndex.from_catalog, self.catalog)
+        committed = await asyncio.to_thread(self.queue.commit_results, self.catalog, duplicates)
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.GREEN}Committed {committed} embeddings to the catalog.{Style.RESET_ALL}")
+        if committed:
+            self.stale_artifacts = True
+
+    async def queue_status(self, job: argparse.Namespace):
+        counts = self.queue.counts()
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.CYAN}{self.queue.db_path}: {', '.join(f'{n} {state}' for state, n in counts.items())}{Style.RESET_ALL}")
+        for worker, leased in self.queue.workers().items():
+            print(f"    {worker:<40} {leased} leased")
+        failures = self.queue.failures()
+        if failures:
+            print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.YELLOW}Recent failures:{Style.RESET_ALL}")
+            for track_id, name, attempts, error in failures:
+                print(f"    {track_id} {name} ({attempts} attempts): {error}")
+
+    async def run(self, jobs: list) -> bool:
+        """
+        Runs jobs one after another. A failed job is reported and the run moves on,
+        including when it exits (some older library code still calls sys.exit).
+
+        Args:
+            jobs (list): Parsed commands (argparse.Namespace).
+
+        Returns:
+            bool: Whether every job succeeded.
+        """
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.options.workers, thread_name_prefix='pipeline'))
+        handlers = {
+            'sync-likes': self.sync_likes,
+            'sync-playlists': self.sync_playlists,
+            'ingest-baseline': self.ingest_baseline,
+            'embed': self.embed_tsvs,
+            'build': self.build,
+            'enqueue': self.enqueue,
+            'work': self.work,
+            'commit': self.commit,
+            'queue-status': self.queue_status
+        }
+
+        start = time.perf_counter()
+        for job in jobs:
+            print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Running {job.line}{Style.RESET_ALL}")
+            try:
+                await handlers[job.command](job)
+            except (Exception, SystemExit) as e:
+                print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.RED}Error: {job.line} failed: {e}{Style.RESET_ALL}")
+                self.failed.append(job.line)
+
+        if self.stale_artifacts and not self.options.no_build:
+            from src.embeddings.generator import update_catalog_artifacts
+            print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Updating the similarity index, clusters and map...{Style.RESET_ALL}")
+            await asyncio.to_thread(update_catalog_artifacts, self.catalog.store)
+
+        color = Fore.RED if self.failed else Fore.GREEN
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{color}Ran {len(jobs)} jobs in {time.perf_counter() - start:.1f}s: embedded {self.embedded} tracks, {len(self.failed)} failures.{Style.RESET_ALL}")
+        for failure in self.failed:
+            print(f"    {failure}")
+        return not self.failed
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run pipeline jobs without prompts.")
+    parser.add_argument('--workers', type=int, default=max(8, os.cpu_count() or 1), help="Threads in the shared worker pool (Spotify requests, downloads).")
+    parser.add_argument('--spotify-concurrency', type=int, default=SPOTIFY_CONCURRENCY, help="Playlists fetched from Spotify at once.")
+    parser.add_argument('--download-concurrency', type=int, default=DOWNLOAD_CONCURRENCY, help="Songs downloaded at once.")
+    parser.add_argument('--chunk-size', type=int, default=None, help="TSV rows processed per chunk.")
+    parser.add_argument('--force', action='store_true', help="Re-embed every track, not just the pending ones.")
+    parser.add_argument('--no-build', action='store_true', help="Don't update the index and map at the end of the run.")
+    parser.add_argument('--queue', default=JOB_QUEUE_PATH, help="The job queue database used by enqueue, work and commit.")
+    parser.add_argument('--metrics', metavar='PATH', help="Write metrics to this file periodically: Prometheus text for a .prom file, otherwise JSON lines.")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="Seconds between metrics writes.")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics at http://HOST:PORT/metrics.")
+    parser.add_argument('--metrics-host', default='127.0.0.1', help="Interface the metrics server binds (0.0.0.0 for all, to be scraped from other machines).")
+    parser.add_argument('--trace', metavar='PATH', help="Append every timed span to this file as JSON lines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('login', help="Authenticate with Spotify in a browser and cache the token.")
+
+    likes = commands.add_parser('sync-likes', help="Save the liked songs to a TSV and embed them.")
+    likes.add_argument('--output', default=os.path.join(PLAYLISTS_PATH, 'likes.tsv'), help="The likes TSV path.")
+    likes.add_argument('--no-embed', action='store_true', help="Only save the TSV.")
+
+    playlists = commands.add_parser('sync-playlists', help="Save playlists to TSVs and embed them.")
+    playlists.add_argument('--uris', '--ids', nargs='+', help="Playlist URIs or IDs.")
+    playlists.add_argument('--names', nargs='+', help="Playlist names, looked up in the user's playlists.")
+    playlists.add_argument('--names-file', help="File with one playlist name per line.")
+    playlists.add_argument('--output-dir', default=PLAYLISTS_PATH, help="Directory the TSVs are saved to.")
+    playlists.add_argument('--no-embed', action='store_true', help="Only save the TSVs.")
+
+    commands.add_parser('ingest-baseline', help="Fetch and embed the baseline genre playlists.")
+
+    embed = commands.add_parser('embed', help="Embed the pending tracks of TSVs.")
+    embed.add_argument('tsvs', nargs='*', help="TSV paths (default: every TSV in the playlists directory).")
+
+    build = commands.add_parser('build', help="Update the similarity index, clusters, map layout and tiles.")
+    build.add_argument('--refit-projection', action='store_true', help="Refit the map projection on the baseline first.")
+
+    enqueue = commands.add_parser('enqueue', help="Queue pending tracks for distributed embedding.")
+    enqueue.add_argument('tsvs', nargs='*', help="TSV paths (default: every TSV in the playlists directory).")
+    enqueue.add_argument('--catalog', action='store_true', help="Queue every catalog track without a current embedding instead.")
+
+    work = commands.add_parser('work', help="Lease, download and embed queued tracks.")
+    work.add_argument('--batch-size', type=int, default=JOB_BATCH_SIZE, help="Tracks leased at a time.")
+    work.add_argument('--follow', action='store_true', help="Keep waiting for new jobs instead of stopping when the queue is drained.")
+    work.add_argument('--max-jobs', type=int, default=None, help="Stop after this many tracks.")
+    work.add_argument('--no-commit', action='store_true', help="Leave results in the queue (for workers without the catalog).")
+
+    commands.add_parser('commit', help="Move finished embeddings from the queue into the catalog.")
+    commands.add_parser('queue-status', help="Show the job queue's state.")
+
+    calibrate = commands.add_parser('calibrate', help="Tune the inference batch size and threads for this machine.")
+    calibrate.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32, 64, 128, 256], help="Examples per inference call to try.")
+    calibrate.add_argument('--intra-threads', type=int, nargs='+', help="Intra-op thread counts to try (default: powers of two up to the CPU count).")
+    calibrate.add_argument('--inter-threads', type=int, nargs='+', default=[1, 2], help="Inter-op thread counts to try.")
+    calibrate.add_argument('--track-seconds', type=float, default=180.0, help="Length of the synthetic track.")
+    calibrate.add_argument('--tracks', type=int, default=5, help="Tracks embedded per measurement.")
+    calibrate.add_argument('--max-memory-mb', type=float, help="Ignore configurations that use more memory than this.")
+    calibrate.add_argument('--dry-run', action='store_true', help="Report the results without writing the profile.")
+
+    batch = commands.add_parser('batch', help="Run the commands listed in a file.")
+    batch.add_argument('file', help="File with one command per line.")
+    return parser
+
+def parse_jobs(parser: argparse.ArgumentParser, args: argparse.Namespace, argv: list) -> list:
+    """
+    Turns the command line (or the lines of a batch file) into jobs that
+    inherit the global options.
+    """
+    if args.command != 'batch':
+        args.line = shlex.join(argv)
+        return [args]
+    if not os.path.exists(args.file):
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.RED}Error: File not found.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    jobs = []
+    with open(args.file, 'r') as f:
+        for line in f:
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            job = parser.parse_args(words, namespace=copy.copy(args))
+            if job.command in ('batch', 'login', 'calibrate'):
+                parser.error(f"'{job.command}' can't be used inside a batch file")
+            job.line = shlex.join(words)
+            jobs.append(job)
+    return jobs
+
+def start_metrics(args: argparse.Namespace):
+    from src.utils import metrics
+    metrics.enable(trace_path=args.trace)
+    if args.metrics:
+        metrics.start_exporter(args.metrics, args.metrics_interval)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Serving metrics at http://{args.metrics_host}:{args.metrics_port}/metrics{Style.RESET_ALL}")
+
+def stop_metrics():
+    from src.utils import metrics
+    summary = metrics.stage_summary()
+    metrics.stop()
+    if not summary:
+        return
+    print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.CYAN}Stage latencies (p50 / p90 / p99 from histogram buckets):{Style.RESET_ALL}")
+    for stage, count, total, p50, p90, p99 in summary:
+        print(f"    {stage:<48} {count:>7} calls {total:>9.1f}s total   {p50:8.3f}s / {p90:8.3f}s / {p99:8.3f}s")
+
+def main(argv: list | None = None) -> int:
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+
+    if args.command == 'login':
+        from src.interface.spotify_utils import sp
+        sp.authenticate()
+        while sp.sp is None:
+            time.sleep(1)
+        print(f"{Style.BRIGHT}[CLI]: {Style.NORMAL}{Fore.GREEN}Spotify token cached.{Style.RESET_ALL}")
+        os._exit(0) # The OAuth callback server thread doesn't stop on its own
+
+    if args.command == 'calibrate':
+        from src.embeddings.calibration import calibrate
+        profile = calibrate(args.batch_sizes, args.intra_threads, args.inter_threads, args.track_seconds, args.tracks, args.max_memory_mb, write=not args.dry_run)
+        return 0 if profile is not None else 1
+
+    from src.utils.tsv_reader import DEFAULT_CHUNK_SIZE
+    jobs = parse_jobs(parser, args, argv)
+    for job in jobs:
+        job.chunk_size = job.chunk_size or DEFAULT_CHUNK_SIZE
+    collect_metrics = args.metrics or args.metrics_port or args.trace
+    if collect_metrics:
+        start_metrics(args)
+    succeeded = asyncio.run(PipelineRun(args).run(jobs))
+    if collect_metrics:
+        stop_metrics()
+    return 0 if succeeded else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,7 +14,7 @@ sys.path.insert(0, str(project_root))
 from colorama import Fore, Style
 import asyncio
 import time
-from src.interface.spotify_utils import sp
+from src.interface.spotify_utils import sp, PLAYLISTS_PATH, LIKES_PATH
 from src.embeddings.generator import add_embeddings_to_tsv, download_and_embed_tsv
 #from src.embeddings.vgg_maxpool import extract_one_embedding
 
@@ -26,7 +26,8 @@ async def get_playlist_embedding(playlist_name: str):
     playlist_id = sp.get_playlist_uri_for_name(playlist_name)
 
     # Get the track IDs
-    tsv_path = os.path.join(os.path.dirname(__file__), 'data', 'playlists', f'{playlist_name.lower().replace(' ', '_')}.tsv')
+    file_name = playlist_name.lower().replace(' ', '_')
+    tsv_path = os.path.join(PLAYLISTS_PATH, f"{file_name}.tsv")
     sp.load_playlist_to_tsv(playlist_id, tsv_path)
 
     # Add the embeddings to the TSV
@@ -37,12 +38,10 @@ async def get_likes_embedding():
     Extracts the embedding for all liked songs.
     """
     # Get the liked songs
-    sp.load_likes_to_tsv()
-
-    likes_path = os.path.join(os.path.dirname(__file__), 'playlists', 'likes.tsv')
+    sp.load_likes_to_tsv(LIKES_PATH)
 
     # Add the embeddings to the TSV
-    await download_and_embed_tsv(likes_path)
+    await download_and_embed_tsv(LIKES_PATH)
 
 def menu():
     """
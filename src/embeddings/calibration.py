@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Calibrates the embedding engine for this machine.
+
+Sweeps the inference batch size and TensorFlow's intra-op/inter-op thread
+counts on synthetic log-mel examples shaped like a typical track, measures
+tracks per second and peak memory for each combination, and writes the
+fastest one (within an optional memory budget) to this machine's engine
+profile. EmbeddingEngine loads the profile automatically (see vgg_maxpool.py).
+
+Each combination runs in a fresh process, since TensorFlow's thread pools
+are fixed once created and peak memory is only meaningful per process.
+
+Usage:
+    python cli.py calibrate
+    python cli.py calibrate --batch-sizes 32 64 128 --max-memory-mb 4000
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import json
+import multiprocessing
+import resource
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from src.embeddings.vgg import vggish_params
+from src.embeddings.vgg_maxpool import CHECKPOINT_PATH, PCA_PARAMS_PATH, profile_path
+
+BATCH_SIZES = [16, 32, 64, 128, 256]
+
+def thread_options(cpu_count: int | None = None) -> list:
+    """
+    Lists the intra-op thread counts worth trying: powers of two below the
+    CPU count, and the CPU count itself.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    options = [1 << i for i in range(cpu_count.bit_length()) if 1 << i < cpu_count]
+    return options + [cpu_count]
+
+def examples_per_track(track_seconds: float) -> int:
+    """
+    Returns the number of VGGish examples a track of this length is split into.
+    """
+    return max(1, int((track_seconds - vggish_params.EXAMPLE_WINDOW_SECONDS) // vggish_params.EXAMPLE_HOP_SECONDS) + 1)
+
+def synthetic_examples(count: int, seed: int = 0) -> np.ndarray:
+    """
+    Generates log-mel examples in the range of real ones (log of 0.01 up to loud bands).
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(np.log(vggish_params.LOG_OFFSET), 3.0, (count, vggish_params.NUM_FRAMES, vggish_params.NUM_BANDS)).astype(np.float32)
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure(batch_size: int, intra_op_threads: int, inter_op_threads: int, track_seconds: float, tracks: int, checkpoint_path: str = CHECKPOINT_PATH, pca_params_path: str = PCA_PARAMS_PATH) -> dict:
+    """
+    Measures one configuration. Meant to run in a fresh process.
+
+    Returns:
+        dict: The configuration with its tracks/s, examples/s and peak memory.
+    """
+    from src.embeddings import vgg_maxpool
+
+    engine = vgg_maxpool.EmbeddingEngine(checkpoint_path, pca_params_path, batch_size=batch_size, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    examples = synthetic_examples(examples_per_track(track_seconds))
+    engine.embed_examples(examples)  # Warm up at the real batch shape
+
+    start = time.perf_counter()
+    for _ in range(tracks):
+        engine.embed_examples(examples)
+    elapsed = time.perf_counter() - start
+    engine.close()
+    return {
+        'batch_size': batch_size,
+        'intra_op_threads': intra_op_threads,
+        'inter_op_threads': inter_op_threads,
+        'tracks_per_s': tracks / elapsed,
+        'examples_per_s': tracks * len(examples) / elapsed,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'use_gpu': vgg_maxpool.use_gpu  # False if no GPU was found
+    }
+
+def choose(results: list, max_memory_mb: float | None = None) -> dict | None:
+    """
+    Picks the fastest configuration within the memory budget.
+    """
+    allowed = [r for r in results if max_memory_mb is None or r['peak_rss_mb'] <= max_memory_mb]
+    return max(allowed, key=lambda r: r['tracks_per_s'], default=None)
+
+def calibrate(batch_sizes: list = BATCH_SIZES, intra_threads: list | None = None, inter_threads: list | None = None, track_seconds: float = 180.0, tracks: int = 5, max_memory_mb: float | None = None, write: bool = True) -> dict | None:
+    """
+    Sweeps every combination of batch size and thread counts and saves the best.
+
+    Args:
+        batch_sizes (list): Examples per inference call. Sizes at or above a
+            track's example count all feed the whole track at once, so only
+            the first of them is tried.
+        intra_threads (list | None): Intra-op thread counts. Defaults to thread_options().
+        inter_threads (list | None): Inter-op thread counts. Defaults to [1, 2].
+        track_seconds (float): Length of the synthetic track.
+        tracks (int): Tracks embedded per measurement.
+        max_memory_mb (float | None): Ignore configurations whose peak memory is above this.
+        write (bool): Write the best configuration to this machine's engine profile.
+
+    Returns:
+        dict | None: The profile, or None if no configuration fit the budget.
+
+    Raises:
+        SystemExit: If the VGGish checkpoint is missing.
+    """
+    if not (os.path.exists(CHECKPOINT_PATH) and os.path.exists(PCA_PARAMS_PATH)):
+        print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.RED}Error: VGGish model files not found. Run __init__.py first.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    per_track = examples_per_track(track_seconds)
+    sizes = sorted({min(b, per_track) for b in batch_sizes})
+    grid = [(b, i, j) for b in sizes for i in (intra_threads or thread_options()) for j in (inter_threads or [1, 2])]
+    print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Measuring {len(grid)} configurations on {tracks} synthetic {track_seconds:.0f}s tracks ({per_track} examples each)...{Style.RESET_ALL}")
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for batch_size, intra, inter in grid:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                result = pool.submit(measure, batch_size, intra, inter, track_seconds, tracks).result()
+            except Exception as e:
+                print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.RED}Error: batch {batch_size}, {intra}/{inter} threads failed: {e}{Style.RESET_ALL}")
+                continue
+        results.append(result)
+        print(f"    batch {batch_size:>4}  intra {intra:>3}  inter {inter:>2}  {result['tracks_per_s']:8.2f} tracks/s  {result['examples_per_s']:9.1f} examples/s  {result['peak_rss_mb']:8.1f} MB")
+
+    best = choose(results, max_memory_mb)
+    if best is None:
+        print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.RED}Error: No configuration fit in {max_memory_mb} MB.{Style.RESET_ALL}")
+        return None
+
+    profile = {
+        **best,
+        'host': socket.gethostname(),
+        'cpu_count': os.cpu_count(),
+        'track_seconds': track_seconds,
+        'calibrated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'results': results
+    }
+    print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.GREEN}Best: batch size {best['batch_size']}, {best['intra_op_threads']} intra-op / {best['inter_op_threads']} inter-op threads, {best['tracks_per_s']:.2f} tracks/s.{Style.RESET_ALL}")
+    if write:
+        path = profile_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        os.replace(tmp_path, path)
+        print(f"{Style.BRIGHT}[Calibration]: {Style.NORMAL}{Fore.GREEN}Profile written to {path}.{Style.RESET_ALL}")
+    return profile
+
+if __name__ == "__main__":
+    calibrate()
@@ -13,158 +13,352 @@ sys.path.insert(0, str(project_root))
 
 from colorama import Fore, Style
 import asyncio
-import json
-from src.utils.ytdl_handler import download_best
-from src.utils.download_songs import download_songs
-from src.embeddings.vgg_maxpool import extract_one_embedding
-import pandas as pd
+from src.embeddings.vgg_maxpool import extract_one_embedding, MODEL_VERSION
+from src.storage.track_catalog import TrackCatalog
+from src.storage.embedding_store import EmbeddingStore, migrate_tsv_embeddings, sidecar_versions, record_sidecar_versions
+from src.storage.result_writer import ResultWriter, results_path_for
+from src.map.similarity_index import update_catalog_index
+from src.map.clustering import update_catalog_clusters
+from src.map.dedupe import DuplicateIndex
+from src.map.projection import update_catalog_layout
+from src.map.tiles import update_catalog_tiles
+from src.utils.tsv_reader import TrackRecord, read_track_chunks, count_rows, DEFAULT_CHUNK_SIZE
+from src.utils import metrics
+import numpy as np
 from tqdm import tqdm
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
-with open(CONFIG_PATH, 'r') as f:
-    config = json.load(f)
+from src.utils.config import config
 
 WAVEFORM_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['audio_destination_path'][1:])
+DOWNLOAD_CONCURRENCY = config['settings']['download_concurrency']
+
+# Columns of the streaming results log (see result_writer.py)
+RESULT_COLUMNS = ['Track ID', 'Track Name', 'Artists', 'Song Length (s)', 'Status', 'Embedding Row', 'Duplicate Of']
+
+def _result_row(track: TrackRecord, status: str, embedding_row: int | None = None, duplicate_of: str | None = None) -> dict:
+    metrics.counter('tracks_total', status=status)
+    return {
+        'Track ID': track.track_id,
+        'Track Name': track.track_name,
+        'Artists': track.artists,
+        'Song Length (s)': track.song_length,
+        'Status': status,
+        'Embedding Row': embedding_row,
+        'Duplicate Of': duplicate_of
+    }
+
+def audio_path_for(track_id: str) -> str:
+    """
+    Returns the path a track's downloaded audio is saved to.
+    """
+    return os.path.join(WAVEFORM_PATH, f"sp_id_{track_id}.mp3")
+
+def audio_fingerprint(path: str) -> str | None:
+    """
+    Fingerprints an audio file by size and modification time, so a
+    re-downloaded file can be told apart from the one that was embedded.
+
+    Args:
+        path (str): The path to the audio file.
+
+    Returns:
+        str | None: The fingerprint, or None if the file doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_size}-{st.st_mtime_ns}"
 
-async def embed_row(row: pd.Series, pre_downloaded: bool = False) -> list:
+async def embed_row(row: TrackRecord, pre_downloaded: bool = False) -> np.ndarray:
     """
-    Embeds a row of the dataframe.
+    Embeds a row of a playlist TSV.
 
-    This function takes a row of the dataframe as input, downloads the song, generates embeddings,
+    This function takes a row of the TSV as input, downloads the song, generates embeddings,
     and returns the embeddings.
 
     Note: This isn't as optimized as downloading all the songs at once, and 
     should be used for testing purposes or one-off embeddings.
 
     Args:
-        row (pd.Series): A row of the dataframe.
+        row (TrackRecord): A row of the TSV (see tsv_reader.py).
         pre_downloaded (bool): Whether the song has already been downloaded.
 
     Returns:
-        list: The embedding of the row [list of 128 floats].
+        np.ndarray: The float32 embedding of the row [128 floats].
     """
     # Download the song
     if not pre_downloaded:
+        from src.utils.ytdl_handler import download_best
         success, file_path = await download_best(
-            search_query=row['Track Name'] + ' by ' + row['Artists'], 
-            target_length=row['Song Length (s)'],
+            search_query=row.track_name + ' by ' + row.artists, 
+            target_length=row.song_length,
             threshold=5,
-            sp_id=row['Track ID']
+            sp_id=row.track_id
         )
 
         if not success:
-            print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: Could not download {row['Track Name']} ({row['Track ID']}).{Style.RESET_ALL}")
+            print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: Could not download {row.track_name} ({row.track_id}).{Style.RESET_ALL}")
             return None
     else:
-        file_path = WAVEFORM_PATH + f"sp_id_{row['Track ID']}.mp3"
+        file_path = audio_path_for(row.track_id)
 
     # Generate the embeddings
     embedding = extract_one_embedding(file=file_path)
     # print(type(embedding))
     # print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.GREEN}Embedding generated for {row['Track Name']} is shape {len(embedding)}{Style.RESET_ALL}")
 
-    return embedding.tolist()
+    return embedding.astype(np.float32)
 
-async def add_embeddings_to_tsv(tsv_path: str):
+async def add_embeddings_to_tsv(tsv_path: str, force: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE):
     """
     Adds embeddings to a TSV file.
 
-    This function reads a TSV file, generates embeddings for each row, and adds these embeddings
-    as a new column to the dataframe. The updated dataframe is then saved back to the TSV file.
+    This function reads a TSV file, generates embeddings for the rows whose
+    embedding is missing, was made by another model version, or whose audio
+    file has changed since, and appends them to the TSV's sidecar embedding
+    store (<name>.embeddings.npy/.ids, with the model version and audio
+    fingerprint of each row in <name>.embeddings.versions). The TSV itself
+    only holds metadata.
 
     Args:
         tsv_path (str): The path to the TSV file.
+        force (bool): Re-embed every row, not just the stale ones.
+        chunk_size (int): Number of TSV rows read into memory at a time.
 
     Raises:
-        SystemExit: If the file does not exist or if the 'embeddings' column already exists in the dataframe.
+        FileNotFoundError: If the file does not exist.
 
     Notes:
-        - The function checks if the file exists at the given path. If not, it prints an error message and exits.
-        - It reads the TSV file into a pandas dataframe.
-        - It ensures that the 'embeddings' column is not already present in the dataframe.
-        - It iterates over each row of the dataframe, generating embeddings and appending them to a list.
-        - The embeddings are added as a new column to the dataframe.
-        - The updated dataframe is saved back to the TSV file.
+        - The function checks if the file exists at the given path. If not, it raises FileNotFoundError.
+        - A legacy inline 'embeddings' column is first moved into the sidecar store.
+        - It streams the TSV in chunks of TrackRecords rather than loading it whole.
+        - It iterates over each stale row, generating an embedding and appending it to the store.
+        - Each row is logged to <name>.results.tsv as soon as it completes.
         - A success message is printed upon completion.
     """
     # Check if the file exists
     if not os.path.exists(tsv_path):
-        print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: File not found.{Style.RESET_ALL}")
-        sys.exit(1)
-
-    # Read
-    df = pd.read_csv(tsv_path, sep='\t')
-
-    # Ensure 'embeddings' column is not already present
-    if 'embeddings' in df.columns:
-        print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: 'embeddings' column already exists in the dataframe.{Style.RESET_ALL}")
-        sys.exit(1)
-
-    embeddings = []
-
-    for _, row in tqdm(df.iterrows(), desc="Embedding rows", total=df.shape[0]):
-        embeddings.append(await embed_row(row))
+        raise FileNotFoundError(f"No TSV at {tsv_path}.")
+
+    prefix = migrate_tsv_embeddings(tsv_path)
+    store = EmbeddingStore(prefix)
+    recorded = sidecar_versions(store)
+
+    # Each embedding is committed to the store and logged as soon as it's done
+    embedded, attempted = 0, set()
+    with ResultWriter(results_path_for(tsv_path), RESULT_COLUMNS, prefix) as writer, \
+         tqdm(desc="Embedding rows", total=count_rows(tsv_path)) as pbar:
+        for chunk in read_track_chunks(tsv_path, chunk_size):
+            for track in chunk:
+                pbar.update(1)
+                audio_path = audio_path_for(track.track_id)
+                if track.track_id in attempted or (not force and not _sidecar_stale(recorded.get(track.track_id), audio_fingerprint(audio_path))):
+                    continue
+                attempted.add(track.track_id)
+                embedding = await embed_row(track)
+                if embedding is None:
+                    writer.write(_result_row(track, 'failed'))
+                    continue
+                rows = store.append([track.track_id], embedding[np.newaxis])
+                record_sidecar_versions(store, rows, [MODEL_VERSION], [audio_fingerprint(audio_path)])
+                store_row = int(rows[0])
+                writer.write(_result_row(track, 'embedded', store_row))
+                embedded += 1
+
+    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.GREEN}Embedded {embedded} of {len(attempted)} pending rows of {tsv_path} into {prefix}.npy.{Style.RESET_ALL}")
+
+def _sidecar_stale(recorded: tuple | None, fingerprint: str | None) -> bool:
+    """
+    Applies TrackCatalog.stale_embeddings' rule to a sidecar row's recorded
+    (model version, audio fingerprint).
+    """
+    if recorded is None:
+        return True
+    version, recorded_fingerprint = recorded
+    return version != MODEL_VERSION or (fingerprint is not None and recorded_fingerprint != fingerprint)
 
-    # Add the embeddings to the dataframe
-    df['embeddings'] = embeddings
+def _import_sidecar_embeddings(catalog: TrackCatalog, prefix: str):
+    """
+    Copies embeddings from a TSV's sidecar store into the catalog for tracks
+    the catalog has no embedding for, with the model version and audio
+    fingerprint recorded for them. Rows without a record are imported with
+    an unknown version, so they count as stale and are redone.
+    """
+    store = EmbeddingStore(prefix)
+    missing = catalog.missing_embeddings(store.ids)
+    if not missing:
+        return
+    matrix, found = store.get(missing)
+    ids = [t for t, ok in zip(missing, found) if ok]
+    recorded = sidecar_versions(store)
+    versions = [recorded.get(t, (None, None)) for t in ids]
+    for version in {v for v, _ in versions}:
+        mask = np.array([v == version for v, _ in versions])
+        catalog.set_embeddings(
+            [t for t, m in zip(ids, mask) if m],
+            matrix[mask],
+            version,
+            [fp for (_, fp), m in zip(versions, mask) if m]
+        )
 
-    # Save the dataframe
-    df.to_csv(tsv_path, sep='\t', index=False)
+def update_catalog_artifacts(store: EmbeddingStore):
+    """
+    Brings everything derived from the catalog's embeddings up to date: the
+    similarity index, clusters, map layout and map tiles. Each only processes
+    the tracks added since its last update where it can.
 
-    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.GREEN}Embeddings added to {tsv_path}.{Style.RESET_ALL}")
+    Args:
+        store (EmbeddingStore): The catalog's embedding store.
+    """
+    update_catalog_index(store)
+    update_catalog_clusters(store)
+    layout = update_catalog_layout(store)
+    if layout is not None:
+        update_catalog_tiles(layout)
 
-async def download_and_embed_tsv(tsv_path: str):
+async def download_and_embed_tsv(tsv_path: str, collection: str | None = None, kind: str | None = None, catalog: TrackCatalog | None = None, force: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE, update_index: bool = True, download_concurrency: int = DOWNLOAD_CONCURRENCY) -> int:
     """
     Downloads and embeds a TSV file.
 
-    This function reads a TSV file, downloads the songs asynchronously in 
-    batches, generates embeddings for each row, and adds these embeddings
-    as a new column to the dataframe. The updated dataframe is then saved
-    back to the TSV file.
+    This function streams a TSV file in chunks, registers its tracks and
+    membership list in the track catalog, and (re-)embeds only the tracks
+    whose catalog embedding is missing, failed, was made by another model
+    version, or whose audio file has changed since. Audio is only downloaded
+    for tracks that don't have it yet. The embeddings of every row are then
+    written to the TSV's sidecar embedding store; the TSV itself only holds
+    metadata.
 
     Args:
         tsv_path (str): The path to the TSV file.
+        collection (str | None): Catalog collection name. Defaults to the TSV file name.
+        kind (str | None): Catalog collection kind. Defaults to 'likes' for the likes TSV, otherwise 'playlist'.
+        catalog (TrackCatalog | None): The catalog to use. Defaults to the shared catalog.
+        force (bool): Re-embed every track, not just the stale ones.
+        chunk_size (int): Number of TSV rows read into memory at a time.
+        update_index (bool): Add newly embedded tracks to the persisted similarity index, clusters, map layout and tiles.
+        download_concurrency (int): Maximum number of songs downloaded at once.
+
+    Returns:
+        int: The number of tracks embedded.
 
     Raises:
-        SystemExit: If the file does not exist or if the 'embeddings' column already exists in the dataframe.
+        FileNotFoundError: If the file does not exist.
 
     Notes:
-        - The function checks if the file exists at the given path. If not, it prints an error message and exits.
-        - It reads the TSV file into a pandas dataframe.
-        - It ensures that the 'embeddings' column is not already present in the dataframe.
-        - It downloads the songs asynchronously in batches.
-        - It iterates over each row of the dataframe, generating embeddings and appending them to a list.
-        - The embeddings are added as a new column to the dataframe.
-        - The updated dataframe is saved back to the TSV file.
+        - The function checks if the file exists at the given path. If not, it raises FileNotFoundError.
+        - A legacy inline 'embeddings' column is moved into the sidecar store and imported into the catalog.
+        - The TSV is read in chunks of TrackRecords, and each chunk goes through every stage before the next is read, so memory use doesn't grow with the file.
+        - It upserts the tracks into the catalog and appends them to the collection.
+        - It downloads the stale songs without audio asynchronously.
+        - It embeds each stale song once and stores the result in the catalog.
+        - Tracks that fail keep their previous embedding, if any, and are retried next run.
+        - Every row is logged to <name>.results.tsv as soon as it is settled.
+        - The embeddings for every row are copied from the catalog into a new sidecar store, which replaces the old one at the end.
+        - New catalog embeddings are added to the similarity index and clusters (see similarity_index.py, clustering.py).
         - A success message is printed upon completion.
     """
     # Check if the file exists
     if not os.path.exists(tsv_path):
-        print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: File not found.{Style.RESET_ALL}")
-        sys.exit(1)
-
-    # Read
-    df = pd.read_csv(tsv_path, sep='\t')
-
-    # Ensure 'embeddings' column is not already present
-    if 'embeddings' in df.columns:
-        print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: 'embeddings' column already exists in the dataframe.{Style.RESET_ALL}")
-        sys.exit(1)
-
-    # Download and embed the songs
-    await download_songs(df)
-
-    # Add the embeddings to the dataframe
-    embeddings = []
-    for _, row in tqdm(df.iterrows(), desc="Embedding rows", total=df.shape[0]):
-        embeddings.append(await embed_row(row, pre_downloaded=True))
-
-    df['embeddings'] = embeddings
-
-    # Save the dataframe
-    df.to_csv(tsv_path, sep='\t', index=False)
-
-    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.GREEN}Embeddings added to {tsv_path}.{Style.RESET_ALL}")
+        raise FileNotFoundError(f"No TSV at {tsv_path}.")
+
+    prefix = migrate_tsv_embeddings(tsv_path)
+
+    # Register the membership list, filled in chunk by chunk below
+    if catalog is None:
+        catalog = TrackCatalog()
+    if collection is None:
+        collection = Path(tsv_path).stem
+    if kind is None:
+        kind = 'likes' if collection == 'likes' else 'playlist'
+    catalog.set_collection(collection, kind, [])
+    if os.path.exists(prefix + '.npy'):
+        _import_sidecar_embeddings(catalog, prefix)
+
+    total = count_rows(tsv_path)
+    position, embedded, stale_total = 0, 0, 0
+    sidecar = EmbeddingStore.staging(prefix, dim=catalog.store.dim, dtype=catalog.store.dtype)
+    duplicates = None  # Built from the catalog when the first track is embedded
+
+    # Every row is logged as soon as it's settled so the results can be
+    # tailed while the run is in progress
+    with ResultWriter(results_path_for(tsv_path), RESULT_COLUMNS, catalog.store.prefix) as writer, \
+         tqdm(desc="Embedding rows", total=total) as pbar:
+        for chunk in read_track_chunks(tsv_path, chunk_size):
+            # Register the tracks and their collection positions
+            catalog.upsert_records(chunk)
+            catalog.extend_collection(
+                collection,
+                [t.track_id for t in chunk],
+                [t.added_at for t in chunk],
+                start=position
+            )
+            position += len(chunk)
+
+            # Only schedule the tracks whose embedding is missing or out of
+            # date. A track repeated in a later chunk is cached by then.
+            tracks = list({t.track_id: t for t in chunk}.values())
+            track_ids = [t.track_id for t in tracks]
+            fingerprints = {t: fp for t in track_ids if (fp := audio_fingerprint(audio_path_for(t))) is not None}
+            stale_ids = set(track_ids if force else catalog.stale_embeddings(track_ids, MODEL_VERSION, fingerprints))
+            stale_total += len(stale_ids)
+
+            # Download the stale songs that don't have audio yet
+            to_download = [t for t in tracks if t.track_id in stale_ids and t.track_id not in fingerprints]
+            if to_download:
+                # Deferred so that runs with nothing to download don't load yt-dlp
+                from src.utils.download_songs import download_songs
+                downloads, _ = await download_songs(to_download, download_concurrency)
+                for track_id, (audio_path, url) in downloads.items():
+                    catalog.set_download(track_id, audio_path, url)
+
+            cached_rows = catalog.embedding_rows([t for t in track_ids if t not in stale_ids])
+            queued = len(stale_ids)
+            for track in tracks:
+                if track.track_id not in stale_ids:
+                    writer.write(_result_row(track, 'cached', cached_rows.get(track.track_id)))
+                    continue
+                queued -= 1
+                metrics.gauge('embed_queue_depth', queued)
+                audio_path = audio_path_for(track.track_id)
+                if not os.path.exists(audio_path):
+                    writer.write(_result_row(track, 'not downloaded'))
+                    continue
+                try:
+                    embedding = await embed_row(track, pre_downloaded=True)
+                except Exception as e:
+                    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.RED}Error: Could not embed {track.track_name} ({track.track_id}): {e}{Style.RESET_ALL}")
+                    writer.write(_result_row(track, 'failed'))
+                    continue
+
+                # Check for a near-duplicate already in the catalog before storing
+                if duplicates is None:
+                    duplicates = DuplicateIndex.from_catalog(catalog)
+                match = duplicates.query(embedding, track.song_length, exclude=track.track_id)
+                duplicate_of = match[0] if match else None
+                store_row = catalog.set_embedding(track.track_id, embedding, MODEL_VERSION, audio_fingerprint(audio_path))
+                catalog.set_duplicates({track.track_id: duplicate_of})
+                if duplicate_of is None:
+                    duplicates.add(track.track_id, embedding, track.song_length)
+                writer.write(_result_row(track, 'embedded', store_row, duplicate_of))
+                embedded += 1
+            pbar.update(len(chunk))
+
+            # Copy this chunk's embeddings next to the TSV. They are rows
+            # already in memory-mapped storage, so this is cheap next to embedding.
+            chunk_ids = [t.track_id for t in chunk]
+            matrix, found = catalog.get_embedding_matrix(chunk_ids)
+            found_ids = [t for t, ok in zip(chunk_ids, found) if ok]
+            rows = sidecar.append(found_ids, matrix)
+            versions = catalog.embedding_versions(found_ids)
+            record_sidecar_versions(sidecar, rows, [versions[t][0] for t in found_ids], [versions[t][1] for t in found_ids])
+
+    sidecar.promote(prefix)
+    if update_index:
+        update_catalog_artifacts(catalog.store)
+
+    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.CYAN}{stale_total} of {total} rows needed embedding.{Style.RESET_ALL}")
+    print(f"{Style.BRIGHT}[EmbeddingsGenerator]: {Style.NORMAL}{Fore.GREEN}Embedded {embedded} tracks; embeddings for {tsv_path} written to {prefix}.npy.{Style.RESET_ALL}")
+    return embedded
 
 if __name__ == "__main__":
     # asyncio.run(add_embeddings_to_tsv(sys.argv[1]))
@@ -175,13 +369,16 @@ if __name__ == "__main__":
 
     asyncio.run(download_and_embed_tsv(tsv_path))
 
-    # test_row = pd.Series({
-    #     'Track ID': '3pLlcz1uuEqas5TkVzGiRe',
-    #     'Track Name': 'Awaken - Alternate Version',
-    #     'Artists': 'Alex Baker',
-    #     'Album': 'Awaken (Alternate Version)',
-    #     'Song Length (s)': 393.333
-    # })
+    # test_row = TrackRecord(
+    #     track_id='3pLlcz1uuEqas5TkVzGiRe',
+    #     track_name='Awaken - Alternate Version',
+    #     track_url=None,
+    #     artists='Alex Baker',
+    #     album='Awaken (Alternate Version)',
+    #     song_length=393.333,
+    #     metrics=None,
+    #     added_at=None
+    # )
 
     # embedding = asyncio.run(embed_row(test_row))
     # print(embedding)
\ No newline at end of file
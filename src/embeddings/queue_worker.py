@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Distributed embedding: fills the job queue (see job_queue.py) with the tracks
+that need embedding, and runs workers that lease batches of them, download
+and embed them, and hand the embeddings back.
+
+Any number of workers can run at once, in one process each, on any machine
+that can open the queue database. Each worker heartbeats its leases while it
+works, so a batch that takes longer than the lease isn't handed out twice,
+and the batch of a worker that crashes is picked up by another worker once
+its lease expires. Workers with access to the track catalog commit results
+into it as they go; workers on other machines run with commit=False and the
+results are committed by `python cli.py commit` on the catalog's machine.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import asyncio
+import socket
+from src.embeddings.generator import audio_path_for, audio_fingerprint
+from src.embeddings.vgg_maxpool import extract_one_embedding, MODEL_VERSION
+from src.storage.job_queue import JobQueue
+from src.storage.track_catalog import TrackCatalog
+from src.utils.tsv_reader import read_track_chunks, DEFAULT_CHUNK_SIZE
+from src.utils import metrics
+from src.utils.config import config
+
+BATCH_SIZE = config['settings']['job_batch_size']
+DOWNLOAD_CONCURRENCY = config['settings']['download_concurrency']
+
+def worker_name() -> str:
+    """
+    Names this worker process, e.g. 'gpu-box-3-12345'.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def enqueue_tsv(queue: JobQueue, catalog: TrackCatalog, tsv_path: str, collection: str | None = None, kind: str | None = None, force: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Registers a TSV's tracks and membership list in the catalog, as
+    download_and_embed_tsv does, and queues the tracks that need embedding.
+
+    Args:
+        queue (JobQueue): The job queue.
+        catalog (TrackCatalog): The track catalog.
+        tsv_path (str): The path to the TSV file.
+        collection (str | None): Catalog collection name. Defaults to the TSV file name.
+        kind (str | None): Catalog collection kind. Defaults to 'likes' for the likes TSV, otherwise 'playlist'.
+        force (bool): Queue every track, not just the stale ones.
+        chunk_size (int): Number of TSV rows read into memory at a time.
+
+    Returns:
+        int: The number of tracks newly queued.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    if not os.path.exists(tsv_path):
+        raise FileNotFoundError(f"No TSV at {tsv_path}.")
+
+    if collection is None:
+        collection = Path(tsv_path).stem
+    if kind is None:
+        kind = 'likes' if collection == 'likes' else 'playlist'
+    catalog.set_collection(collection, kind, [])
+
+    position, queued = 0, 0
+    for chunk in read_track_chunks(tsv_path, chunk_size):
+        catalog.upsert_records(chunk)
+        catalog.extend_collection(collection, [t.track_id for t in chunk], [t.added_at for t in chunk], start=position)
+        position += len(chunk)
+
+        tracks = {t.track_id: t for t in chunk}
+        fingerprints = {t: fp for t in tracks if (fp := audio_fingerprint(audio_path_for(t))) is not None}
+        stale_ids = set(tracks if force else catalog.stale_embeddings(list(tracks), MODEL_VERSION, fingerprints))
+        queued += queue.enqueue([t for track_id, t in tracks.items() if track_id in stale_ids])
+    return queued
+
+def enqueue_catalog(queue: JobQueue, catalog: TrackCatalog) -> int:
+    """
+    Queues every catalog track without an embedding from the current model.
+
+    Returns:
+        int: The number of tracks newly queued.
+    """
+    return queue.enqueue(catalog.stale_records(MODEL_VERSION))
+
+class QueueWorker:
+    def __init__(self, queue: JobQueue, catalog: TrackCatalog | None = None, name: str | None = None, batch_size: int = BATCH_SIZE, download_concurrency: int = DOWNLOAD_CONCURRENCY):
+        """
+        Sets up a worker.
+
+        Args:
+            queue (JobQueue): The job queue.
+            catalog (TrackCatalog | None): If given, results are committed to it
+                after every batch. Otherwise they wait in the queue.
+            name (str | None): Identifies the worker in the queue. Defaults to host and PID.
+            batch_size (int): Jobs leased at a time.
+            download_concurrency (int): Maximum number of songs downloaded at once.
+        """
+        self.queue = queue
+        self.catalog = catalog
+        self.name = name or worker_name()
+        self.batch_size = batch_size
+        self.download_concurrency = download_concurrency
+        self.active = []    # Jobs leased and not yet settled
+        self.lost = set()   # Track IDs whose lease went to another worker
+        self.stats = {'embedded': 0, 'failed': 0, 'lost': 0, 'committed': 0}
+        self._duplicates = None
+
+    async def _heartbeat(self):
+        # Renew well before expiry so a slow queue write doesn't lose the lease
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            self.lost |= await asyncio.to_thread(self.queue.heartbeat, list(self.active))
+
+    async def process(self, jobs: list):
+        """
+        Downloads and embeds a batch of leased jobs, handing each result back.
+
+        Args:
+            jobs (list): The leased Jobs.
+        """
+        to_download = [job.track for job in jobs if not os.path.exists(audio_path_for(job.track.track_id))]
+        downloads, download_errors = {}, {}
+        if to_download:
+            # Deferred so that workers with every track downloaded don't load yt-dlp
+            from src.utils.download_songs import download_songs
+            downloads, download_errors = await download_songs(to_download, self.download_concurrency)
+
+        for job in jobs:
+            track_id = job.track.track_id
+            audio_path = audio_path_for(track_id)
+            if track_id in self.lost:
+                status = 'lost'
+            elif not os.path.exists(audio_path):
+                # Uses up an attempt, so a track that can't be downloaded ends up failed
+                error = download_errors.get(track_id, 'not downloaded')
+                status = 'lost' if not self.queue.fail(job, error) else 'failed'
+            else:
+                try:
+                    # Off the event loop, so heartbeats keep running during inference
+                    embedding = await asyncio.to_thread(extract_one_embedding, audio_path)
+                except Exception as e:
+                    print(f"{Style.BRIGHT}[QueueWorker]: {Style.NORMAL}{Fore.RED}Error: Could not embed {job.track.track_name} ({track_id}): {e}{Style.RESET_ALL}")
+                    status = 'lost' if not self.queue.fail(job, str(e)) else 'failed'
+                else:
+                    url = downloads.get(track_id, (None, None))[1]
+                    accepted = self.queue.complete(job, embedding, MODEL_VERSION, audio_fingerprint(audio_path), url)
+                    status = 'embedded' if accepted else 'lost'
+            self.stats[status] += 1
+            metrics.counter('jobs_total', status=status)
+            self.active.remove(job)
+
+    def commit(self) -> int:
+        """
+        Commits the finished results in the queue to the catalog, checking each
+        track for near-duplicates first.
+
+        Returns:
+            int: The number of embeddings committed.
+        """
+        if self._duplicates is None:
+            from src.map.dedupe import DuplicateIndex
+            self._duplicates = DuplicateIndex.from_catalog(self.catalog)
+        committed = self.queue.commit_results(self.catalog, self._duplicates)
+        self.stats['committed'] += committed
+        return committed
+
+    async def run(self, follow: bool = False, poll_interval: float = 10.0, max_jobs: int | None = None) -> dict:
+        """
+        Leases and processes batches until the queue is drained.
+
+        Without `follow`, the worker waits while other workers hold leases
+        (their tracks come back if they crash) and stops once nothing is
+        pending or leased.
+
+        If the worker is interrupted (Ctrl+C or cancellation), its unfinished
+        jobs are released without using up an attempt. If it crashes, they are
+        failed instead, so a job that keeps crashing workers runs out of
+        attempts rather than taking down every worker that leases it.
+
+        Args:
+            follow (bool): Keep waiting for new jobs instead of stopping.
+            poll_interval (float): Seconds between checks of an empty queue.
+            max_jobs (int | None): Stop after leasing this many jobs.
+
+        Returns:
+            dict: Counts of tracks embedded, failed, lost to other workers, and committed.
+        """
+        print(f"{Style.BRIGHT}[QueueWorker]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Worker {self.name} started on {self.queue.db_path}.{Style.RESET_ALL}")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        leased = 0
+        try:
+            while max_jobs is None or leased < max_jobs:
+                count = self.batch_size if max_jobs is None else min(self.batch_size, max_jobs - leased)
+                jobs = await asyncio.to_thread(self.queue.lease, self.name, count)
+                if not jobs:
+                    counts = self.queue.counts()
+                    metrics.gauge('job_queue_depth', counts['pending'] + counts['expired'])
+                    if not follow and counts['pending'] + counts['leased'] + counts['expired'] == 0:
+                        break
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+                leased += len(jobs)
+                self.active.extend(jobs)
+                await self.process(jobs)
+                if self.catalog is not None:
+                    await asyncio.to_thread(self.commit)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            # Hand back anything unfinished rather than waiting for the lease to expire
+            if self.active:
+                self.queue.release(self.active)
+                self.active.clear()
+            raise
+        except Exception as e:
+            print(f"{Style.BRIGHT}[QueueWorker]: {Style.NORMAL}{Fore.RED}Error: Worker {self.name} crashed: {e}{Style.RESET_ALL}")
+            for job in self.active:
+                self.queue.fail(job, f"worker crashed: {e}")
+            self.active.clear()
+            raise
+        finally:
+            heartbeat.cancel()
+
+        print(f"{Style.BRIGHT}[QueueWorker]: {Style.NORMAL}{Fore.GREEN}Worker {self.name} finished: {self.stats['embedded']} embedded, {self.stats['failed']} failed, {self.stats['lost']} lost to other workers, {self.stats['committed']} committed.{Style.RESET_ALL}")
+        return self.stats
@@ -58,16 +58,20 @@ class Postprocessor(object):
             1,
         ), "Bad PCA means shape: %r" % (self._pca_means.shape,)
 
-    def postprocess(self, embeddings_batch):
+    def postprocess(self, embeddings_batch, quantize=False):
         """Applies postprocessing to a batch of embeddings.
 
         Args:
           embeddings_batch: An nparray of shape [batch_size, embedding_size]
             containing output from the embedding layer of VGGish.
+          quantize: If True, also apply the 8-bit quantization of the released
+            AudioSet embeddings. Off by default, as the map works on the
+            float PCA output (see src/storage/compression.py for compressed
+            storage).
 
         Returns:
-          An nparray of the same shape as the input but of type uint8,
-          containing the PCA-transformed and quantized version of the input.
+          An nparray of the same shape as the input containing the
+          PCA-transformed version of the input: float, or uint8 if quantized.
         """
         assert len(embeddings_batch.shape) == 2, "Expected 2-d batch, got %r" % (
             embeddings_batch.shape,
@@ -85,7 +89,8 @@ class Postprocessor(object):
         # - Transpose result back to [batch_size, embedding_size].
         pca_applied = np.dot(self._pca_matrix, (embeddings_batch.T - self._pca_means)).T
 
-        return pca_applied
+        if not quantize:
+            return pca_applied
 
         # Quantize by:
         # - clipping to [min, max] range
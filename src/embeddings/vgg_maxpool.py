@@ -6,6 +6,14 @@ Created on Thu Sep 19 2024
 This script extracts audio embeddings from audio files using a pre-trained VGGish model.
 It's also responsible for post-processing the embeddings.
 
+TensorFlow is only imported, and the model only loaded, when the first track
+is embedded (see get_engine), so importing this module is cheap.
+
+The inference batch size and TensorFlow thread counts come from this
+machine's engine profile, if `python cli.py calibrate` has written one (see
+calibration.py); otherwise a track's examples are fed in one batch with
+TensorFlow's default threading.
+
 NOTE: I should consider switching this to pytorch - this is very 2018.
 """
 
@@ -17,130 +25,321 @@ project_root = Path(__file__).resolve().parent.parent.parent
 sys.path.insert(0, str(project_root))
 
 from colorama import Fore, Style
-print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Loading TensorFlow. This may take a while...{Style.RESET_ALL}")
+import hashlib
 import json
-import time
-import numpy as np
 import logging
+import socket
+import threading
+import time
 import warnings
-import tensorflow.compat.v1 as tf # type: ignore
-print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.CYAN}TensorFlow version: {tf.__version__} loaded.{Style.RESET_ALL}")
-from src.embeddings.vgg import vggish_input
+import numpy as np
 from src.embeddings.vgg import vggish_params
 from src.embeddings.vgg import vggish_postprocess
-from src.embeddings.vgg import vggish_slim
-
-# Suppress TensorFlow logging
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-logging.getLogger('tensorflow').setLevel(logging.ERROR)
-# Suppress deprecation warnings
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
-warnings.filterwarnings("ignore")
-tf.compat.v1.disable_eager_execution()
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
-
-# Set random seed for reproducibility
-tf.set_random_seed(42)
-np.random.seed(42)
-
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
-with open(CONFIG_PATH, 'r') as f:
-    config  = json.load(f)
+from src.utils.config import config
+from src.utils import metrics
+
 use_gpu     = config['settings']['use_gpu']
 gpu_percent = config['settings']['gpu_percent']
 debug       = config['settings']['debug']
 
-CHECKPOINT_PATH = config['paths']['checkpoint_path']
-PCA_PARAMS_PATH = config['paths']['pca_params_path']
+CHECKPOINT_PATH = os.path.normpath(os.path.join(project_root, config['paths']['checkpoint_path']))
+PCA_PARAMS_PATH = os.path.normpath(os.path.join(project_root, config['paths']['pca_params_path']))
+ENGINE_PROFILE_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['engine_profile_path'][1:])
+MODEL_VERSION_CACHE_PATH = CHECKPOINT_PATH + '.version.json'
+
+def _file_digest(path: str) -> str:
+    """
+    Hashes a file's contents in chunks, so the checkpoint isn't read into memory at once.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-if use_gpu:
-    physical_devices = tf.config.experimental.list_physical_devices('GPU')
+def _model_version() -> str:
+    """
+    Identifies the embedding pipeline, so embeddings made by a different
+    checkpoint, PCA parameters or pooling can be detected and redone.
 
-    if len(physical_devices) == 0:
-        print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.RED}No GPU available. Switching to CPU...{Style.RESET_ALL}")
-        use_gpu = False
-    else:
-        print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.GREEN}GPU available. Using GPU...{Style.RESET_ALL}")
+    The version is built from a hash of the checkpoint and PCA parameters'
+    contents. Hashing the checkpoint takes a moment, so the digests are
+    cached next to it, keyed by each file's size and modification time.
+    """
+    try:
+        with open(MODEL_VERSION_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    digests, changed = [], False
+    for path in (CHECKPOINT_PATH, PCA_PARAMS_PATH):
+        if not os.path.exists(path):
+            digests.append('missing')
+            continue
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        entry = cache.get(path)
+        if not entry or entry.get('key') != key:
+            entry = cache[path] = {'key': key, 'digest': _file_digest(path)}
+            changed = True
+        digests.append(entry['digest'])
+    if changed:
         try:
-            tf.config.experimental.set_memory_growth(physical_devices[0], True)
-        except:
-            print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.RED}Invalid device or cannot modify virtual devices once initialized.")
-else:
-    print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.YELLOW}GPU disabled. Switching to CPU...{Style.RESET_ALL}")
+            tmp_path = MODEL_VERSION_CACHE_PATH + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, MODEL_VERSION_CACHE_PATH)
+        except OSError:
+            pass  # Read-only model directory; the digests are recomputed next time
+    return f"vggish-pca-maxpool-{'-'.join(digests)}"
 
+MODEL_VERSION = _model_version()
 
-def extract_one_embedding(file: str) -> np.ndarray:
+tf = None  # tensorflow.compat.v1, once _load_tensorflow has run
+
+def _load_tensorflow():
     """
-    Extracts a single embedding from an audio file using a pre-trained VGGish model.
-    
-    Args:
-        file (str): Path to the audio file.
+    Imports and configures TensorFlow the first time a model is loaded, so
+    that importing this module (and everything that imports it) stays fast.
+
     Returns:
-        np.ndarray: A 128-dimensional embedding representing the audio file.
-    Raises:
-        ValueError: If the embedding dimension is not 128.
-    Notes:
-        - The audio file is loaded as mono and resampled to 16kHz.
-        - The audio is split into 1-second segments, padded if necessary.
-        - Embeddings are extracted for each segment and max-pooled across all segments.
+        module: tensorflow.compat.v1.
     """
-    # Generate VGGish input samples
-    # - Resamples to 16kHz
-    # - Converts audio to mono
-    # - Frames a log-mel spectrogram into 0.96s examples with 50% overlap
-    # The output is numpy array of shape [num_examples, num_frames, num_bands]
-    # which is essentially always [num_examples, 96, 64]
-    segments = vggish_input.wavfile_to_examples(file)
-    segment_times = []
+    global tf, use_gpu
+    if tf is not None:
+        return tf
+
+    # Suppress TensorFlow logging (read when TensorFlow is imported)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
+    print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}Loading TensorFlow. This may take a while...{Style.RESET_ALL}")
+    import tensorflow.compat.v1 as tf_v1 # type: ignore
+    print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.CYAN}TensorFlow version: {tf_v1.__version__} loaded.{Style.RESET_ALL}")
+
+    logging.getLogger('tensorflow').setLevel(logging.ERROR)
+    # Suppress deprecation warnings
+    tf_v1.logging.set_verbosity(tf_v1.logging.ERROR)
+    warnings.filterwarnings("ignore")
+    tf_v1.disable_eager_execution()
+
+    # Set random seed for reproducibility
+    tf_v1.set_random_seed(42)
+    np.random.seed(42)
+
+    if use_gpu:
+        physical_devices = tf_v1.config.experimental.list_physical_devices('GPU')
+
+        if len(physical_devices) == 0:
+            print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.RED}No GPU available. Switching to CPU...{Style.RESET_ALL}")
+            use_gpu = False
+        else:
+            print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.GREEN}GPU available. Using GPU...{Style.RESET_ALL}")
+            try:
+                tf_v1.config.experimental.set_memory_growth(physical_devices[0], True)
+            except:
+                print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.RED}Invalid device or cannot modify virtual devices once initialized.")
+    else:
+        print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.YELLOW}GPU disabled. Switching to CPU...{Style.RESET_ALL}")
+
+    tf = tf_v1
+    return tf
+
+def profile_path(host: str | None = None) -> str:
+    """
+    Returns the path of a machine's engine profile.
+    """
+    return os.path.join(ENGINE_PROFILE_PATH, f"{host or socket.gethostname()}.json")
+
+def load_profile() -> dict:
+    """
+    Loads this machine's engine profile (see calibration.py).
+
+    A profile recorded with a different CPU count or device is ignored, since
+    its settings were tuned for other hardware.
+
+    Returns:
+        dict: The profile, or an empty dict if there's no usable one.
+    """
+    path = profile_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    if profile.get('cpu_count') != os.cpu_count() or profile.get('use_gpu') != use_gpu:
+        print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.YELLOW}Warning: Ignoring {path}, it was calibrated on different hardware. Run 'python cli.py calibrate' again.{Style.RESET_ALL}")
+        return {}
+    return profile
+
+def _session_config(intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """
+    Builds the TensorFlow session config for the configured device.
 
-    # Ensure GPU use if available
-    config = tf.ConfigProto()
+    Args:
+        intra_op_threads (int): Threads used within an op. 0 lets TensorFlow choose.
+        inter_op_threads (int): Ops run in parallel. 0 lets TensorFlow choose.
+    """
+    session_config = tf.ConfigProto()
+    session_config.intra_op_parallelism_threads = intra_op_threads
+    session_config.inter_op_parallelism_threads = inter_op_threads
     if use_gpu:
-        config.gpu_options.allow_growth = True
-        config.gpu_options.per_process_gpu_memory_fraction = gpu_percent
+        session_config.gpu_options.allow_growth = True
+        session_config.gpu_options.per_process_gpu_memory_fraction = gpu_percent
         print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}GPU limited to {gpu_percent * 100} of total memory.{Style.RESET_ALL}")
     else:
-        config.gpu_options.allow_growth = False
-        config.gpu_options.visible_device_list = '' # Force CPU use
+        session_config.gpu_options.allow_growth = False
+        session_config.gpu_options.visible_device_list = '' # Force CPU use
         if debug:
             print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTCYAN_EX}GPU disabled. Using CPU...{Style.RESET_ALL}")
 
-    config.log_device_placement = False
-    config.allow_soft_placement = True
+    session_config.log_device_placement = False
+    session_config.allow_soft_placement = True
+    return session_config
 
-    overall_start = time.time()
-    
-    with tf.Graph().as_default(), tf.Session(config=config) as sess:
-        # Define the VGGish model
-        vggish_slim.define_vggish_slim(training=False)
-        vggish_slim.load_vggish_slim_checkpoint(sess, CHECKPOINT_PATH)
+class EmbeddingEngine:
+    def __init__(self, checkpoint_path: str = CHECKPOINT_PATH, pca_params_path: str = PCA_PARAMS_PATH, warm_up: bool = True, batch_size: int | None = None, intra_op_threads: int | None = None, inter_op_threads: int | None = None):
+        """
+        Loads the VGGish graph, checkpoint and PCA parameters into a session
+        that's kept open, so embedding a track only runs the model.
+
+        Settings that aren't given are taken from this machine's engine
+        profile (see load_profile).
+
+        Args:
+            checkpoint_path (str): The VGGish checkpoint.
+            pca_params_path (str): The PCA parameters used by the postprocessor.
+            warm_up (bool): Run one dummy example now, so the first real call
+                doesn't pay for TensorFlow's lazy initialization.
+            batch_size (int | None): Examples per inference call. 0 feeds a track's examples in one call.
+            intra_op_threads (int | None): TensorFlow threads used within an op. 0 lets TensorFlow choose.
+            inter_op_threads (int | None): TensorFlow ops run in parallel. 0 lets TensorFlow choose.
+        """
+        _load_tensorflow()
+        from src.embeddings.vgg import vggish_slim
+
+        profile = load_profile() if None in (batch_size, intra_op_threads, inter_op_threads) else {}
+        if profile:
+            print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.CYAN}Using engine profile: batch size {profile['batch_size']}, {profile['intra_op_threads']} intra-op / {profile['inter_op_threads']} inter-op threads.{Style.RESET_ALL}")
+        self.batch_size = batch_size if batch_size is not None else profile.get('batch_size', 0)
+        self.intra_op_threads = intra_op_threads if intra_op_threads is not None else profile.get('intra_op_threads', 0)
+        self.inter_op_threads = inter_op_threads if inter_op_threads is not None else profile.get('inter_op_threads', 0)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.sess = tf.Session(config=_session_config(self.intra_op_threads, self.inter_op_threads), graph=self.graph)
+            # Define the VGGish model
+            vggish_slim.define_vggish_slim(training=False)
+            vggish_slim.load_vggish_slim_checkpoint(self.sess, checkpoint_path)
 
-        # Get input and output tensors
-        features_tensor  = sess.graph.get_tensor_by_name(vggish_params.INPUT_TENSOR_NAME)
-        embedding_tensor = sess.graph.get_tensor_by_name(vggish_params.OUTPUT_TENSOR_NAME)
+            # Get input and output tensors
+            self.features_tensor  = self.graph.get_tensor_by_name(vggish_params.INPUT_TENSOR_NAME)
+            self.embedding_tensor = self.graph.get_tensor_by_name(vggish_params.OUTPUT_TENSOR_NAME)
+        self.graph.finalize()
 
         # Create a postprocessor
-        pproc = vggish_postprocess.Postprocessor(PCA_PARAMS_PATH)
+        self.pproc = vggish_postprocess.Postprocessor(pca_params_path)
+
+        if warm_up:
+            self.embed_examples(np.zeros((1, vggish_params.NUM_FRAMES, vggish_params.NUM_BANDS), dtype=np.float32))
+
+    def embed_examples(self, examples: np.ndarray, timings: dict | None = None) -> np.ndarray:
+        """
+        Embeds a track from its VGGish input examples.
+
+        Args:
+            examples (np.ndarray): Log-mel examples of shape [num_examples, 96, 64] (see vggish_input.py).
+            timings (dict | None): If given, the seconds spent on inference,
+                postprocessing and pooling are stored in it under those names.
+
+        Returns:
+            np.ndarray: A 128-dimensional embedding, max-pooled across the examples.
+
+        Raises:
+            ValueError: If there are no examples (audio shorter than 0.96 s).
+        """
+        if len(examples) == 0:
+            raise ValueError("No examples to embed; the audio is shorter than one 0.96 s example.")
 
         # Run inference
-        st = time.time()
-        [embedding_batch] = sess.run([embedding_tensor], feed_dict={features_tensor: segments})
-        segment_times.append(time.time() - st)
+        st = time.perf_counter()
+        batch_size = self.batch_size or len(examples)
+        with metrics.span('inference'):
+            batches = [
+                self.sess.run(self.embedding_tensor, feed_dict={self.features_tensor: examples[i:i + batch_size]})
+                for i in range(0, len(examples), batch_size)
+            ]
+            embedding_batch = np.concatenate(batches) if len(batches) > 1 else batches[0]
+        inference_end = time.perf_counter()
 
         if debug:
             print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTMAGENTA_EX}Embedding shape: {embedding_batch.shape}{Style.RESET_ALL}")
-        
+
         # Postprocess the embeddings
-        postprocessed_batch = pproc.postprocess(embedding_batch)
+        with metrics.span('postprocess'):
+            postprocessed_batch = self.pproc.postprocess(embedding_batch)
+        postprocess_end = time.perf_counter()
 
         # Max pool the embeddings across all segments
         embedding = np.max(postprocessed_batch, axis=0)
 
+        metrics.counter('examples_embedded_total', len(examples))
+        if timings is not None:
+            timings['inference'] = inference_end - st
+            timings['postprocess'] = postprocess_end - inference_end
+            timings['pool'] = time.perf_counter() - postprocess_end
+        return embedding
+
+    def close(self):
+        """
+        Closes the session.
+        """
+        self.sess.close()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> EmbeddingEngine:
+    """
+    Returns the process-wide embedding engine, loading it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = EmbeddingEngine()
+    return _engine
+
+def extract_one_embedding(file: str) -> np.ndarray:
+    """
+    Extracts a single embedding from an audio file using a pre-trained VGGish model.
+    
+    Args:
+        file (str): Path to the audio file.
+    Returns:
+        np.ndarray: A 128-dimensional embedding representing the audio file.
+    Raises:
+        ValueError: If the audio is too short to embed.
+    Notes:
+        - The audio file is loaded as mono and resampled to 16kHz.
+        - The audio is split into 1-second segments, padded if necessary.
+        - Embeddings are extracted for each segment and max-pooled across all segments.
+        - The model is loaded once per process (see get_engine).
+    """
+    # Generate VGGish input samples
+    # - Resamples to 16kHz
+    # - Converts audio to mono
+    # - Frames a log-mel spectrogram into 0.96s examples with 50% overlap
+    # The output is numpy array of shape [num_examples, num_frames, num_bands]
+    # which is essentially always [num_examples, 96, 64]
+    from src.embeddings.vgg import vggish_input
+    with metrics.span('decode'):
+        segments = vggish_input.wavfile_to_examples(file)
+
+    overall_start = time.time()
+    timings = {}
+    embedding = get_engine().embed_examples(segments, timings)
+
     overall_end = time.time()
     if debug:
         print(f"{Style.BRIGHT}[Embeddings]: {Style.NORMAL}{Fore.LIGHTMAGENTA_EX}Total embedding extraction time: {overall_end - overall_start:.2f} seconds{Style.RESET_ALL}")
-        print(f"{Style.BRIGHT}[Embeddings]: {Style.DIM}{Fore.LIGHTMAGENTA_EX}Average segment embedding time: {np.mean(segment_times):.2f} seconds{Style.RESET_ALL}")
+        print(f"{Style.BRIGHT}[Embeddings]: {Style.DIM}{Fore.LIGHTMAGENTA_EX}Inference time for {len(segments)} segments: {timings['inference']:.2f} seconds{Style.RESET_ALL}")
 
-    return embedding
\ No newline at end of file
+    return embedding
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Read-only HTTP service for map queries.
+
+Everything a query needs is loaded once at startup: the catalog's embedding
+store and map layout are memory-mapped, and the similarity index is read
+into memory and warmed. Requests then only do in-memory lookups and small
+matrix multiplies. Collections are read from the catalog the first time
+they're asked for and cached.
+
+Endpoints:
+    GET  /health                            Sizes of the loaded data.
+    GET  /tracks/<id>/neighbours?k=10       Nearest tracks to one track.
+    POST /neighbours                        {"ids": [...], "k": 10}: nearest tracks to many tracks in one call.
+    GET  /collections/<name>/coordinates    Map positions of a playlist's (or likes') tracks.
+    POST /similarity                        {"names": [...], "method": "mean"}: pairwise similarity of collections, e.g. two users' likes.
+    GET  /tiles/manifest                    Bounds and settings of the map tiles (see tiles.py).
+    GET  /tiles/<z>/<x>/<y>                 One binary map tile.
+
+Responses are compact JSON. Add ?format=npy (or send Accept: application/x-npy)
+to get a NumPy structured array instead, which clients load without parsing.
+
+Usage:
+    python src/interface/map_service.py --port 8890
+
+That runs Werkzeug's development server, which handles every request on a
+new thread of one process and can't hold a low p99 under load. In
+production, host the app with a WSGI server through the create_app factory:
+
+    gunicorn -w 4 --threads 2 -b 127.0.0.1:8890 'src.interface.map_service:create_app()'
+
+Each worker process loads the similarity index into its own memory (the
+store and layout memory maps share the page cache), so start with one
+worker per CPU core and lower it if the index doesn't fit that many times.
+Don't use --preload: the catalog's SQLite connection can't be shared
+across the forked workers. Check the deployment with
+`python benchmarks/load_test.py --url http://127.0.0.1:8890`.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import io
+import json
+import logging
+import threading
+import numpy as np
+from flask import Flask, Response, request # type: ignore
+from src.map.similarity_index import SIMILARITY_INDEX_PATH, load_index
+from src.map.projection import LAYOUT_PATH
+from src.map.tiles import TILES_PATH, TileSet, encode_tile, POINT_DTYPE, AGGREGATE_DTYPE
+from src.map.user_similarity import SongSets, similarity_frame
+from src.storage.embedding_store import EmbeddingStore
+from src.utils.config import config
+
+MAP_SERVICE_PORT = config['settings']['map_service_port']
+
+MAX_K = 100
+MAX_BATCH = 1000
+NPY_MIMETYPE = 'application/x-npy'
+SIMILARITY_METHODS = ('mean', 'max', 'covariance', 'mmd', 'chamfer')
+
+class MapService:
+    def __init__(self, store: EmbeddingStore, index, layout: EmbeddingStore | None = None, catalog=None, tiles: TileSet | None = None):
+        """
+        Holds the data the service answers queries from.
+
+        Args:
+            store (EmbeddingStore): The catalog's embedding store.
+            index (ExactIndex | IVFIndex): The similarity index over the store.
+            layout (EmbeddingStore | None): The map layout (see update_catalog_layout).
+            catalog (TrackCatalog | None): The catalog, for collection lookups.
+            tiles (TileSet | None): The map tiles.
+        """
+        self.store = store
+        self.index = index
+        self.layout = layout
+        self.catalog = catalog
+        self.tiles = tiles
+        self._collections = {}
+        self._catalog_lock = threading.Lock()
+        # Build the index's lazy search structures now rather than on (and
+        # racing between) the first requests
+        if len(index):
+            index.search(np.asarray(store.matrix()[:1], dtype=np.float32), 1)
+
+    @classmethod
+    def from_catalog(cls, catalog=None, index_path: str = SIMILARITY_INDEX_PATH, layout_prefix: str = LAYOUT_PATH, tiles_path: str = TILES_PATH) -> 'MapService':
+        """
+        Loads the service's data from the catalog's persisted files.
+
+        Args:
+            catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+            index_path (str): The similarity index path.
+            layout_prefix (str): The map layout prefix.
+            tiles_path (str): The map tiles directory.
+
+        Returns:
+            MapService: The loaded service.
+        """
+        if catalog is None:
+            from src.storage.track_catalog import TrackCatalog
+            catalog = TrackCatalog()
+        if not os.path.exists(index_path):
+            print(f"{Style.BRIGHT}[MapService]: {Style.NORMAL}{Fore.RED}Error: No similarity index at {index_path}. Embed some tracks first.{Style.RESET_ALL}")
+            sys.exit(1)
+        layout = EmbeddingStore(layout_prefix, dim=2) if os.path.exists(layout_prefix + '.npy') else None
+        if layout is None:
+            print(f"{Style.BRIGHT}[MapService]: {Style.NORMAL}{Fore.YELLOW}Warning: No map layout at {layout_prefix}.npy; coordinate queries will fail.{Style.RESET_ALL}")
+        tiles = TileSet(tiles_path) if os.path.exists(os.path.join(tiles_path, 'manifest.json')) else None
+        return cls(catalog.store, load_index(index_path), layout, catalog, tiles)
+
+    def neighbours(self, track_ids: list, k: int = 10) -> tuple[dict, list]:
+        """
+        Finds the nearest tracks to each given track, with one index search
+        for the whole batch.
+
+        Args:
+            track_ids (list): The query track IDs.
+            k (int): Neighbours per track, not counting the track itself.
+
+        Returns:
+            tuple: A tuple containing:
+                - dict: A list of (track ID, score) tuples per found query ID.
+                - list: The query IDs that have no embedding.
+        """
+        vectors, found = self.store.get(track_ids)
+        found_ids = [t for t, ok in zip(track_ids, found) if ok]
+        missing = [t for t, ok in zip(track_ids, found) if not ok]
+        results = self.index.search(vectors, k + 1) if len(found_ids) else []
+        return {
+            track_id: [(other, score) for other, score in hits if other != track_id][:k]
+            for track_id, hits in zip(found_ids, results)
+        }, missing
+
+    def collection_track_ids(self, name: str) -> list:
+        """
+        The track IDs of a catalog collection, cached after the first read.
+        """
+        if name not in self._collections:
+            if self.catalog is None:
+                return []
+            with self._catalog_lock:
+                self._collections[name] = self.catalog.collection_track_ids(name)
+        return self._collections[name]
+
+    def coordinates(self, name: str) -> tuple[list, np.ndarray]:
+        """
+        Looks up the map positions of a collection's tracks.
+
+        Args:
+            name (str): The collection name.
+
+        Returns:
+            tuple: The placed track IDs and their [n, 2] positions.
+        """
+        if self.layout is None:
+            raise LookupError("The map layout hasn't been built yet.")
+        positions, found = self.layout.get(self.collection_track_ids(name))
+        track_ids = [t for t, ok in zip(self.collection_track_ids(name), found) if ok]
+        return track_ids, positions
+
+    def similarity(self, names: list, method: str = 'mean'):
+        """
+        Compares collections pairwise (see user_similarity.similarity_frame).
+
+        Args:
+            names (list): The collection names.
+            method (str): One of SIMILARITY_METHODS.
+
+        Returns:
+            pd.DataFrame: The [N, N] matrix indexed by the collections that have embedded tracks.
+        """
+        sets, kept = [], []
+        for name in names:
+            matrix, _ = self.store.get(self.collection_track_ids(name))
+            if len(matrix):
+                sets.append(np.asarray(matrix, dtype=np.float32))
+                kept.append(name)
+        if not sets:
+            raise LookupError("None of the collections have embedded tracks.")
+        return similarity_frame(SongSets.from_list(sets, kept), method)
+
+def _wants_npy() -> bool:
+    return request.args.get('format') == 'npy' or request.accept_mimetypes.best == NPY_MIMETYPE
+
+def _json(payload, status: int = 200) -> Response:
+    return Response(json.dumps(payload, separators=(',', ':')), status, mimetype='application/json')
+
+def _npy(array: np.ndarray) -> Response:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return Response(buffer.getvalue(), mimetype=NPY_MIMETYPE)
+
+def _error(message: str, status: int) -> Response:
+    return _json({'error': message}, status)
+
+def _id_dtype(track_ids: list) -> str:
+    return f"S{max((len(t) for t in track_ids), default=1)}"
+
+def _parse_k(value) -> int:
+    k = int(value)
+    if not 0 < k <= MAX_K:
+        raise ValueError(f"k must be between 1 and {MAX_K}.")
+    return k
+
+def _neighbour_response(results: dict, missing: list) -> Response:
+    if _wants_npy():
+        rows = [(query, other, score) for query, hits in results.items() for other, score in hits]
+        ids = [r[0] for r in rows] + [r[1] for r in rows]
+        dtype = [('query', _id_dtype(ids)), ('id', _id_dtype(ids)), ('score', '<f4')]
+        return _npy(np.array(rows, dtype=dtype))
+    return _json({
+        'neighbours': {query: [[other, round(score, 5)] for other, score in hits] for query, hits in results.items()},
+        'missing': missing
+    })
+
+def create_app(service: MapService | None = None) -> Flask:
+    """
+    Builds the Flask app serving a MapService. Also the factory WSGI servers
+    call, once per worker: gunicorn 'src.interface.map_service:create_app()'.
+
+    Args:
+        service (MapService | None): A loaded service. Defaults to loading the catalog's.
+
+    Returns:
+        Flask: The app, ready for app.run or any WSGI server.
+    """
+    service = service or MapService.from_catalog()
+    app = Flask(__name__)
+
+    @app.get('/health')
+    def health():
+        return _json({
+            'tracks': len(service.store),
+            'indexed': len(service.index),
+            'placed': len(service.layout) if service.layout is not None else 0
+        })
+
+    @app.get('/tracks/<track_id>/neighbours')
+    def track_neighbours(track_id: str):
+        try:
+            k = _parse_k(request.args.get('k', 10))
+        except ValueError as e:
+            return _error(str(e), 400)
+        results, missing = service.neighbours([track_id], k)
+        if missing:
+            return _error(f"Track {track_id} has no embedding.", 404)
+        return _neighbour_response(results, missing)
+
+    @app.post('/neighbours')
+    def batch_neighbours():
+        body = request.get_json(silent=True) or {}
+        track_ids = body.get('ids')
+        if not isinstance(track_ids, list) or not track_ids:
+            return _error("Expected a JSON body with a non-empty 'ids' list.", 400)
+        if len(track_ids) > MAX_BATCH:
+            return _error(f"At most {MAX_BATCH} IDs per request.", 400)
+        try:
+            k = _parse_k(body.get('k', 10))
+        except ValueError as e:
+            return _error(str(e), 400)
+        return _neighbour_response(*service.neighbours([str(t) for t in track_ids], k))
+
+    @app.get('/collections/<name>/coordinates')
+    def collection_coordinates(name: str):
+        try:
+            track_ids, positions = service.coordinates(name)
+        except LookupError as e:
+            return _error(str(e), 503)
+        if not track_ids:
+            return _error(f"Collection '{name}' has no placed tracks.", 404)
+        if _wants_npy():
+            array = np.empty(len(track_ids), dtype=[('id', _id_dtype(track_ids)), ('x', '<f4'), ('y', '<f4')])
+            array['id'], array['x'], array['y'] = track_ids, positions[:, 0], positions[:, 1]
+            return _npy(array)
+        positions = np.round(positions.astype(np.float64), 4)
+        return _json({'ids': track_ids, 'x': positions[:, 0].tolist(), 'y': positions[:, 1].tolist()})
+
+    @app.post('/similarity')
+    def collection_similarity():
+        body = request.get_json(silent=True) or {}
+        names, method = body.get('names'), body.get('method', 'mean')
+        if not isinstance(names, list) or len(names) < 2:
+            return _error("Expected a JSON body with a 'names' list of at least two collections.", 400)
+        if method not in SIMILARITY_METHODS:
+            return _error(f"Unknown method '{method}', expected one of {SIMILARITY_METHODS}.", 400)
+        try:
+            frame = service.similarity([str(n) for n in names], method)
+        except LookupError as e:
+            return _error(str(e), 404)
+        if _wants_npy():
+            return _npy(frame.to_numpy(dtype=np.float32))
+        return _json({'names': list(frame.index), 'method': method, 'matrix': np.round(frame.to_numpy(), 5).tolist()})
+
+    @app.get('/tiles/manifest')
+    def tiles_manifest():
+        if service.tiles is None:
+            return _error("The map tiles haven't been built yet.", 503)
+        return _json(service.tiles.manifest)
+
+    @app.get('/tiles/<int:zoom>/<int:x>/<int:y>')
+    def tile(zoom: int, x: int, y: int):
+        if service.tiles is None:
+            return _error("The map tiles haven't been built yet.", 503)
+        try:
+            with open(service.tiles.tile_path(zoom, x, y), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Tiles with nothing in them aren't written
+            data = encode_tile(np.empty(0, dtype=POINT_DTYPE), np.empty(0, dtype=AGGREGATE_DTYPE))
+        return Response(data, mimetype='application/octet-stream')
+
+    return app
+
+def serve(host: str = '127.0.0.1', port: int = MAP_SERVICE_PORT, service: MapService | None = None):
+    """
+    Loads the catalog's map data and serves it with Werkzeug's development
+    server until interrupted. For production, see the module docstring.
+
+    Args:
+        host (str): The interface to bind.
+        port (int): The port to listen on.
+        service (MapService | None): A loaded service. Defaults to loading the catalog's.
+    """
+    service = service or MapService.from_catalog()
+    # Werkzeug logs every request, which costs more than most queries do
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    print(f"{Style.BRIGHT}[MapService]: {Style.NORMAL}{Fore.GREEN}Serving {len(service.index)} indexed tracks on http://{host}:{port}.{Style.RESET_ALL}")
+    create_app(service).run(host=host, port=port, threaded=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve read-only map queries over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to bind.")
+    parser.add_argument('--port', type=int, default=MAP_SERVICE_PORT, help="Port to listen on.")
+    args = parser.parse_args()
+    serve(args.host, args.port)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Per-user index of a Spotify account's playlists.
+
+Resolving a playlist name used to page through every playlist the user owns
+on every call. The index keeps the name, ID, URI and track count of each
+playlist in memory and on disk (one JSON file per user), so name lookups are
+answered without any network calls until the index expires or is refreshed.
+The ID of the last user to log in is kept next to the index files, so a new
+process can open the right index without asking Spotify who is logged in.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import bisect
+import json
+import time
+from typing import Callable
+from src.utils.config import config
+debug = config['settings']['debug']
+
+INDEX_PATH  = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['playlist_index_path'][1:])
+DEFAULT_TTL = config['settings']['playlist_index_ttl']
+LAST_USER_FILE = '.last_user'  # No .json suffix, so it can't collide with a user's index
+
+def recorded_user(index_dir: str = INDEX_PATH) -> str | None:
+    """
+    Returns the user ID recorded by record_user, or None if there is none.
+    """
+    try:
+        with open(os.path.join(index_dir, LAST_USER_FILE), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def record_user(user_id: str, index_dir: str = INDEX_PATH):
+    """
+    Records the logged-in user's ID next to the index files.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, LAST_USER_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(user_id)
+    os.replace(path + '.tmp', path)
+
+class PlaylistIndex:
+    def __init__(self, user_id: str, fetch_playlists: Callable[[], list], ttl: float = DEFAULT_TTL, index_dir: str = INDEX_PATH):
+        """
+        Initializes a new instance of the PlaylistIndex class.
+
+        The on-disk index is loaded immediately if it exists. Nothing is
+        fetched from Spotify until a lookup finds the index missing or stale.
+
+        Args:
+            user_id (str): The Spotify user ID the index belongs to.
+            fetch_playlists (Callable): Returns the user's playlists as a list of
+                dictionaries with 'name', 'id', 'uri', 'owner' and 'tracks' keys
+                (see SpotifyAPI.get_playlists).
+            ttl (float): Seconds before the index is considered stale.
+            index_dir (str): Directory holding the per-user index files.
+        """
+        self.user_id = user_id
+        self.ttl = ttl
+        self._fetch_playlists = fetch_playlists
+        self._path = os.path.join(index_dir, f"{user_id}.json")
+        self._playlists = []
+        self._by_name = {}
+        self._sorted_names = []
+        self._built_at = 0.0
+        self._load()
+
+    def _build(self, playlists: list, built_at: float):
+        """
+        Builds the lookup structures from a list of playlists.
+
+        Args:
+            playlists (list): The playlists to index.
+            built_at (float): Unix time at which the playlists were fetched.
+        """
+        self._playlists = playlists
+        self._by_name = {}
+        for playlist in playlists:
+            # First playlist wins on duplicate names, same as the old linear scan
+            self._by_name.setdefault(playlist['name'].lower(), playlist)
+        self._sorted_names = sorted(self._by_name)
+        self._built_at = built_at
+
+    def _load(self):
+        """
+        Loads the index from disk if present.
+        """
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+            self._build(data['playlists'], data['built_at'])
+        except (json.JSONDecodeError, KeyError):
+            print(f"{Style.BRIGHT}[PlaylistIndex]: {Style.NORMAL}{Fore.YELLOW}Ignoring corrupt index at {self._path}.{Style.RESET_ALL}")
+
+    def _save(self):
+        """
+        Writes the index to disk atomically.
+        """
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'user_id': self.user_id, 'built_at': self._built_at, 'playlists': self._playlists}, f)
+        os.replace(tmp_path, self._path)
+
+    def is_stale(self) -> bool:
+        """
+        Checks whether the index has expired.
+
+        Returns:
+            bool: True if the index was never built or is older than the TTL.
+        """
+        return self._built_at == 0.0 or time.time() - self._built_at > self.ttl
+
+    def refresh(self):
+        """
+        Re-fetches the user's playlists from Spotify and rewrites the index.
+        """
+        self._build(self._fetch_playlists(), time.time())
+        self._save()
+        if debug:
+            print(f"{Style.BRIGHT}[PlaylistIndex]: {Style.NORMAL}{Fore.CYAN}Indexed {len(self._playlists)} playlists for {self.user_id}.{Style.RESET_ALL}")
+
+    def invalidate(self):
+        """
+        Marks the index as stale so the next lookup refreshes it.
+        """
+        self._built_at = 0.0
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            self.refresh()
+
+    def playlists(self) -> list:
+        """
+        Returns all indexed playlists.
+
+        Returns:
+            list: The indexed playlist dictionaries.
+        """
+        self._ensure_fresh()
+        return list(self._playlists)
+
+    def lookup(self, name: str) -> dict | None:
+        """
+        Finds a playlist by its name, ignoring case.
+
+        Args:
+            name (str): The name of the playlist.
+
+        Returns:
+            dict | None: The playlist dictionary, or None if not found.
+        """
+        self._ensure_fresh()
+        return self._by_name.get(name.lower())
+
+    def lookup_prefix(self, prefix: str) -> list:
+        """
+        Finds every playlist whose name starts with the given prefix, ignoring case.
+
+        Args:
+            prefix (str): The start of the playlist name.
+
+        Returns:
+            list: Matching playlist dictionaries, sorted by name.
+        """
+        self._ensure_fresh()
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        matches = []
+        for name in self._sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(self._by_name[name])
+        return matches
+
+    def get_uri(self, name: str) -> str | None:
+        """
+        Retrieves the URI of a playlist by its name, ignoring case.
+
+        Args:
+            name (str): The name of the playlist.
+
+        Returns:
+            str | None: The URI of the playlist, or None if not found.
+        """
+        playlist = self.lookup(name)
+        return playlist['uri'] if playlist is not None else None
@@ -3,6 +3,10 @@
 """
 This handles SpotifyAPI authentication and requests.
 Saves the access token to a file for future use.
+
+Nothing is set up at import: the shared `sp` client is created on first
+use, and spotipy and the Flask app for the OAuth callback are only loaded
+when they're needed.
 """
 
 import os, sys
@@ -13,47 +17,66 @@ project_root = Path(__file__).resolve().parent.parent.parent
 sys.path.insert(0, str(project_root))
 
 from colorama import Fore, Style
-import requests
-import spotipy
 from datetime import datetime
 import time
 import webbrowser
 import threading
-from flask import Flask, redirect, request # type: ignore
 import json
-from spotipy.oauth2 import SpotifyOAuth
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
-with open(CONFIG_PATH, 'r') as f:
-    config = json.load(f)
+from src.interface.playlist_index import PlaylistIndex, recorded_user, record_user
+from src.utils import metrics
+from src.utils.config import config
 debug = config['settings']['debug']
 
-if not debug:
-    SPOTIPY_CLIENT_ID = config['spotify']['client_id']
-    SPOTIPY_CLIENT_SECRET = config['spotify']['client_secret']
-else:
-    SPOTIPY_CLIENT_ID = input("Client ID: ")
-    SPOTIPY_CLIENT_SECRET = input("Client Secret: ")
-
 SPOTIPY_REDIRECT_URI = config['spotify']['redirect_uri']
 SPOTIPY_REDIRECT_PORT= SPOTIPY_REDIRECT_URI.split(':')[-1].split('/')[0]
 CACHE_PATH = config['paths']['spotify_token_path']
 CACHE_PATH = os.path.join(os.path.dirname(__file__), '..', '..') + CACHE_PATH
+PLAYLISTS_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['playlists_path'][1:])
+LIKES_PATH = os.path.join(PLAYLISTS_PATH, 'likes.tsv')
+
+# Flask app that handles the authentication callback, created by authenticate()
+app = None
+
+def _credentials() -> tuple[str, str]:
+    """
+    Returns the Spotify client ID and secret, asking for them in debug mode.
+    """
+    if not debug:
+        return config['spotify']['client_id'], config['spotify']['client_secret']
+    return input("Client ID: "), input("Client Secret: ")
+
+def _spotify_client(auth_manager):
+    """
+    Creates a spotipy client whose every HTTP request is timed (see metrics.py),
+    labelled by method and endpoint (e.g. GET playlists).
+    """
+    import spotipy
 
-# Using Flask to handle the authentication
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
+    class InstrumentedSpotify(spotipy.Spotify):
+        def _internal_call(self, method, url, payload, params):
+            if not metrics.is_enabled():
+                return super()._internal_call(method, url, payload, params)
+            endpoint = url.split('?')[0].replace(self.prefix, '').split('/')[0]
+            with metrics.span('spotify_request', method=method, endpoint=endpoint):
+                return super()._internal_call(method, url, payload, params)
+
+    return InstrumentedSpotify(auth_manager=auth_manager)
 
 class SpotifyAPI:
     def __init__(self):
         """
         Initializes a new instance of the SpotifyAPI class.
         """
+        from spotipy.oauth2 import SpotifyOAuth
+
+        client_id, client_secret = _credentials()
         self.scope = "user-library-read playlist-read-private playlist-read-collaborative"
         self.sp = None
+        self.user_id = None
+        self.playlist_index = None
         self.auth_manager=SpotifyOAuth(
-            client_id=SPOTIPY_CLIENT_ID, 
-            client_secret=SPOTIPY_CLIENT_SECRET, 
+            client_id=client_id, 
+            client_secret=client_secret, 
             redirect_uri=SPOTIPY_REDIRECT_URI, 
             scope=self.scope,
             show_dialog=True,
@@ -62,6 +85,13 @@ class SpotifyAPI:
         print(f"{Style.BRIGHT}[SpotifyAPI]: {Style.NORMAL}{Fore.GREEN}SpotifyAPI initialized.{Style.RESET_ALL}")
 
     def authenticate(self):
+        global app
+        from flask import Flask, redirect, request # type: ignore
+
+        # Using Flask to handle the authentication
+        app = Flask(__name__)
+        app.secret_key = os.urandom(24)
+
         @app.route('/')
         def index():
             return redirect(self.auth_manager.get_authorize_url())
@@ -70,7 +100,10 @@ class SpotifyAPI:
         def callback():
             if request.args.get('code'):
                 self.auth_manager.get_access_token(request.args['code'], as_dict=False)
-                self.sp = spotipy.Spotify(auth_manager=self.auth_manager)
+                self.sp = _spotify_client(self.auth_manager)
+                # A different account may have logged in, so the recorded user is replaced
+                self.user_id = self.sp.current_user()['id']
+                record_user(self.user_id)
                 return "Authentication successful. You can now close this tab."
             else:
                 return "Error: Authentication failed."
@@ -79,6 +112,20 @@ class SpotifyAPI:
         webbrowser.open_new_tab(f'{SPOTIPY_REDIRECT_URI.split("/callback")[0]}')
         threading.Thread(target=lambda: app.run(port=SPOTIPY_REDIRECT_PORT)).start()
 
+    def authenticate_cached(self) -> bool:
+        """
+        Authenticates from the cached token without a browser, for unattended runs.
+        The token is refreshed automatically when it expires.
+
+        Returns:
+            bool: Whether a usable token was cached.
+        """
+        token = self.auth_manager.validate_token(self.auth_manager.cache_handler.get_cached_token())
+        if token is None:
+            return False
+        self.sp = _spotify_client(self.auth_manager)
+        return True
+
     def refresh_token(self):
         """
         Refreshes the access token if it has expired.
@@ -98,30 +145,85 @@ class SpotifyAPI:
             playlist_url (str): URL of the Spotify playlist.
             tsv_path (str): Path to the TSV file.
         """
+        import spotipy
+
         if not playlist_uri.startswith('spotify:playlist:'):
-            playlist_uri = self.get_playlist_uri_for_name(playlist_uri)
+            playlist_name = playlist_uri
+            playlist_uri = self.get_playlist_uri_for_name(playlist_name)
             if playlist_uri == None:
-                print(f"{Style.BRIGHT}[SpotifyAPI]: {Style.NORMAL}{Fore.RED}Error: Could not find playlist with name '{playlist_uri_or_name}'.{Style.RESET_ALL}")
+                print(f"{Style.BRIGHT}[SpotifyAPI]: {Style.NORMAL}{Fore.RED}Error: Could not find playlist with name '{playlist_name}'.{Style.RESET_ALL}")
                 sys.exit(1)
-        playlist_id = playlist_uri.split(':')[-1]
         try:
-            playlist = self.sp.playlist(playlist_id)
+            tracks = self.get_playlist_tracks(playlist_uri)
         except spotipy.SpotifyException:
             print(f"{Style.BRIGHT}[SpotifyAPI]: {Style.NORMAL}{Fore.RED}Error: Could not load playlist. Please check the playlist URL.{Style.RESET_ALL}")
             sys.exit(1)
 
+        metrics = self.get_spotify_metrics_batch([track['track_id'] for track in tracks])
+        self.write_tracks_to_tsv(tracks, metrics, tsv_path)
+        print(f"{Style.BRIGHT}{Fore.GREEN}[SpotifyAPI]: Playlist saved to {tsv_path.replace(os.path.join(os.path.dirname(__file__), '..', '..'), '')}{Style.RESET_ALL}\n")
+
+    def get_playlist_tracks(self, playlist_uri: str) -> list:
+        """
+        Retrieves every track in a playlist, following pagination.
+
+        Local files and removed tracks (which have no Spotify ID) are skipped.
+
+        Args:
+            playlist_uri (str): URI of the Spotify playlist.
+
+        Returns:
+            list: A list of dictionaries with the same keys as get_user_saved_tracks,
+                minus 'added_at'.
+        """
+        playlist_id = playlist_uri.split(':')[-1]
+        results = self.sp.playlist_items(playlist_id, additional_types=('track',))
+        tracks = []
+        while results:
+            for item in results['items']:
+                track = item['track']
+                if track is None or track['id'] is None:
+                    continue
+                tracks.append({
+                    'track_id': track['id'],
+                    'track_name': track['name'],
+                    'track_url': track['external_urls']['spotify'],
+                    'artists': ', '.join([artist['name'] for artist in track['artists']]),
+                    'album': track['album']['name'],
+                    'song_length': track['duration_ms'] / 1000
+                })
+            if results['next']:
+                results = self.sp.next(results)
+            else:
+                results = None
+        return tracks
+
+    def get_playlist_name(self, playlist_uri: str) -> str:
+        """
+        Retrieves the name of a playlist.
+
+        Args:
+            playlist_uri (str): URI of the Spotify playlist.
+
+        Returns:
+            str: The playlist name.
+        """
+        return self.sp.playlist(playlist_uri.split(':')[-1], fields='name')['name']
+
+    @staticmethod
+    def write_tracks_to_tsv(tracks: list, metrics: dict, tsv_path: str):
+        """
+        Writes tracks to a playlist TSV file.
+
+        Args:
+            tracks (list): Track dictionaries as returned by get_playlist_tracks.
+            metrics (dict): Spotify metrics keyed by track ID.
+            tsv_path (str): Path to the TSV file.
+        """
         with open(tsv_path, 'w') as f:
             f.write("Track ID\tTrack Name\tTrack Url\tArtists\tAlbum\tSong Length (s)\tMetrics\n")
-            for track in playlist['tracks']['items']:
-                track_id = track['track']['id']
-                metrics = self.get_spotify_metrics(track_id)
-                track_name = track['track']['name']
-                track_url = track['track']['external_urls']['spotify']
-                artists = ', '.join([artist['name'] for artist in track['track']['artists']])
-                album = track['track']['album']['name']
-                song_length = track['track']['duration_ms'] / 1000
-                f.write(f"{track_id}\t{track_name}\t{track_url}\t{artists}\t{album}\t{song_length}\t{json.dumps(metrics)}\n")
-        print(f"{Style.BRIGHT}{Fore.GREEN}[SpotifyAPI]: Playlist saved to {tsv_path.replace(os.path.join(os.path.dirname(__file__), '..', '..'), '')}{Style.RESET_ALL}\n")
+            for track in tracks:
+                f.write(f"{track['track_id']}\t{track['track_name']}\t{track['track_url']}\t{track['artists']}\t{track['album']}\t{track['song_length']}\t{json.dumps(metrics.get(track['track_id']))}\n")
 
     def get_playlists(self):
         """
@@ -151,21 +253,48 @@ class SpotifyAPI:
                 playlists = None
         return playlist_dict
 
-    def get_playlist_uri_for_name(self, playlist_name):
+    def get_playlist_index(self) -> PlaylistIndex:
+        """
+        Retrieves the playlist index for the authenticated user, creating it on
+        first use. The user ID is read from the one recorded at login, and only
+        fetched from Spotify if none was recorded.
+
+        Returns:
+            PlaylistIndex: The user's playlist index.
+        """
+        if self.playlist_index is None:
+            if self.user_id is None:
+                self.user_id = recorded_user()
+            if self.user_id is None:
+                self.user_id = self.sp.current_user()['id']
+                record_user(self.user_id)
+            self.playlist_index = PlaylistIndex(self.user_id, self.get_playlists)
+        return self.playlist_index
+
+    def get_playlist_uri_for_name(self, playlist_name: str, refresh: bool = False):
         """
         Retrieves the URI of a playlist by its name.
 
+        Names are resolved through the cached playlist index, so no requests
+        are made unless the index is stale. A miss triggers one refresh in case
+        the playlist was created since the index was built.
+
         Args:
             playlist_name (str): The name of the playlist to retrieve.
+            refresh (bool): Whether to force a refresh of the index first.
 
         Returns:
             str: The URI of the playlist.
         """
-        playlists = self.get_playlists()
-        for playlist in playlists:
-            if playlist['name'].lower() == playlist_name.lower():
-                return playlist['uri']
-        return None
+        index = self.get_playlist_index()
+        just_built = refresh or index.is_stale()
+        if refresh:
+            index.refresh()
+        uri = index.get_uri(playlist_name)
+        if uri is None and not just_built:
+            index.refresh()
+            uri = index.get_uri(playlist_name)
+        return uri
 
     def get_song_analysis(self, song_id: str) -> dict:
         """
@@ -191,6 +320,32 @@ class SpotifyAPI:
             dict: A dictionary containing metrics for the song.
         """
         metrics = self.sp.audio_features(song_id)[0]
+        return self._strip_metrics(metrics)
+
+    def get_spotify_metrics_batch(self, song_ids: list) -> dict:
+        """
+        Retrieves metrics for many songs, 100 per request.
+
+        Args:
+            song_ids (list): The IDs of the songs.
+
+        Returns:
+            dict: Metrics keyed by song ID. Songs Spotify has no features for are omitted.
+        """
+        metrics = {}
+        for i in range(0, len(song_ids), 100):
+            for features in self.sp.audio_features(song_ids[i:i + 100]):
+                if features is None:
+                    continue
+                song_id = features['id']
+                metrics[song_id] = self._strip_metrics(features)
+        return metrics
+
+    @staticmethod
+    def _strip_metrics(metrics: dict) -> dict:
+        """
+        Removes the non-metric fields from an audio features response.
+        """
         metrics.pop('type')
         metrics.pop('id')
         metrics.pop('uri')
@@ -235,21 +390,44 @@ class SpotifyAPI:
         print(f"{Style.NORMAL}[SpotifyAPI]: {Style.DIM}{Fore.LIGHTGREEN_EX}Retrieved {len(tracks)} liked songs.{Style.RESET_ALL}")
         return tracks
     
-    def load_likes_to_tsv(self):
+    def load_likes_to_tsv(self, tsv_path: str = LIKES_PATH):
         """
         Loads the user's liked songs to a TSV file.
+
+        Args:
+            tsv_path (str): Path to the TSV file.
         """
         print(f"{Style.BRIGHT}[SpotifyAPI]: {Style.NORMAL}{Fore.CYAN}Saving liked songs to TSV...{Style.RESET_ALL}", end='\r', flush=True)
-        tsv_path = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'playlists', 'likes.tsv')
         tracks = self.get_user_saved_tracks()
+        metrics = self.get_spotify_metrics_batch([track['track_id'] for track in tracks])
         with open(tsv_path, 'w') as f:
             f.write("Track ID\tTrack Name\tTrack Url\tArtists\tAlbum\tSong Length (s)\tMetrics\tAdded At\n")
             for track in tracks:
-                f.write(f"{track['track_id']}\t{track['track_name']}\t{track['track_url']}\t{track['artists']}\t{track['album']}\t{track['song_length']}\t{json.dumps(self.get_spotify_metrics(track['track_id']))}\t{track['added_at']}\n")
+                f.write(f"{track['track_id']}\t{track['track_name']}\t{track['track_url']}\t{track['artists']}\t{track['album']}\t{track['song_length']}\t{json.dumps(metrics.get(track['track_id']))}\t{track['added_at']}\n")
         print(f"\n{Style.BRIGHT}{Fore.GREEN}[SpotifyAPI]: Liked songs saved to {tsv_path.replace(os.path.join(os.path.dirname(__file__), '..', '..'), '')}{Style.RESET_ALL}\n")
 
+class LazySpotifyAPI:
+    """
+    Stands in for the shared SpotifyAPI instance, creating it on first use.
+    """
+    def __init__(self):
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get(self) -> SpotifyAPI:
+        with self._lock:
+            if self._instance is None:
+                object.__setattr__(self, '_instance', SpotifyAPI())
+        return self._instance
+
+    def __getattr__(self, name: str):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self._get(), name, value)
+
 # Singleton instance of the SpotifyAPI class (for global use)
-sp = SpotifyAPI()
+sp = LazySpotifyAPI()
 #sp.refresh_token()
 #sp.authenticate()
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Query-by-audio: embeds a local clip and finds the nearest catalog tracks.
+
+The VGGish session, similarity index and map projection are loaded once and
+kept warm, so a query reads the clip, runs it through the model and searches
+the index. Each query records how long every stage took:
+    - read: decoding only the requested window of the file
+    - resample: converting to 16 kHz mono
+    - features: log-mel examples (vggish_input.waveform_to_examples)
+    - inference, postprocess, pool: VGGish, PCA and max-pooling (see vgg_maxpool.py)
+    - search: the similarity index
+    - place: the clip's position on the map (see projection.py)
+
+Resampling uses resampy's 'kaiser_fast' filter by default. 'kaiser_best',
+which the catalog embeddings use, costs about 200 ms for a 10 s clip on its
+own. 'kaiser_fast' rolls off earlier near 8 kHz, which only affects the top
+two or three of the 64 mel bands.
+
+Usage:
+    python src/map/audio_query.py clip.wav --offset 30 --duration 10 --k 10
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import argparse
+import time
+import numpy as np
+from src.map.similarity_index import SIMILARITY_INDEX_PATH, load_index
+from src.map.projection import PROJECTION_PATH, MapProjection
+from src.utils.config import config
+
+QUERY_BUDGET_MS = config['settings']['audio_query_budget_ms']
+CLIP_SECONDS = 10.0
+STAGES = ('read', 'resample', 'features', 'inference', 'postprocess', 'pool', 'search', 'place')
+
+def read_clip(path: str, offset_s: float = 0.0, duration_s: float | None = CLIP_SECONDS) -> tuple[np.ndarray, int]:
+    """
+    Reads a window of an audio file as mono float samples, without decoding the rest.
+
+    Args:
+        path (str): The audio file.
+        offset_s (float): Where the window starts, in seconds.
+        duration_s (float | None): Length of the window in seconds; None for the rest of the file.
+
+    Returns:
+        tuple: A tuple containing:
+            - np.ndarray: The samples in [-1.0, 1.0].
+            - int: The file's sample rate.
+    """
+    import soundfile as sf
+
+    sample_rate = sf.info(path).samplerate
+    start = int(offset_s * sample_rate)
+    frames = -1 if duration_s is None else int(duration_s * sample_rate)
+    samples, sample_rate = sf.read(path, start=start, frames=frames, dtype='float32', always_2d=True)
+    return samples.mean(axis=1), sample_rate
+
+class AudioQuery:
+    def __init__(self, index, engine=None, projection: MapProjection | None = None, catalog=None, resample_filter: str = 'kaiser_fast'):
+        """
+        Holds the warm state that clips are queried against.
+
+        Args:
+            index (ExactIndex | IVFIndex): The similarity index over the catalog.
+            engine (EmbeddingEngine | None): The VGGish engine. Defaults to the process-wide one.
+            projection (MapProjection | None): The map projection, for the clip's position.
+            catalog (TrackCatalog | None): The catalog, for track names.
+            resample_filter (str): The resampy filter used to convert clips to 16 kHz.
+        """
+        if engine is None:
+            from src.embeddings.vgg_maxpool import get_engine
+            engine = get_engine()
+        self.index = index
+        self.engine = engine
+        self.projection = projection
+        self.catalog = catalog
+        self.resample_filter = resample_filter
+        # Build the index's lazy search structures, and have resampy compile
+        # its resampling kernel, now rather than on the first query
+        if len(index):
+            index.search(np.zeros((1, index.dim), dtype=np.float32), 1)
+        import resampy
+        resampy.resample(np.zeros(4410, dtype=np.float32), 44100, 16000, filter=resample_filter)
+
+    @classmethod
+    def from_catalog(cls, catalog=None, index_path: str = SIMILARITY_INDEX_PATH, projection_path: str = PROJECTION_PATH) -> 'AudioQuery':
+        """
+        Loads the catalog's persisted index and projection, and the embedding engine.
+
+        Args:
+            catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+            index_path (str): The similarity index path.
+            projection_path (str): The map projection path.
+
+        Returns:
+            AudioQuery: The loaded query state.
+        """
+        if catalog is None:
+            from src.storage.track_catalog import TrackCatalog
+            catalog = TrackCatalog()
+        if not os.path.exists(index_path):
+            print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{Fore.RED}Error: No similarity index at {index_path}. Embed some tracks first.{Style.RESET_ALL}")
+            sys.exit(1)
+        projection = MapProjection.load(projection_path) if os.path.exists(projection_path) else None
+        if projection is None:
+            print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{Fore.YELLOW}Warning: No map projection at {projection_path}; clips won't be placed on the map.{Style.RESET_ALL}")
+        return cls(load_index(index_path), projection=projection, catalog=catalog)
+
+    def embed_samples(self, samples: np.ndarray, sample_rate: int, timings: dict | None = None) -> np.ndarray:
+        """
+        Embeds mono samples at any sample rate.
+
+        Args:
+            samples (np.ndarray): The samples in [-1.0, 1.0].
+            sample_rate (int): Their sample rate.
+            timings (dict | None): If given, the seconds spent per stage are stored in it.
+
+        Returns:
+            np.ndarray: The float32 embedding [128 floats].
+        """
+        import resampy
+        from src.embeddings.vgg import vggish_input, vggish_params
+
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        if sample_rate != vggish_params.SAMPLE_RATE:
+            samples = resampy.resample(samples, sample_rate, vggish_params.SAMPLE_RATE, filter=self.resample_filter)
+        resampled = time.perf_counter()
+        examples = vggish_input.waveform_to_examples(samples, vggish_params.SAMPLE_RATE)
+        timings['resample'] = resampled - start
+        timings['features'] = time.perf_counter() - resampled
+        return self.engine.embed_examples(examples, timings).astype(np.float32)
+
+    def query(self, path: str, k: int = 10, offset_s: float = 0.0, duration_s: float | None = CLIP_SECONDS) -> dict:
+        """
+        Finds the catalog tracks nearest to a clip of an audio file.
+
+        Args:
+            path (str): The audio file.
+            k (int): Number of neighbours.
+            offset_s (float): Where the clip starts, in seconds.
+            duration_s (float | None): Length of the clip in seconds; None for the whole file.
+
+        Returns:
+            dict: The result, with keys:
+                - 'embedding': The clip's embedding.
+                - 'neighbours': A list of (track ID, score) tuples, closest first.
+                - 'position': The clip's (x, y) map position, or None without a projection.
+                - 'timings': Seconds spent per stage (see STAGES), and the 'total'.
+
+        Raises:
+            ValueError: If the clip is shorter than one 0.96 s example.
+        """
+        timings = {}
+        start = time.perf_counter()
+        samples, sample_rate = read_clip(path, offset_s, duration_s)
+        timings['read'] = time.perf_counter() - start
+
+        embedding = self.embed_samples(samples, sample_rate, timings)
+
+        search_start = time.perf_counter()
+        [neighbours] = self.index.search(embedding[np.newaxis], k) if len(self.index) else [[]]
+        place_start = time.perf_counter()
+        position = tuple(float(v) for v in self.projection.place(embedding)[0]) if self.projection is not None else None
+        end = time.perf_counter()
+
+        timings['search'] = place_start - search_start
+        timings['place'] = end - place_start
+        timings['total'] = end - start
+        return {'embedding': embedding, 'neighbours': neighbours, 'position': position, 'timings': timings}
+
+def print_result(result: dict, names: dict | None = None, budget_ms: float = QUERY_BUDGET_MS):
+    """
+    Prints a query's neighbours, map position and per-stage timings.
+
+    Args:
+        result (dict): A result from AudioQuery.query.
+        names (dict | None): (name, artists) tuples keyed by track ID, from TrackCatalog.track_names.
+        budget_ms (float): The latency target the total is checked against.
+    """
+    names = names or {}
+    for rank, (track_id, score) in enumerate(result['neighbours'], start=1):
+        name, artists = names.get(track_id, (track_id, ''))
+        label = f"{name} by {artists}" if artists else name
+        print(f"    {rank:>3}. {score:.3f}  {label}")
+    if result['position'] is not None:
+        x, y = result['position']
+        print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{Fore.CYAN}Map position: ({x:.2f}, {y:.2f}){Style.RESET_ALL}")
+
+    timings = result['timings']
+    breakdown = ', '.join(f"{stage} {timings[stage] * 1000:.1f}" for stage in STAGES if stage in timings)
+    total_ms = timings['total'] * 1000
+    color = Fore.GREEN if total_ms <= budget_ms else Fore.RED
+    print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{color}Answered in {total_ms:.1f} ms against a {budget_ms:g} ms budget{Style.RESET_ALL} {Style.DIM}({breakdown} ms){Style.RESET_ALL}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the catalog tracks nearest to a local audio clip.")
+    parser.add_argument('path', help="The audio file.")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours to return.")
+    parser.add_argument('--offset', type=float, default=0.0, help="Where the clip starts, in seconds.")
+    parser.add_argument('--duration', type=float, default=CLIP_SECONDS, help="Length of the clip in seconds; 0 for the whole file.")
+    parser.add_argument('--repeat', type=int, default=1, help="Run the query this many times, to see warm timings.")
+    parser.add_argument('--exact-resample', action='store_true', help="Resample with 'kaiser_best', as catalog embeddings are.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{Fore.RED}Error: File not found.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    audio_query = AudioQuery.from_catalog()
+    if args.exact_resample:
+        audio_query.resample_filter = 'kaiser_best'
+    for _ in range(args.repeat):
+        try:
+            result = audio_query.query(args.path, args.k, args.offset, args.duration or None)
+        except ValueError as e:
+            print(f"{Style.BRIGHT}[AudioQuery]: {Style.NORMAL}{Fore.RED}Error: {e}{Style.RESET_ALL}")
+            sys.exit(1)
+        print_result(result, audio_query.catalog.track_names([t for t, _ in result['neighbours']]))
@@ -5,6 +5,11 @@ Created on Tue Sep 24 2024
 
 Downloads and processes the baseline data for the map.
 This data is gathered from official Spotify genere-based playlists.
+
+All configured playlists are fetched concurrently and merged into a single
+deduplicated track table, with genre/playlist memberships kept in a separate
+many-to-many table. Each unique track is downloaded and embedded once, no
+matter how many editorial playlists it appears in.
 """
 
 import os, sys
@@ -16,47 +21,154 @@ sys.path.insert(0, str(project_root))
 
 from colorama import Fore, Style
 import asyncio
-import json
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from src.interface.spotify_utils import sp
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
-with open(CONFIG_PATH, 'r') as f:
-    config = json.load(f)
+from src.utils.config import config
 
 debug = config['settings']['debug']
+SPOTIFY_CONCURRENCY = config['settings']['spotify_concurrency']
 PLAYLISTS_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['playlists_path'][1:], 'spotify_official_genre_mappings')
 BASELINE_DATA = config['baseline_data']
 
-def load_playlists() -> list:
+MEMBERSHIP_COLUMNS = ['Track ID', 'Genre', 'Playlist', 'Playlist URI']
+
+async def fetch_baseline_playlists(concurrency: int = SPOTIFY_CONCURRENCY) -> dict:
     """
-    Loads the playlists from the config file to the correct .tsv files.
+    Fetches the tracks of every configured baseline playlist concurrently.
+
+    Spotipy is synchronous, so each playlist is fetched in the default
+    executor, with at most `concurrency` requests in flight.
+
+    Args:
+        concurrency (int): Maximum number of playlists fetched at once.
+
+    Returns:
+        dict: Track lists keyed by (genre, playlist name, playlist URI).
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(genre: str, playlist: dict):
+        async with semaphore:
+            tracks = await loop.run_in_executor(None, sp.get_playlist_tracks, playlist['uri'])
+        if debug:
+            print(f"{Style.BRIGHT}[BaselineData]: {Style.NORMAL}{Fore.MAGENTA}Fetched {len(tracks)} tracks from {playlist['name']} ({genre}).{Style.RESET_ALL}")
+        return (genre, playlist['name'], playlist['uri']), tracks
+
+    tasks = [
+        fetch(genre_dict['genre'], playlist)
+        for genre_dict in BASELINE_DATA
+        for playlist in genre_dict['playlists']
+    ]
+    return dict(await asyncio.gather(*tasks))
+
+def deduplicate_tracks(playlist_tracks: dict) -> tuple[list, pd.DataFrame]:
+    """
+    Merges playlist track lists into unique tracks plus a membership table.
+
+    Args:
+        playlist_tracks (dict): Track lists keyed by (genre, playlist name, playlist URI).
 
     Returns:
-        list: A list of the paths to the .tsv files.
+        tuple: A tuple containing:
+            - list: Unique track dictionaries, in first-seen order.
+            - pd.DataFrame: One row per (track, genre, playlist) membership.
+    """
+    unique_tracks = {}
+    memberships = []
+    for (genre, name, uri), tracks in playlist_tracks.items():
+        for track in tracks:
+            unique_tracks.setdefault(track['track_id'], track)
+            memberships.append((track['track_id'], genre, name, uri))
+
+    membership_df = pd.DataFrame(memberships, columns=MEMBERSHIP_COLUMNS).drop_duplicates()
+    return list(unique_tracks.values()), membership_df
+
+async def build_baseline_dataset(concurrency: int = SPOTIFY_CONCURRENCY) -> list:
+    """
+    Fetches the configured playlists and writes a deduplicated baseline dataset.
+
+    Writes two files under the genre mappings directory:
+        - tracks_<date>.tsv: one row per unique track, in the playlist TSV format.
+        - memberships_<date>.tsv: the genre/playlist memberships of each track.
+
+    Args:
+        concurrency (int): Maximum number of playlists fetched at once.
+
+    Returns:
+        list: The paths to the tracks and memberships .tsv files.
     """
     date_str = datetime.now().strftime("%d_%m_%Y")
+    os.makedirs(PLAYLISTS_PATH, exist_ok=True)
 
-    for genre_dict in BASELINE_DATA:
-        genre = genre_dict['genre']
-        playlists = genre_dict['playlists']
-        if not os.path.exists(os.path.join(PLAYLISTS_PATH, genre)):
-            os.makedirs(os.path.join(PLAYLISTS_PATH, genre))
+    playlist_tracks = await fetch_baseline_playlists(concurrency)
+    tracks, membership_df = deduplicate_tracks(playlist_tracks)
 
-        for name, uri, p in playlists.items():
+    # Metrics are fetched once per unique track rather than per appearance
+    metrics = await asyncio.to_thread(sp.get_spotify_metrics_batch, [track['track_id'] for track in tracks])
 
-            path = os.path.join(PLAYLISTS_PATH, {genre}, f"{p}_{date_str}.tsv")
-            sp.load_playlist_to_tsv(uri, path)
+    tracks_path = os.path.join(PLAYLISTS_PATH, f"tracks_{date_str}.tsv")
+    memberships_path = os.path.join(PLAYLISTS_PATH, f"memberships_{date_str}.tsv")
+    sp.write_tracks_to_tsv(tracks, metrics, tracks_path)
+    membership_df.to_csv(memberships_path, sep='\t', index=False)
 
-            print(f"{Style.BRIGHT}[BaselineData]: {Style.NORMAL}{Fore.MAGENTA}Loaded playlist {name} to {p}.{Style.RESET_ALL}")
+    print(f"{Style.BRIGHT}[BaselineData]: {Style.NORMAL}{Fore.MAGENTA}Loaded {len(playlist_tracks)} playlists: {len(membership_df)} appearances of {len(tracks)} unique tracks.{Style.RESET_ALL}")
+    return [tracks_path, memberships_path]
 
-if __name__ == "__main__":
-    load_playlists()
-    
+def load_playlists() -> list:
+    """
+    Loads the playlists from the config file to the correct .tsv files.
 
+    Returns:
+        list: The paths to the tracks and memberships .tsv files.
+    """
+    return asyncio.run(build_baseline_dataset())
 
+async def ingest_baseline(concurrency: int = SPOTIFY_CONCURRENCY, **embed_options) -> list:
+    """
+    Loads the baseline playlists, downloads and embeds each unique track once,
+    then rebuilds the genre model and refits the map projection on the
+    baseline corpus.
 
+    Args:
+        concurrency (int): Maximum number of playlists fetched at once.
+        **embed_options: Passed on to download_and_embed_tsv (e.g. download_concurrency, update_index).
 
+    Returns:
+        list: The paths to the tracks and memberships .tsv files.
+    """
+    # Deferred so that loading playlists alone doesn't pull in TensorFlow
+    from src.embeddings.generator import download_and_embed_tsv
+    from src.map.genre_model import build_genre_model
+    from src.map.projection import fit_baseline_projection
+
+    tracks_path, memberships_path = await build_baseline_dataset(concurrency)
+    await download_and_embed_tsv(tracks_path, collection='baseline', kind='baseline', **embed_options)
+    build_genre_model(tracks_path, memberships_path)
+    fit_baseline_projection()
+    return [tracks_path, memberships_path]
+
+def genre_track_indices(tracks_df: pd.DataFrame, membership_df: pd.DataFrame) -> dict:
+    """
+    Maps each genre to the rows of the unique track table that belong to it.
+
+    The genre reference map is built from these indices, so every track's
+    embedding is loaded once and shared by all of its genres.
 
+    Args:
+        tracks_df (pd.DataFrame): The deduplicated track table.
+        membership_df (pd.DataFrame): The genre/playlist membership table.
 
+    Returns:
+        dict: Sorted np.ndarray of row indices into tracks_df, keyed by genre.
+    """
+    row_of = pd.Series(np.arange(len(tracks_df)), index=tracks_df['Track ID'].values)
+    genre_rows = membership_df[['Track ID', 'Genre']].drop_duplicates()
+    genre_rows = genre_rows[genre_rows['Track ID'].isin(row_of.index)]
+    genre_rows = genre_rows.assign(row=row_of.loc[genre_rows['Track ID']].values)
+    return {genre: np.sort(group['row'].values) for genre, group in genre_rows.groupby('Genre')}
+
+if __name__ == "__main__":
+    asyncio.run(ingest_baseline())
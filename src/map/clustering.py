@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Streaming mini-batch k-means over the embedding corpus, for map regions and
+labels.
+
+Centroids are seeded with k-means++ on the first batch and then refined one
+mini-batch at a time (Sculley, 2010): every centroid moves towards the mean
+of the batch points assigned to it, with a step size that shrinks as it
+absorbs more points. The corpus is read from the memory-mapped embedding
+store in shuffled, contiguous batches, so only one batch is in memory at a
+time. New embeddings are folded in incrementally as the generator produces
+them. The centroids, per-centroid counts and the cluster of every store row
+are saved together.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import numpy as np
+from src.utils.config import config
+
+CLUSTERS_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['clusters_path'][1:])
+CLUSTER_COUNT = config['settings']['cluster_count']
+
+BATCH_SIZE = 4096
+ASSIGN_BLOCK = 32768  # Rows assigned per matrix multiply
+
+def kmeans_plus_plus(points: np.ndarray, k: int, seed: int = 0) -> np.ndarray:
+    """
+    Picks k initial centroids with k-means++: each new centroid is drawn with
+    probability proportional to its squared distance from the nearest one
+    already picked.
+
+    Args:
+        points (np.ndarray): Matrix of shape [n, dim], n >= k.
+        k (int): Number of centroids.
+        seed (int): Random seed.
+
+    Returns:
+        np.ndarray: The [k, dim] centroids.
+    """
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.float32)
+    sq_norms = np.einsum('ij,ij->i', points, points)
+    centroids = np.empty((k, points.shape[1]), dtype=np.float32)
+    centroids[0] = points[rng.integers(len(points))]
+    closest = np.maximum(sq_norms - 2.0 * (points @ centroids[0]) + centroids[0] @ centroids[0], 0.0)
+    for i in range(1, k):
+        total = closest.sum()
+        chosen = rng.choice(len(points), p=closest / total) if total > 0 else rng.integers(len(points))
+        centroids[i] = points[chosen]
+        distances = np.maximum(sq_norms - 2.0 * (points @ centroids[i]) + centroids[i] @ centroids[i], 0.0)
+        np.minimum(closest, distances, out=closest)
+    return centroids
+
+class MiniBatchKMeans:
+    def __init__(self, k: int = CLUSTER_COUNT, batch_size: int = BATCH_SIZE, seed: int = 0):
+        """
+        Initializes an unfitted model.
+
+        Args:
+            k (int): Number of clusters.
+            batch_size (int): Vectors per mini-batch.
+            seed (int): Random seed.
+        """
+        self.k = k
+        self.batch_size = batch_size
+        self.seed = seed
+        self.centroids = None
+        self.counts = np.zeros(k, dtype=np.int64)
+        self.assignments = np.empty(0, dtype=np.int32)  # Cluster of each store row
+        self.synced_rows = 0  # Store rows folded into the centroids
+        self._pending = []    # Vectors seen before there were enough to seed from
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.centroids is not None
+
+    def assign(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest centroid of each vector, in blocks.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim].
+
+        Returns:
+            tuple: The cluster labels and squared distances to the centroid.
+        """
+        c_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        labels = np.empty(len(vectors), dtype=np.int32)
+        sq_dist = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), ASSIGN_BLOCK):
+            block = np.asarray(vectors[start:start + ASSIGN_BLOCK], dtype=np.float32)
+            # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2; the ||x||^2 term doesn't change the argmin
+            scores = block @ self.centroids.T
+            scores *= -2.0
+            scores += c_sq_norms
+            best = scores.argmin(axis=1)
+            labels[start:start + len(block)] = best
+            sq_dist[start:start + len(block)] = np.maximum(
+                scores[np.arange(len(block)), best] + np.einsum('ij,ij->i', block, block), 0.0
+            )
+        return labels, sq_dist
+
+    def partial_fit(self, batch: np.ndarray) -> 'MiniBatchKMeans':
+        """
+        Updates the centroids with one mini-batch.
+
+        Args:
+            batch (np.ndarray): Matrix of shape [n, dim].
+
+        Returns:
+            MiniBatchKMeans: self.
+        """
+        batch = np.asarray(batch, dtype=np.float32)
+        if not self.is_fitted:
+            self._pending.append(batch)
+            seen = sum(len(b) for b in self._pending)
+            if seen < self.k:
+                return self
+            batch = np.concatenate(self._pending)
+            self._pending = []
+            self.centroids = kmeans_plus_plus(batch, self.k, self.seed)
+        if len(batch) == 0:
+            return self
+
+        labels, _ = self.assign(batch)
+        batch_counts = np.bincount(labels, minlength=self.k)
+        hit = batch_counts > 0
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(batch_counts)[:-1]])[hit]
+        batch_sums = np.add.reduceat(batch[order], starts, axis=0)
+
+        # Each centroid moves to the running mean of every point it has absorbed
+        self.counts[hit] += batch_counts[hit]
+        rate = (batch_counts[hit] / self.counts[hit])[:, np.newaxis].astype(np.float32)
+        batch_means = batch_sums / batch_counts[hit][:, np.newaxis]
+        self.centroids[hit] += rate * (batch_means - self.centroids[hit])
+        return self
+
+    def fit(self, matrix: np.ndarray, epochs: int = 1) -> 'MiniBatchKMeans':
+        """
+        Fits the centroids on a (possibly memory-mapped) matrix, reading it in
+        shuffled contiguous batches, and assigns every row. Rows are labelled
+        -1 while there are fewer than k of them to seed from.
+
+        Args:
+            matrix (np.ndarray): Matrix of shape [n, dim].
+            epochs (int): Passes over the matrix.
+
+        Returns:
+            MiniBatchKMeans: self.
+        """
+        rng = np.random.default_rng(self.seed)
+        starts = np.arange(0, len(matrix), self.batch_size)
+        for _ in range(epochs):
+            for start in rng.permutation(starts):
+                self.partial_fit(matrix[start:start + self.batch_size])
+        # With fewer rows than clusters the model stays unseeded, and the
+        # rows wait in _pending until enough arrive through update()
+        if self.is_fitted:
+            self.assignments, _ = self.assign(matrix)
+        else:
+            self.assignments = np.full(len(matrix), -1, dtype=np.int32)
+        self.synced_rows = len(matrix)
+        return self
+
+    def update(self, new_vectors: np.ndarray) -> np.ndarray:
+        """
+        Folds newly appended store rows into the centroids and assigns them.
+
+        Earlier rows keep the assignments they were given; call fit again to
+        reassign everything against the current centroids.
+
+        Args:
+            new_vectors (np.ndarray): The rows appended since the last update, in order.
+
+        Returns:
+            np.ndarray: The labels of the new rows.
+        """
+        for start in range(0, len(new_vectors), self.batch_size):
+            self.partial_fit(new_vectors[start:start + self.batch_size])
+        if self.is_fitted:
+            labels, _ = self.assign(new_vectors)
+        else:
+            labels = np.full(len(new_vectors), -1, dtype=np.int32)
+        self.assignments = np.concatenate([self.assignments, labels])
+        self.synced_rows += len(new_vectors)
+        return labels
+
+    def inertia(self, matrix: np.ndarray) -> float:
+        """
+        Mean squared distance of the rows of a matrix to their nearest centroid.
+        """
+        _, sq_dist = self.assign(matrix)
+        return float(sq_dist.mean())
+
+    def save(self, path: str = CLUSTERS_PATH):
+        """
+        Saves the model to a .npz file, replacing any existing one by renaming it into place.
+
+        Args:
+            path (str): The destination path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        state = {
+            'settings': np.array([self.k, self.batch_size, self.seed, self.synced_rows]),
+            'counts': self.counts,
+            'assignments': self.assignments
+        }
+        if self.is_fitted:
+            state['centroids'] = self.centroids
+        if self._pending:
+            state['pending'] = np.concatenate(self._pending)
+        np.savez(tmp_path, **state)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = CLUSTERS_PATH) -> 'MiniBatchKMeans':
+        """
+        Loads a model saved with save().
+
+        Args:
+            path (str): The .npz path.
+
+        Returns:
+            MiniBatchKMeans: The model.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            k, batch_size, seed, synced_rows = (int(v) for v in data['settings'])
+            model = cls(k, batch_size, seed)
+            model.synced_rows = synced_rows
+            model.counts = data['counts']
+            model.assignments = data['assignments']
+            if 'centroids' in data.files:
+                model.centroids = data['centroids']
+            if 'pending' in data.files:
+                model._pending = [data['pending']]
+        return model
+
+def update_catalog_clusters(store, path: str = CLUSTERS_PATH, k: int = CLUSTER_COUNT) -> MiniBatchKMeans:
+    """
+    Brings the persisted catalog clustering up to date with an embedding store.
+
+    The first call fits on the whole store; later calls only fold in the rows
+    appended since. If the store was rewritten, it starts over.
+
+    Args:
+        store (EmbeddingStore): The catalog's embedding store.
+        path (str): The clustering path.
+        k (int): Number of clusters for a new model.
+
+    Returns:
+        MiniBatchKMeans: The updated model.
+    """
+    model = MiniBatchKMeans.load(path) if os.path.exists(path) else None
+    if len(store) == 0:
+        return model or MiniBatchKMeans(k)
+    if model is None or len(store) < model.synced_rows:
+        model = MiniBatchKMeans(k).fit(store.matrix())
+    elif len(store) > model.synced_rows:
+        model.update(store.matrix()[model.synced_rows:])
+        # Rows that arrived before the model could be seeded
+        unassigned = np.flatnonzero(model.assignments < 0)
+        if model.is_fitted and len(unassigned):
+            model.assignments[unassigned], _ = model.assign(store.matrix()[unassigned])
+    else:
+        return model
+    model.save(path)
+
+    if model.is_fitted:
+        print(f"{Style.BRIGHT}[Clustering]: {Style.NORMAL}{Fore.GREEN}Clustered {model.synced_rows} embeddings into {model.k} clusters.{Style.RESET_ALL}")
+    else:
+        print(f"{Style.BRIGHT}[Clustering]: {Style.NORMAL}{Fore.YELLOW}Waiting for {model.k} embeddings before clustering ({model.synced_rows} so far).{Style.RESET_ALL}")
+    return model
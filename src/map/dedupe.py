@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Near-duplicate track detection with locality-sensitive hashing.
+
+The same recording often appears under several Spotify IDs (remasters,
+compilations), and the downloader sometimes picks the same upload for
+different tracks. Such tracks have almost identical embeddings and
+durations.
+
+Each embedding gets one signature per hash table: the signs of its dot
+products with a set of random hyperplanes, packed into an integer. Two
+vectors at angle theta agree on each bit with probability 1 - theta / pi,
+so near-duplicates share a signature in at least one table with high
+probability, while unrelated tracks rarely do. Only tracks sharing a
+signature are compared, and only if their durations are close, so the
+whole catalog is checked in roughly linear rather than quadratic time.
+
+find_duplicates produces a batch report over many tracks. DuplicateIndex
+answers one track at a time, so a new embedding can be checked before it
+is stored.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import numpy as np
+from src.utils.config import config
+
+DUPLICATES_REPORT_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['duplicates_report_path'][1:])
+DUPLICATE_COSINE = config['settings']['duplicate_cosine']
+DUPLICATE_DURATION_S = config['settings']['duplicate_duration_s']
+
+REPORT_COLUMNS = ['Track ID', 'Duplicate Of', 'Cosine', 'Duration Diff (s)']
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class HyperplaneLSH:
+    def __init__(self, dim: int = 128, n_bits: int = 24, n_tables: int = 24, seed: int = 0):
+        """
+        Initializes random hyperplane hash functions.
+
+        With the defaults, a pair at cosine 0.97 shares a signature in at
+        least one table with probability ~0.99, and a pair at cosine 0.9 with
+        probability ~0.6.
+
+        Args:
+            dim (int): Embedding dimension.
+            n_bits (int): Hyperplanes per table (at most 64).
+            n_tables (int): Number of tables.
+            seed (int): Random seed.
+        """
+        if not 0 < n_bits <= 64:
+            raise ValueError("n_bits must be between 1 and 64.")
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((dim, n_tables * n_bits)).astype(np.float32)
+        self._bit_values = np.left_shift(np.uint64(1), np.arange(n_bits, dtype=np.uint64))
+
+    def signatures(self, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """
+        Hashes vectors into one signature per table.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim].
+            block_size (int): Rows hashed per matrix multiply.
+
+        Returns:
+            np.ndarray: uint64 signatures of shape [n, n_tables].
+        """
+        vectors = np.atleast_2d(vectors)
+        out = np.empty((len(vectors), self.n_tables), dtype=np.uint64)
+        for start in range(0, len(vectors), block_size):
+            bits = (np.asarray(vectors[start:start + block_size], dtype=np.float32) @ self.planes) > 0
+            bits = bits.reshape(len(bits), self.n_tables, self.n_bits).astype(np.uint64)
+            out[start:start + len(bits)] = (bits * self._bit_values).sum(axis=2, dtype=np.uint64)
+        return out
+
+def _verify(a: np.ndarray, b: np.ndarray, unit: np.ndarray, durations: np.ndarray, min_cosine: float, max_duration_diff: float) -> tuple:
+    """
+    Keeps the candidate pairs that are really near-duplicates.
+    """
+    cosines = np.empty(len(a), dtype=np.float32)
+    for start in range(0, len(a), 1 << 20):
+        stop = start + (1 << 20)
+        cosines[start:stop] = np.einsum('ij,ij->i', unit[a[start:stop]], unit[b[start:stop]])
+    duration_diff = np.abs(durations[a] - durations[b])
+    # Unknown durations don't rule a pair out
+    keep = (cosines >= min_cosine) & ~(duration_diff > max_duration_diff)
+    return a[keep], b[keep], cosines[keep], duration_diff[keep]
+
+def find_duplicates(ids: list, embeddings: np.ndarray, durations: np.ndarray | None = None, min_cosine: float = DUPLICATE_COSINE, max_duration_diff: float = DUPLICATE_DURATION_S, window: int = 32, lsh: HyperplaneLSH | None = None) -> 'pd.DataFrame':
+    """
+    Finds near-duplicate pairs among many tracks.
+
+    In each table, tracks are sorted by (signature, duration) and each is
+    compared with the next `window` tracks of its bucket whose durations are
+    within max_duration_diff. Huge buckets (e.g. many silent tracks) thus
+    cost O(n * window) rather than O(n^2).
+
+    Args:
+        ids (list): The track IDs.
+        embeddings (np.ndarray): Matrix of shape [n, dim], row-aligned with ids.
+        durations (np.ndarray | None): Durations in seconds; NaN or None when unknown.
+        min_cosine (float): Minimum cosine similarity of a duplicate pair.
+        max_duration_diff (float): Maximum duration difference of a duplicate pair, in seconds.
+        window (int): Neighbours compared per track within a bucket.
+        lsh (HyperplaneLSH | None): The hash functions. Defaults to HyperplaneLSH(dim).
+
+    Returns:
+        pd.DataFrame: One row per duplicate, with REPORT_COLUMNS. Each
+            duplicate points at the canonical (first-listed) track of its group.
+    """
+    import pandas as pd
+
+    n = len(ids)
+    unit = _normalize(embeddings)
+    durations = np.full(n, np.nan) if durations is None else np.asarray(durations, dtype=np.float64)
+    # Unknown durations sort last and aren't filtered by the window check
+    sort_durations = np.where(np.isnan(durations), np.inf, durations)
+    lsh = lsh or HyperplaneLSH(unit.shape[1])
+    signatures = lsh.signatures(unit)
+
+    candidates = []
+    for t in range(lsh.n_tables):
+        order = np.lexsort((sort_durations, signatures[:, t]))
+        sig, dur = signatures[order, t], sort_durations[order]
+        for d in range(1, min(window, n - 1) + 1):
+            same = sig[:-d] == sig[d:]
+            # No pair shares a bucket at this distance, so none does further on. Pairs too
+            # far apart in duration don't end the scan: an unknown duration can follow them.
+            if not same.any():
+                break
+            with np.errstate(invalid='ignore'):  # inf - inf between two unknown durations
+                close = (dur[d:] - dur[:-d] <= max_duration_diff) | np.isinf(dur[d:])
+            mask = same & close
+            a, b = order[:-d][mask], order[d:][mask]
+            candidates.append(np.minimum(a, b).astype(np.int64) * n + np.maximum(a, b))
+    if not candidates:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+
+    pairs = np.unique(np.concatenate(candidates))
+    a, b, cosines, duration_diff = _verify(pairs // n, pairs % n, unit, durations, min_cosine, max_duration_diff)
+    canonical = _group_canonicals(n, a, b)
+
+    # Report each duplicate against its group's canonical track, with the
+    # strongest direct evidence for it
+    duplicate = np.concatenate([a, b])
+    partner = np.concatenate([b, a])
+    evidence = np.concatenate([cosines, cosines])
+    diffs = np.concatenate([duration_diff, duration_diff])
+    is_dup = canonical[duplicate] != duplicate
+    report = pd.DataFrame({
+        'row': duplicate[is_dup],
+        'Cosine': evidence[is_dup],
+        'Duration Diff (s)': diffs[is_dup],
+        'partner': partner[is_dup]
+    }).sort_values('Cosine', ascending=False).drop_duplicates('row')
+    report.insert(0, 'Duplicate Of', [ids[i] for i in canonical[report['row'].values]])
+    report.insert(0, 'Track ID', [ids[i] for i in report['row'].values])
+    return report[REPORT_COLUMNS].sort_values(['Duplicate Of', 'Track ID']).reset_index(drop=True)
+
+def _group_canonicals(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Groups rows connected by duplicate pairs (union-find) and returns the
+    lowest row of each row's group.
+    """
+    parent = np.arange(n)
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for x, y in zip(a.tolist(), b.tolist()):
+        rx, ry = find(x), find(y)
+        if rx != ry:
+            parent[max(rx, ry)] = min(rx, ry)
+    return np.array([find(x) for x in range(n)])
+
+class DuplicateIndex:
+    def __init__(self, lsh: HyperplaneLSH | None = None, min_cosine: float = DUPLICATE_COSINE, max_duration_diff: float = DUPLICATE_DURATION_S, rebuild_every: int = 4096):
+        """
+        Initializes an empty online duplicate index.
+
+        Signatures are kept sorted per table and looked up with binary search;
+        newly added tracks wait in a small buffer that is merged in every
+        rebuild_every additions.
+
+        Args:
+            lsh (HyperplaneLSH | None): The hash functions. Defaults to HyperplaneLSH().
+            min_cosine (float): Minimum cosine similarity of a duplicate.
+            max_duration_diff (float): Maximum duration difference of a duplicate, in seconds.
+            rebuild_every (int): Buffered additions before the sorted tables are rebuilt.
+        """
+        self.lsh = lsh or HyperplaneLSH()
+        self.min_cosine = min_cosine
+        self.max_duration_diff = max_duration_diff
+        self.rebuild_every = rebuild_every
+        self.ids = []
+        self._unit = np.empty((0, self.lsh.planes.shape[0]), dtype=np.float32)
+        self._durations = np.empty(0, dtype=np.float64)
+        self._signatures = np.empty((0, self.lsh.n_tables), dtype=np.uint64)
+        self._sorted = None  # Per table: (sorted signatures, rows)
+        self._buffer = []    # (id, unit vector, duration, signatures) not yet merged
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self._buffer)
+
+    def add_many(self, ids: list, embeddings: np.ndarray, durations: np.ndarray | None = None):
+        """
+        Adds many tracks at once and rebuilds the sorted tables.
+
+        Args:
+            ids (list): The track IDs.
+            embeddings (np.ndarray): Matrix of shape [n, dim].
+            durations (np.ndarray | None): Durations in seconds; NaN when unknown.
+        """
+        self._merge_buffer()
+        unit = _normalize(embeddings)
+        durations = np.full(len(ids), np.nan) if durations is None else np.asarray(durations, dtype=np.float64)
+        self.ids.extend(str(t) for t in ids)
+        self._unit = np.concatenate([self._unit, unit])
+        self._durations = np.concatenate([self._durations, durations])
+        self._signatures = np.concatenate([self._signatures, self.lsh.signatures(unit)])
+        self._rebuild()
+
+    def add(self, track_id: str, embedding: np.ndarray, duration: float | None = None):
+        """
+        Adds one track.
+
+        Args:
+            track_id (str): The track ID.
+            embedding (np.ndarray): The embedding.
+            duration (float | None): The duration in seconds.
+        """
+        unit = _normalize(np.atleast_2d(embedding))
+        self._buffer.append((str(track_id), unit[0], np.nan if duration is None else float(duration), self.lsh.signatures(unit)[0]))
+        if len(self._buffer) >= self.rebuild_every:
+            self._merge_buffer()
+            self._rebuild()
+
+    def _merge_buffer(self):
+        if not self._buffer:
+            return
+        ids, unit, durations, signatures = zip(*self._buffer)
+        self.ids.extend(ids)
+        self._unit = np.concatenate([self._unit, np.stack(unit)])
+        self._durations = np.concatenate([self._durations, durations])
+        self._signatures = np.concatenate([self._signatures, np.stack(signatures)])
+        self._buffer = []
+
+    def _rebuild(self):
+        self._sorted = []
+        for t in range(self.lsh.n_tables):
+            order = np.argsort(self._signatures[:, t], kind='stable')
+            self._sorted.append((self._signatures[order, t], order))
+
+    def query(self, embedding: np.ndarray, duration: float | None = None, exclude: str | None = None) -> tuple[str, float] | None:
+        """
+        Finds the closest indexed near-duplicate of a track.
+
+        Args:
+            embedding (np.ndarray): The track's embedding.
+            duration (float | None): The track's duration in seconds.
+            exclude (str | None): A track ID to ignore, e.g. the track itself.
+
+        Returns:
+            tuple | None: (track ID, cosine) of the best duplicate, or None.
+        """
+        unit = _normalize(np.atleast_2d(embedding))[0]
+        signature = self.lsh.signatures(unit[np.newaxis])[0]
+        duration = np.nan if duration is None else float(duration)
+
+        # Candidates from the sorted tables
+        rows = []
+        if self._sorted is not None:
+            for t, (sig, order) in enumerate(self._sorted):
+                lo, hi = np.searchsorted(sig, signature[t], 'left'), np.searchsorted(sig, signature[t], 'right')
+                rows.append(order[lo:hi])
+        best = None
+        if rows:
+            rows = np.unique(np.concatenate(rows))
+            if len(rows):
+                diffs = np.abs(self._durations[rows] - duration)
+                cosines = self._unit[rows] @ unit
+                ok = (cosines >= self.min_cosine) & ~(diffs > self.max_duration_diff)
+                for row in rows[ok][np.argsort(-cosines[ok])]:
+                    if self.ids[row] != exclude:
+                        best = (self.ids[row], float(self._unit[row] @ unit))
+                        break
+
+        # And from the buffer of recent additions
+        for track_id, other, other_duration, other_signature in self._buffer:
+            if track_id == exclude or not np.any(other_signature == signature):
+                continue
+            if abs(other_duration - duration) > self.max_duration_diff:
+                continue
+            cosine = float(other @ unit)
+            if cosine >= self.min_cosine and (best is None or cosine > best[1]):
+                best = (track_id, cosine)
+        return best
+
+    @classmethod
+    def from_catalog(cls, catalog, **kwargs) -> 'DuplicateIndex':
+        """
+        Builds an index of every embedded catalog track that isn't itself a duplicate.
+
+        Args:
+            catalog (TrackCatalog): The catalog.
+            **kwargs: Passed to DuplicateIndex.
+
+        Returns:
+            DuplicateIndex: The index.
+        """
+        index = cls(**kwargs)
+        ids, durations, rows = catalog.embedded_tracks()
+        duplicates = catalog.duplicate_track_ids()
+        keep = np.array([t not in duplicates for t in ids], dtype=bool)
+        if keep.any():
+            matrix = catalog.store.matrix()
+            index.add_many([t for t, k in zip(ids, keep) if k], matrix[rows[keep]], durations[keep])
+        return index
+
+def dedupe_catalog(catalog=None, report_path: str = DUPLICATES_REPORT_PATH, mark: bool = True) -> 'pd.DataFrame':
+    """
+    Finds every near-duplicate in the catalog, writes a report and
+    (optionally) marks the duplicates in the catalog. The canonical track of
+    each group is the one embedded first.
+
+    Args:
+        catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+        report_path (str): Where to write the TSV report.
+        mark (bool): Record each duplicate's canonical track in the catalog.
+
+    Returns:
+        pd.DataFrame: The report (see find_duplicates).
+    """
+    if catalog is None:
+        from src.storage.track_catalog import TrackCatalog
+        catalog = TrackCatalog()
+
+    ids, durations, rows = catalog.embedded_tracks()
+    report = find_duplicates(ids, catalog.store.matrix()[rows], durations)
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    report.to_csv(report_path, sep='\t', index=False)
+    if mark:
+        # Tracks that are no longer duplicates lose their mark
+        marks = dict.fromkeys(catalog.duplicate_track_ids())
+        marks.update(zip(report['Track ID'], report['Duplicate Of']))
+        catalog.set_duplicates(marks)
+
+    print(f"{Style.BRIGHT}[Dedupe]: {Style.NORMAL}{Fore.GREEN}Found {len(report)} near-duplicates among {len(ids)} tracks; report written to {report_path}.{Style.RESET_ALL}")
+    return report
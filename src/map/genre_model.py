@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Genre classifier built from the labelled baseline playlists.
+
+Each genre is summarized by a small mixture of centroids of its baseline
+tracks' (L2-normalized) embeddings. All centroids are stacked into one
+matrix, so scoring any batch of tracks is a single matrix multiply followed
+by a per-genre log-sum-exp over its mixture components and a softmax across
+genres. The softmax temperature is fitted on the baseline labels.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import glob
+import numpy as np
+import pandas as pd
+from src.utils.config import config
+
+GENRE_MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['genre_model_path'][1:])
+PLAYLISTS_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['playlists_path'][1:], 'spotify_official_genre_mappings')
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _logsumexp(x: np.ndarray, axis: int) -> np.ndarray:
+    peak = x.max(axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0.0)
+    return np.squeeze(peak, axis=axis) + np.log(np.exp(x - peak).sum(axis=axis))
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = x - x.max(axis=1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=1, keepdims=True)
+
+def _genre_mixture(vectors: np.ndarray, n_components: int, iterations: int = 20, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Fits up to n_components spherical k-means centroids to one genre's tracks.
+
+    Args:
+        vectors (np.ndarray): Normalized embeddings of the genre's tracks.
+        n_components (int): Maximum number of centroids.
+
+    Returns:
+        tuple: The normalized centroids and the fraction of tracks each covers.
+    """
+    k = min(n_components, len(vectors))
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)]
+    for _ in range(iterations):
+        labels = (vectors @ centroids.T).argmax(axis=1)
+        for c in range(k):
+            members = vectors[labels == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    counts = np.bincount((vectors @ centroids.T).argmax(axis=1), minlength=k)
+    keep = counts > 0
+    return centroids[keep], counts[keep] / counts.sum()
+
+class GenreModel:
+    def __init__(self, genres: list, centroids: np.ndarray, log_weights: np.ndarray, temperature: float = 0.05):
+        """
+        Initializes a genre model from its stacked mixture components.
+
+        Args:
+            genres (list): Genre names.
+            centroids (np.ndarray): Normalized centroids of shape [len(genres) * M, dim],
+                the M components of genre g at rows g*M .. g*M + M - 1.
+            log_weights (np.ndarray): Log mixture weight of each centroid; -inf marks padding.
+            temperature (float): Softmax temperature on cosine similarities.
+        """
+        self.genres = list(genres)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.log_weights = np.asarray(log_weights, dtype=np.float32)
+        self.temperature = temperature
+        self.components_per_genre = len(self.centroids) // max(len(self.genres), 1)
+
+    def _genre_logits(self, embeddings: np.ndarray, temperature: float | None = None) -> np.ndarray:
+        """
+        Scores tracks against every genre with one matrix multiply.
+
+        Returns:
+            np.ndarray: Unnormalized log-probabilities of shape [n, len(genres)].
+        """
+        temperature = temperature or self.temperature
+        scores = _normalize(np.atleast_2d(embeddings)) @ self.centroids.T / temperature + self.log_weights
+        scores = scores.reshape(len(scores), len(self.genres), self.components_per_genre)
+        return _logsumexp(scores, axis=2)
+
+    def predict_proba(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Computes genre probabilities for a batch of tracks.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, dim] (or one vector).
+
+        Returns:
+            np.ndarray: Probabilities of shape [n, len(genres)], columns in self.genres order.
+        """
+        return _softmax(self._genre_logits(embeddings))
+
+    def predict(self, embeddings: np.ndarray) -> list:
+        """
+        Finds the most likely genre of each track.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, dim] (or one vector).
+
+        Returns:
+            list: The genre name per track.
+        """
+        return [self.genres[i] for i in self._genre_logits(embeddings).argmax(axis=1)]
+
+    def playlist_proba(self, embeddings: np.ndarray, groups: np.ndarray | None = None) -> np.ndarray:
+        """
+        Computes the genre mix of one or more playlists as the mean of their
+        tracks' genre probabilities.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, dim] holding the tracks of every playlist.
+            groups (np.ndarray | None): Playlist index (0 .. P-1) of each track. None for a single playlist.
+
+        Returns:
+            np.ndarray: Probabilities of shape [len(genres)] for one playlist, or [P, len(genres)].
+        """
+        proba = self.predict_proba(embeddings)
+        if groups is None:
+            return proba.mean(axis=0)
+        groups = np.asarray(groups)
+        sums = np.zeros((groups.max() + 1, len(self.genres)), dtype=np.float64)
+        np.add.at(sums, groups, proba)
+        counts = np.bincount(groups, minlength=len(sums))[:, np.newaxis]
+        return sums / np.maximum(counts, 1)
+
+    def fit_temperature(self, embeddings: np.ndarray, labels: np.ndarray, candidates: np.ndarray | None = None) -> float:
+        """
+        Picks the softmax temperature that maximizes the likelihood of known labels.
+
+        Args:
+            embeddings (np.ndarray): Labelled tracks, shape [n, dim].
+            labels (np.ndarray): Genre index of each track.
+            candidates (np.ndarray | None): Temperatures to try.
+
+        Returns:
+            float: The chosen temperature (also stored on the model).
+        """
+        if candidates is None:
+            candidates = np.geomspace(0.005, 1.0, 24)
+        labels = np.asarray(labels)
+        best, best_ll = self.temperature, -np.inf
+        for t in candidates:
+            logits = self._genre_logits(embeddings, t)
+            ll = np.mean(logits[np.arange(len(labels)), labels] - _logsumexp(logits, axis=1))
+            if ll > best_ll:
+                best, best_ll = float(t), ll
+        self.temperature = best
+        return best
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, genre_rows: dict, n_components: int = 3, seed: int = 0) -> 'GenreModel':
+        """
+        Builds a model from labelled embeddings.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, dim].
+            genre_rows (dict): Row indices into embeddings, keyed by genre
+                (see baseline_data.genre_track_indices).
+            n_components (int): Centroids per genre.
+            seed (int): Random seed.
+
+        Returns:
+            GenreModel: The fitted model, with its temperature calibrated.
+        """
+        embeddings = _normalize(embeddings)
+        genres = sorted(g for g, rows in genre_rows.items() if len(rows))
+        dim = embeddings.shape[1]
+        centroids = np.zeros((len(genres) * n_components, dim), dtype=np.float32)
+        log_weights = np.full(len(genres) * n_components, -np.inf, dtype=np.float32)
+        for g, genre in enumerate(genres):
+            c, w = _genre_mixture(embeddings[genre_rows[genre]], n_components, seed=seed)
+            centroids[g * n_components:g * n_components + len(c)] = c
+            log_weights[g * n_components:g * n_components + len(c)] = np.log(w)
+
+        model = cls(genres, centroids, log_weights)
+        rows = np.concatenate([genre_rows[g] for g in genres])
+        labels = np.concatenate([np.full(len(genre_rows[g]), i) for i, g in enumerate(genres)])
+        model.fit_temperature(embeddings[rows], labels)
+        return model
+
+    def save(self, path: str = GENRE_MODEL_PATH):
+        """
+        Saves the model to a .npz file, replacing any existing one by renaming it into place.
+
+        Args:
+            path (str): The destination path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            genres=np.array(self.genres, dtype=str),
+            centroids=self.centroids,
+            log_weights=self.log_weights,
+            temperature=np.array(self.temperature)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = GENRE_MODEL_PATH) -> 'GenreModel':
+        """
+        Loads a model saved with save().
+
+        Args:
+            path (str): The .npz path.
+
+        Returns:
+            GenreModel: The model.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['genres'].tolist(), data['centroids'], data['log_weights'], float(data['temperature']))
+
+def latest_baseline_dataset() -> tuple[str, str] | None:
+    """
+    Finds the most recent baseline tracks/memberships TSV pair.
+
+    Returns:
+        tuple | None: The tracks and memberships paths, or None if there are none.
+    """
+    tracks_paths = glob.glob(os.path.join(PLAYLISTS_PATH, 'tracks_*.tsv'))
+    if not tracks_paths:
+        return None
+    tracks_path = max(tracks_paths, key=os.path.getmtime)
+    memberships_path = tracks_path.replace('tracks_', 'memberships_')
+    return (tracks_path, memberships_path) if os.path.exists(memberships_path) else None
+
+def build_genre_model(tracks_path: str | None = None, memberships_path: str | None = None, catalog=None, path: str = GENRE_MODEL_PATH) -> GenreModel:
+    """
+    Builds the genre model from the baseline dataset and saves it.
+
+    Args:
+        tracks_path (str | None): Baseline tracks TSV. Defaults to the latest one.
+        memberships_path (str | None): Baseline memberships TSV. Defaults to the latest one.
+        catalog (TrackCatalog | None): Where the embeddings are read from. Defaults to the shared catalog.
+        path (str): Where to save the model.
+
+    Returns:
+        GenreModel: The fitted model.
+    """
+    # Deferred so that scoring with a saved model doesn't need the Spotify client
+    from src.map.baseline_data import genre_track_indices
+    from src.storage.track_catalog import TrackCatalog
+
+    if tracks_path is None or memberships_path is None:
+        latest = latest_baseline_dataset()
+        if latest is None:
+            print(f"{Style.BRIGHT}[GenreModel]: {Style.NORMAL}{Fore.RED}Error: No baseline dataset found. Run the baseline ingestion first.{Style.RESET_ALL}")
+            sys.exit(1)
+        tracks_path, memberships_path = latest
+    if catalog is None:
+        catalog = TrackCatalog()
+
+    tracks_df = pd.read_csv(tracks_path, sep='\t', usecols=['Track ID'], dtype={'Track ID': str})
+    membership_df = pd.read_csv(memberships_path, sep='\t', dtype={'Track ID': str})
+
+    # Only tracks with an embedding can be used
+    embeddings, found = catalog.get_embedding_matrix(tracks_df['Track ID'].tolist())
+    tracks_df = tracks_df[found].reset_index(drop=True)
+    model = GenreModel.fit(embeddings, genre_track_indices(tracks_df, membership_df))
+    model.save(path)
+
+    print(f"{Style.BRIGHT}[GenreModel]: {Style.NORMAL}{Fore.GREEN}Built a model of {len(model.genres)} genres from {len(tracks_df)} tracks (temperature {model.temperature:.3f}).{Style.RESET_ALL}")
+    return model
+
+def classify_collection(name: str, model: GenreModel | None = None, catalog=None) -> pd.DataFrame:
+    """
+    Classifies every embedded track of a playlist or likes collection in one call.
+
+    Args:
+        name (str): The catalog collection name.
+        model (GenreModel | None): The model. Defaults to the saved model.
+        catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+
+    Returns:
+        pd.DataFrame: One row per track: 'Track ID', 'Genre', then one probability column per genre.
+    """
+    from src.storage.track_catalog import TrackCatalog
+
+    if model is None:
+        model = GenreModel.load()
+    if catalog is None:
+        catalog = TrackCatalog()
+
+    track_ids = catalog.collection_track_ids(name)
+    embeddings, found = catalog.get_embedding_matrix(track_ids)
+    proba = model.predict_proba(embeddings)
+    df = pd.DataFrame(proba, columns=model.genres)
+    df.insert(0, 'Genre', [model.genres[i] for i in proba.argmax(axis=1)])
+    df.insert(0, 'Track ID', [t for t, ok in zip(track_ids, found) if ok])
+    return df
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Incremental 2-D projection of track embeddings for drawing the map.
+
+The projection is fitted once on a reference corpus (the baseline genre
+playlists) in three steps:
+    1. PCA reduces the 128-d embeddings to a few dozen dimensions.
+    2. A sample of landmarks is laid out in 2-D with t-SNE, which keeps
+       similar-sounding tracks together.
+    3. Each landmark gets a kernel bandwidth from the t-SNE perplexity
+       calibration.
+
+Any track, old or new, is then placed out-of-sample: it is projected with
+PCA and positioned at the kernel-weighted average of its nearest landmarks.
+That is a couple of small matrix multiplies, so a user's new likes appear on
+the map immediately without refitting.
+
+ProjectionEngine watches how far placed tracks are from the landmarks. When
+new tracks drift too far from the fitted corpus, it refits in a background
+thread and aligns the new layout to the old one, so the map doesn't jump
+around between fits.
+
+The placed position of every catalog embedding is kept in a two-column
+embedding store (the layout), row-aligned with the catalog's store, so map
+readers can memory-map it instead of placing tracks themselves.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import threading
+from typing import Callable
+import numpy as np
+from src.utils.config import config
+
+PROJECTION_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['projection_path'][1:])
+LAYOUT_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['layout_path'][1:])
+DRIFT_THRESHOLD = config['settings']['projection_drift_threshold']
+PLACE_BLOCK = 65536  # Tracks placed per block when updating the layout
+
+def _sq_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Pairwise squared Euclidean distances between the rows of a and b.
+    """
+    d = np.einsum('ij,ij->i', a, a)[:, np.newaxis] - 2.0 * (a @ b.T) + np.einsum('ij,ij->i', b, b)
+    return np.maximum(d, 0.0)
+
+def _calibrate_betas(sq_dist: np.ndarray, perplexity: float, iterations: int = 64) -> np.ndarray:
+    """
+    Finds, for every row at once, the Gaussian precision whose conditional
+    distribution over the other rows has the target perplexity.
+
+    Args:
+        sq_dist (np.ndarray): Squared distances, shape [n, n], with the diagonal set to inf.
+        perplexity (float): Target perplexity.
+        iterations (int): Bisection steps.
+
+    Returns:
+        np.ndarray: Precision (1 / 2 sigma^2) per row.
+    """
+    n = len(sq_dist)
+    target = np.log(perplexity)
+    lo = np.zeros(n)
+    hi = np.full(n, np.inf)
+    beta = np.ones(n)
+    # Scale so the search starts near the right magnitude
+    scale = np.median(sq_dist[np.isfinite(sq_dist)])
+    d = sq_dist / scale
+    for _ in range(iterations):
+        logits = -d * beta[:, np.newaxis]
+        logits -= logits.max(axis=1, keepdims=True)
+        p = np.exp(logits)
+        p /= p.sum(axis=1, keepdims=True)
+        entropy = -np.sum(np.where(p > 0, p * np.log(np.maximum(p, 1e-300)), 0.0), axis=1)
+        too_flat = entropy > target
+        lo = np.where(too_flat, beta, lo)
+        hi = np.where(too_flat, hi, beta)
+        beta = np.where(np.isinf(hi), beta * 2.0, (lo + hi) / 2.0)
+    return beta / scale
+
+def tsne(points: np.ndarray, perplexity: float = 30.0, iterations: int = 750, init: np.ndarray | None = None, refine: bool = False, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Exact t-SNE, vectorized over all pairs. Intended for a few thousand
+    landmarks; the cost is quadratic in the number of points.
+
+    Args:
+        points (np.ndarray): Matrix of shape [n, d].
+        perplexity (float): Effective number of neighbours.
+        iterations (int): Gradient descent steps.
+        init (np.ndarray | None): Initial [n, 2] layout. Defaults to small random values.
+        refine (bool): Treat init as an existing layout to refine: keep its
+            scale and skip the early exaggeration phase that would reshuffle it.
+        seed (int): Random seed for the default initialization.
+
+    Returns:
+        tuple: The [n, 2] layout and the per-point Gaussian precisions.
+    """
+    n = len(points)
+    perplexity = min(perplexity, (n - 1) / 3)
+    sq_dist = _sq_distances(points, points).astype(np.float64)
+    np.fill_diagonal(sq_dist, np.inf)
+    betas = _calibrate_betas(sq_dist, perplexity)
+
+    cond = np.exp(-(sq_dist - sq_dist.min(axis=1, keepdims=True)) * betas[:, np.newaxis])
+    cond /= cond.sum(axis=1, keepdims=True)
+    p = np.maximum((cond + cond.T) / (2.0 * n), 1e-12)
+
+    if init is None:
+        init = np.random.default_rng(seed).standard_normal((n, 2)) * 1e-4
+    y = np.array(init, dtype=np.float64)
+    y -= y.mean(axis=0)
+    if not refine:
+        # Start small so early exaggeration can form clusters
+        y = y / (y.std() or 1.0) * 1e-4
+    early_iterations = 0 if refine else 250
+    velocity = np.zeros_like(y)
+    gains = np.ones_like(y)
+    learning_rate = max(n / 12.0, 50.0)
+
+    for i in range(iterations):
+        exaggeration = 12.0 if i < early_iterations else 1.0
+        momentum = 0.5 if i < early_iterations else 0.8
+        num = 1.0 / (1.0 + _sq_distances(y, y))
+        np.fill_diagonal(num, 0.0)
+        q = np.maximum(num / num.sum(), 1e-12)
+        w = (exaggeration * p - q) * num
+        grad = 4.0 * (w.sum(axis=1)[:, np.newaxis] * y - w @ y)
+
+        gains = np.where(np.sign(grad) != np.sign(velocity), gains + 0.2, gains * 0.8)
+        gains = np.maximum(gains, 0.01)
+        velocity = momentum * velocity - learning_rate * gains * grad
+        y += velocity
+        y -= y.mean(axis=0)
+
+    return y, betas
+
+def align(source: np.ndarray, target: np.ndarray) -> tuple[np.ndarray, float, np.ndarray]:
+    """
+    Finds the rotation (or reflection), uniform scale and translation that
+    best map source points onto target points (orthogonal Procrustes).
+
+    Args:
+        source (np.ndarray): Points of shape [n, 2].
+        target (np.ndarray): Matching points of shape [n, 2].
+
+    Returns:
+        tuple: (rotation [2, 2], scale, translation [2]) such that
+            source @ rotation * scale + translation ~= target.
+    """
+    mu_s, mu_t = source.mean(axis=0), target.mean(axis=0)
+    s, t = source - mu_s, target - mu_t
+    u, sigma, vt = np.linalg.svd(s.T @ t)
+    rotation = u @ vt
+    scale = sigma.sum() / max(np.sum(s * s), 1e-12)
+    return rotation, scale, mu_t - scale * (mu_s @ rotation)
+
+class MapProjection:
+    def __init__(self, n_components: int = 32, n_landmarks: int = 1000, n_neighbors: int = 8, perplexity: float = 30.0):
+        """
+        Initializes an unfitted projection.
+
+        Args:
+            n_components (int): PCA dimensions kept before the 2-D layout.
+            n_landmarks (int): Number of corpus points laid out with t-SNE.
+            n_neighbors (int): Landmarks each placed track is interpolated from.
+            perplexity (float): t-SNE perplexity.
+        """
+        self.n_components = n_components
+        self.n_landmarks = n_landmarks
+        self.n_neighbors = n_neighbors
+        self.perplexity = perplexity
+        self.mean = None
+        self.components = None
+        self.landmarks = None
+        self.landmark_positions = None
+        self.landmark_betas = None
+        self.reference_distance = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.landmarks is not None
+
+    def _reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        return (np.asarray(embeddings, dtype=np.float32) - self.mean) @ self.components.T
+
+    def fit(self, embeddings: np.ndarray, seed: int = 0, previous: 'MapProjection | None' = None) -> 'MapProjection':
+        """
+        Fits the projection on a reference corpus.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, 128].
+            seed (int): Random seed for the landmark sample.
+            previous (MapProjection | None): An earlier fit to align the new layout to.
+
+        Returns:
+            MapProjection: self.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        # PCA on a sample is plenty to find the main directions
+        self.mean = embeddings.mean(axis=0)
+        sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), 50000), replace=False)] - self.mean
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        self.components = vt[:min(self.n_components, vt.shape[0])].astype(np.float32)
+
+        # Lay out a landmark sample. A refit starts from where the previous
+        # map put the landmarks, so clusters keep their places; a first fit
+        # starts from the first two principal components.
+        landmark_rows = rng.choice(len(embeddings), min(len(embeddings), self.n_landmarks), replace=False)
+        self.landmarks = self._reduce(embeddings[landmark_rows])
+        refit = previous is not None and previous.is_fitted
+        init = previous.place(embeddings[landmark_rows]) if refit else self.landmarks[:, :2]
+        positions, betas = tsne(self.landmarks, self.perplexity, init=init, refine=refit, seed=seed)
+        self.landmark_betas = betas.astype(np.float32)
+
+        if refit:
+            # t-SNE only fixes the layout up to rotation and scale
+            rotation, scale, translation = align(positions, init)
+            positions = positions @ rotation * scale + translation
+        self.landmark_positions = positions.astype(np.float32)
+
+        # Typical distance from a corpus track to its nearest landmark, for
+        # drift checks. Landmarks themselves are left out, being at distance 0.
+        others = np.setdiff1d(np.arange(len(embeddings)), landmark_rows)
+        if len(others) == 0:
+            others = landmark_rows
+        check_rows = rng.choice(others, min(len(others), 10000), replace=False)
+        _, distances = self.place(embeddings[check_rows], return_distance=True)
+        self.reference_distance = float(distances.mean())
+        return self
+
+    def place(self, embeddings: np.ndarray, return_distance: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        """
+        Places tracks on the fitted map (out-of-sample).
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, 128] (or one vector).
+            return_distance (bool): Also return each track's distance to its nearest landmark.
+
+        Returns:
+            np.ndarray | tuple: The [n, 2] positions, and optionally the distances.
+        """
+        reduced = self._reduce(np.atleast_2d(embeddings))
+        sq_dist = _sq_distances(reduced, self.landmarks)
+        k = min(self.n_neighbors, len(self.landmarks))
+        nearest = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+        nearest_sq = np.take_along_axis(sq_dist, nearest, axis=1)
+
+        # Gaussian weights using each landmark's own t-SNE bandwidth
+        logits = -nearest_sq * self.landmark_betas[nearest]
+        logits -= logits.max(axis=1, keepdims=True)
+        weights = np.exp(logits)
+        weights /= weights.sum(axis=1, keepdims=True)
+        positions = np.einsum('nk,nkd->nd', weights, self.landmark_positions[nearest])
+
+        if return_distance:
+            return positions, np.sqrt(nearest_sq.min(axis=1))
+        return positions
+
+    def save(self, path: str = PROJECTION_PATH):
+        """
+        Saves the fitted projection to a .npz file, replacing any existing one by renaming it into place.
+
+        Args:
+            path (str): The destination path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            settings=np.array([self.n_components, self.n_landmarks, self.n_neighbors, self.perplexity]),
+            mean=self.mean,
+            components=self.components,
+            landmarks=self.landmarks,
+            landmark_positions=self.landmark_positions,
+            landmark_betas=self.landmark_betas,
+            reference_distance=np.array(self.reference_distance)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = PROJECTION_PATH) -> 'MapProjection':
+        """
+        Loads a projection saved with save().
+
+        Args:
+            path (str): The .npz path.
+
+        Returns:
+            MapProjection: The fitted projection.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            n_components, n_landmarks, n_neighbors, perplexity = data['settings']
+            projection = cls(int(n_components), int(n_landmarks), int(n_neighbors), float(perplexity))
+            projection.mean = data['mean']
+            projection.components = data['components']
+            projection.landmarks = data['landmarks']
+            projection.landmark_positions = data['landmark_positions']
+            projection.landmark_betas = data['landmark_betas']
+            projection.reference_distance = float(data['reference_distance'])
+        return projection
+
+class ProjectionEngine:
+    def __init__(self, projection: MapProjection, load_corpus: Callable[[], np.ndarray], drift_threshold: float = DRIFT_THRESHOLD, min_drift_samples: int = 100, path: str | None = PROJECTION_PATH):
+        """
+        Serves placements from a fitted projection and refits it in the
+        background once placed tracks drift away from the fitted corpus.
+
+        Drift is the mean nearest-landmark distance of the tracks placed since
+        the last fit, relative to that of the corpus itself.
+
+        Args:
+            projection (MapProjection): The fitted projection.
+            load_corpus (Callable): Returns the embedding matrix to refit on.
+            drift_threshold (float): Refit once drift exceeds this ratio.
+            min_drift_samples (int): Tracks placed before drift is judged.
+            path (str | None): Where refitted projections are saved. None to skip saving.
+        """
+        self.projection = projection
+        self.load_corpus = load_corpus
+        self.drift_threshold = drift_threshold
+        self.min_drift_samples = min_drift_samples
+        self.path = path
+        self._distance_sum = 0.0
+        self._placed = 0
+        self._lock = threading.Lock()
+        self._refit_thread = None
+
+    @property
+    def drift(self) -> float:
+        """
+        How much further placed tracks are from the landmarks than the fitted corpus is.
+        """
+        if self._placed == 0:
+            return 1.0
+        return (self._distance_sum / self._placed) / max(self.projection.reference_distance, 1e-12)
+
+    @property
+    def refitting(self) -> bool:
+        return self._refit_thread is not None and self._refit_thread.is_alive()
+
+    def place(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Places tracks on the current map, scheduling a background refit if
+        they have drifted too far from the fitted corpus.
+
+        Args:
+            embeddings (np.ndarray): Matrix of shape [n, 128] (or one vector).
+
+        Returns:
+            np.ndarray: The [n, 2] positions.
+        """
+        positions, distances = self.projection.place(embeddings, return_distance=True)
+        with self._lock:
+            self._distance_sum += float(distances.sum())
+            self._placed += len(distances)
+            should_refit = (
+                self._placed >= self.min_drift_samples
+                and self.drift > self.drift_threshold
+                and not self.refitting
+            )
+            if should_refit:
+                self._refit_thread = threading.Thread(target=self._refit, daemon=True)
+                self._refit_thread.start()
+        return positions
+
+    def _refit(self):
+        print(f"{Style.BRIGHT}[Projection]: {Style.NORMAL}{Fore.CYAN}Drift {self.drift:.2f} exceeds {self.drift_threshold:.2f}; refitting in the background.{Style.RESET_ALL}")
+        old = self.projection
+        new = MapProjection(old.n_components, old.n_landmarks, old.n_neighbors, old.perplexity)
+        new.fit(self.load_corpus(), previous=old)
+        if self.path is not None:
+            new.save(self.path)
+        # Swapping the reference is atomic, so readers see either fit whole
+        with self._lock:
+            self.projection = new
+            self._distance_sum = 0.0
+            self._placed = 0
+        print(f"{Style.BRIGHT}[Projection]: {Style.NORMAL}{Fore.GREEN}Refitted the map projection.{Style.RESET_ALL}")
+
+    def wait(self, timeout: float | None = None):
+        """
+        Blocks until a running background refit finishes.
+        """
+        if self._refit_thread is not None:
+            self._refit_thread.join(timeout)
+
+def catalog_corpus(catalog, collection_kind: str = 'baseline') -> np.ndarray:
+    """
+    Gathers the embeddings of every track in the catalog's collections of a kind.
+
+    Args:
+        catalog (TrackCatalog): The track catalog.
+        collection_kind (str): The collection kind, e.g. 'baseline'.
+
+    Returns:
+        np.ndarray: The embedding matrix.
+    """
+    names = [r[0] for r in catalog.conn.execute("SELECT name FROM collections WHERE kind = ?", (collection_kind,))]
+    track_ids = list(dict.fromkeys(t for name in names for t in catalog.collection_track_ids(name)))
+    matrix, _ = catalog.get_embedding_matrix(track_ids)
+    return matrix
+
+def fit_baseline_projection(catalog=None, path: str = PROJECTION_PATH) -> MapProjection:
+    """
+    Fits the map projection on the baseline genre corpus and saves it.
+
+    Args:
+        catalog (TrackCatalog | None): The catalog to read. Defaults to the shared catalog.
+        path (str): Where to save the projection.
+
+    Returns:
+        MapProjection: The fitted projection.
+    """
+    if catalog is None:
+        from src.storage.track_catalog import TrackCatalog
+        catalog = TrackCatalog()
+
+    corpus = catalog_corpus(catalog)
+    if len(corpus) < 2:
+        print(f"{Style.BRIGHT}[Projection]: {Style.NORMAL}{Fore.RED}Error: The baseline corpus has no embeddings. Run the baseline ingestion first.{Style.RESET_ALL}")
+        sys.exit(1)
+
+    previous = MapProjection.load(path) if os.path.exists(path) else None
+    projection = MapProjection().fit(corpus, previous=previous)
+    projection.save(path)
+    print(f"{Style.BRIGHT}[Projection]: {Style.NORMAL}{Fore.GREEN}Fitted the map projection on {len(corpus)} baseline tracks.{Style.RESET_ALL}")
+    return projection
+
+def load_engine(catalog=None, path: str = PROJECTION_PATH) -> ProjectionEngine:
+    """
+    Loads the saved projection into an engine that refits on the catalog's
+    baseline and liked tracks when drift requires it.
+
+    Args:
+        catalog (TrackCatalog | None): The catalog to refit from. Defaults to the shared catalog.
+        path (str): The projection path.
+
+    Returns:
+        ProjectionEngine: The engine.
+    """
+    if catalog is None:
+        from src.storage.track_catalog import TrackCatalog
+        catalog = TrackCatalog()
+    projection = MapProjection.load(path) if os.path.exists(path) else fit_baseline_projection(catalog, path)
+
+    def load_corpus() -> np.ndarray:
+        return np.concatenate([catalog_corpus(catalog, 'baseline'), catalog_corpus(catalog, 'likes')])
+
+    return ProjectionEngine(projection, load_corpus, path=path)
+
+def update_catalog_layout(store, projection: MapProjection | None = None, prefix: str = LAYOUT_PATH, projection_path: str = PROJECTION_PATH):
+    """
+    Brings the persisted map layout up to date with an embedding store.
+
+    Only the store rows appended since the last update are placed. The whole
+    layout is placed again if the projection was refitted since, or if the
+    store was rewritten.
+
+    Args:
+        store (EmbeddingStore): The catalog's embedding store.
+        projection (MapProjection | None): The projection. Defaults to the saved one.
+        prefix (str): Path prefix of the layout store.
+        projection_path (str): The saved projection, whose age decides whether to start over.
+
+    Returns:
+        EmbeddingStore | None: The layout, or None if there is no projection yet.
+    """
+    from src.storage.embedding_store import EmbeddingStore
+
+    if projection is None:
+        if not os.path.exists(projection_path):
+            return None
+        projection = MapProjection.load(projection_path)
+
+    layout = EmbeddingStore(prefix, dim=2) if os.path.exists(prefix + '.npy') else None
+    rebuild = (
+        layout is None
+        or len(store) < len(layout)
+        or (os.path.exists(projection_path) and os.path.getmtime(projection_path) > os.path.getmtime(layout.matrix_path))
+    )
+    target = EmbeddingStore.staging(prefix, dim=2) if rebuild else layout
+    if len(target) == len(store):
+        return target
+
+    matrix = store.matrix()
+    for start in range(len(target), len(store), PLACE_BLOCK):
+        stop = min(start + PLACE_BLOCK, len(store))
+        target.append(store.ids[start:stop], projection.place(np.asarray(matrix[start:stop], dtype=np.float32)))
+    if rebuild:
+        target = target.promote(prefix)
+
+    print(f"{Style.BRIGHT}[Projection]: {Style.NORMAL}{Fore.GREEN}Map layout at {prefix}.npy now holds {len(target)} tracks.{Style.RESET_ALL}")
+    return target
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Nearest-neighbour search over track embeddings.
+
+Two indexes share one interface:
+    - ExactIndex: brute-force top-k. Database rows are scored in blocks with a
+      single matrix multiply per block (BLAS sgemm), so memory stays bounded
+      and results are exact.
+    - IVFIndex: an inverted file. A k-means coarse quantizer splits the
+      vectors into nlist cells, and a query only scans the nprobe cells
+      closest to it. Raising nprobe trades latency for recall.
+
+Both support cosine similarity and Euclidean (L2) distance, incremental
+inserts (re-adding a track ID replaces its vector), and persistence to a
+single .npz file. update_catalog_index keeps a persisted index in step with
+the catalog's embedding store as new tracks are embedded.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import numpy as np
+from src.utils.config import config
+
+SIMILARITY_INDEX_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['similarity_index_path'][1:])
+IVF_NPROBE = config['settings']['ivf_nprobe']
+
+METRICS = ('cosine', 'l2')
+BLOCK_SIZE = 32768  # Database rows scored per matrix multiply
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _merge_top_k(best_scores: np.ndarray, best_pos: np.ndarray, scores: np.ndarray, pos: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merges a block of candidate scores into the running top-k (unsorted).
+
+    Args:
+        best_scores (np.ndarray): Running top-k scores, shape [Q, <=k].
+        best_pos (np.ndarray): Positions matching best_scores.
+        scores (np.ndarray): Candidate scores, shape [Q, B].
+        pos (np.ndarray): Candidate positions, shape [Q, B] or [B].
+
+    Returns:
+        tuple: The new top-k scores and positions.
+    """
+    if pos.ndim == 1:
+        pos = np.broadcast_to(pos, scores.shape)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    pos = np.concatenate([best_pos, pos], axis=1)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        pos = np.take_along_axis(pos, keep, axis=1)
+    return scores, pos
+
+def _sort_top_k(scores: np.ndarray, pos: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(pos, order, axis=1)
+
+class ExactIndex:
+    kind = 'exact'
+
+    def __init__(self, dim: int = 128, metric: str = 'cosine'):
+        """
+        Initializes an empty exact index.
+
+        Args:
+            dim (int): Embedding dimension.
+            metric (str): 'cosine' (similarity, higher is closer) or 'l2' (distance, lower is closer).
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}.")
+        self.dim = dim
+        self.metric = metric
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._size = 0
+        self._ids = []
+        self._pos_of = {}
+        self.synced_rows = 0  # Embedding store rows already added (see update_catalog_index)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self._pos_of
+
+    @property
+    def ids(self) -> list:
+        """
+        The track ID at each position of the index.
+        """
+        return self._ids
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The stored vectors (normalized for cosine), in position order.
+        """
+        return self._vectors[:self._size]
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}.")
+        return _normalize(vectors) if self.metric == 'cosine' else vectors
+
+    def _grow(self, extra: int):
+        # Double the buffer so repeated small inserts stay amortized O(1)
+        needed = self._size + extra
+        if needed <= len(self._vectors):
+            return
+        capacity = max(needed, 2 * len(self._vectors), 1024)
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        self._vectors, self._sq_norms = vectors, sq_norms
+
+    def add(self, ids: list, vectors: np.ndarray) -> np.ndarray:
+        """
+        Adds vectors to the index. An ID that is already indexed has its
+        vector replaced.
+
+        Args:
+            ids (list): The track IDs, one per vector.
+            vectors (np.ndarray): Matrix of shape [len(ids), dim].
+
+        Returns:
+            np.ndarray: The positions the vectors were written to.
+        """
+        vectors = self._prepare(vectors)
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} IDs for {len(vectors)} vectors.")
+        self._grow(len(ids))
+
+        positions = np.empty(len(ids), dtype=np.int64)
+        for i, track_id in enumerate(ids):
+            track_id = str(track_id)
+            pos = self._pos_of.get(track_id)
+            if pos is None:
+                pos = self._size
+                self._size += 1
+                self._ids.append(track_id)
+                self._pos_of[track_id] = pos
+            positions[i] = pos
+        self._vectors[positions] = vectors
+        self._sq_norms[positions] = np.einsum('ij,ij->i', vectors, vectors)
+        return positions
+
+    def _score(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        """
+        Scores queries against database positions [start, stop); higher is closer.
+        """
+        scores = queries @ self._vectors[start:stop].T
+        if self.metric == 'l2':
+            # -||q - x||^2 up to the per-query constant ||q||^2
+            scores *= 2.0
+            scores -= self._sq_norms[start:stop]
+        return scores
+
+    def _finish(self, queries: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        """
+        Converts internal scores to the metric's values.
+        """
+        if self.metric == 'cosine':
+            return scores
+        q_norms = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+        return np.sqrt(np.maximum(q_norms - scores, 0.0))
+
+    def search_positions(self, queries: np.ndarray, k: int = 10, block_size: int = BLOCK_SIZE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k nearest positions for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            k (int): Number of neighbours.
+            block_size (int): Database rows scored per matrix multiply.
+
+        Returns:
+            tuple: Scores and positions, each of shape [Q, min(k, len(self))],
+                closest first. Scores are cosine similarities or L2 distances.
+        """
+        queries = self._prepare(queries)
+        k = min(k, self._size)
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_pos = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, self._size, block_size):
+            stop = min(start + block_size, self._size)
+            scores = self._score(queries, start, stop)
+            best_scores, best_pos = _merge_top_k(best_scores, best_pos, scores, np.arange(start, stop), k)
+        best_scores, best_pos = _sort_top_k(best_scores, best_pos)
+        return self._finish(queries, best_scores), best_pos
+
+    def search(self, queries: np.ndarray, k: int = 10) -> list:
+        """
+        Finds the k nearest tracks for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            k (int): Number of neighbours.
+
+        Returns:
+            list: For each query, a list of (track ID, score) tuples, closest first.
+        """
+        scores, positions = self.search_positions(queries, k)
+        return [
+            [(self._ids[p], float(s)) for p, s in zip(row_pos, row_scores)]
+            for row_pos, row_scores in zip(positions, scores)
+        ]
+
+    def _state(self) -> dict:
+        return {
+            'kind': np.array(self.kind),
+            'dim': np.array(self.dim),
+            'metric': np.array(self.metric),
+            'ids': np.array(self._ids, dtype=str),
+            'vectors': self.vectors,
+            'synced_rows': np.array(self.synced_rows)
+        }
+
+    def _restore(self, state: dict):
+        vectors = state['vectors']
+        self._grow(len(vectors))
+        self._vectors[:len(vectors)] = vectors
+        self._sq_norms[:len(vectors)] = np.einsum('ij,ij->i', vectors, vectors)
+        self._size = len(vectors)
+        self._ids = state['ids'].tolist()
+        self._pos_of = {track_id: i for i, track_id in enumerate(self._ids)}
+        self.synced_rows = int(state['synced_rows'])
+
+    def save(self, path: str):
+        """
+        Saves the index to a .npz file, replacing any existing one by renaming it into place.
+
+        Args:
+            path (str): The destination path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **self._state())
+        os.replace(tmp_path, path)
+
+class IVFIndex(ExactIndex):
+    kind = 'ivf'
+
+    def __init__(self, dim: int = 128, metric: str = 'cosine', nlist: int | None = None, nprobe: int = IVF_NPROBE):
+        """
+        Initializes an empty inverted-file index.
+
+        Until the index has enough vectors to train its quantizer (39 per
+        cell), searches fall back to an exact scan.
+
+        Args:
+            dim (int): Embedding dimension.
+            metric (str): 'cosine' or 'l2'.
+            nlist (int | None): Number of cells. Defaults to about 4 * sqrt(n) at training time.
+            nprobe (int): Cells scanned per query.
+        """
+        super().__init__(dim, metric)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.trained_size = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._order = None    # Positions sorted by cell, rebuilt lazily after inserts
+        self._offsets = None  # Start of each cell in _order
+        self._sorted_vectors = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def _default_nlist(self, n: int) -> int:
+        return int(np.clip(4 * np.sqrt(n), 16, 65536))
+
+    def _grow(self, extra: int):
+        super()._grow(extra)
+        if len(self._assignments) < len(self._vectors):
+            assignments = np.full(len(self._vectors), -1, dtype=np.int32)
+            assignments[:self._size] = self._assignments[:self._size]
+            self._assignments = assignments
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Assigns vectors to their nearest centroid, in blocks.
+        """
+        c_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            scores = vectors[start:start + BLOCK_SIZE] @ self.centroids.T
+            if self.metric == 'l2':
+                scores -= 0.5 * c_sq_norms
+            assignments[start:start + BLOCK_SIZE] = scores.argmax(axis=1)
+        return assignments
+
+    def train(self, nlist: int | None = None, iterations: int = 10, sample_size: int = 64, seed: int = 0):
+        """
+        Trains the coarse quantizer with k-means on the indexed vectors and
+        assigns every vector to a cell.
+
+        Args:
+            nlist (int | None): Number of cells. Defaults to self.nlist, or about 4 * sqrt(n).
+            iterations (int): Lloyd iterations.
+            sample_size (int): Training vectors sampled per cell.
+            seed (int): Random seed.
+        """
+        vectors = self.vectors
+        nlist = nlist or self.nlist or self._default_nlist(len(vectors))
+        nlist = min(nlist, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), nlist * sample_size), replace=False)]
+
+        self.centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._assign(sample)
+            counts = np.bincount(labels, minlength=nlist)
+            filled = counts > 0
+            # Sum each cell's members as contiguous runs of the sorted sample
+            order = np.argsort(labels, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+            self.centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / counts[filled, np.newaxis]
+            # Re-seed empty cells from random sample points
+            self.centroids[~filled] = sample[rng.choice(len(sample), int((~filled).sum()))]
+            if self.metric == 'cosine':
+                self.centroids = _normalize(self.centroids)
+
+        self.nlist = nlist
+        self.trained_size = len(vectors)
+        self._assignments[:self._size] = self._assign(vectors)
+        self._order = None
+
+    def add(self, ids: list, vectors: np.ndarray) -> np.ndarray:
+        positions = super().add(ids, vectors)
+        if self.is_trained:
+            self._assignments[positions] = self._assign(self._vectors[positions])
+        elif self._size >= 39 * (self.nlist or self._default_nlist(self._size)):
+            self.train()
+        self._order = None
+        return positions
+
+    def _build_lists(self):
+        """
+        Groups the positions by cell, with a cell-ordered copy of the vectors
+        so scanning a cell is a contiguous slice.
+        """
+        assignments = self._assignments[:self._size]
+        self._order = np.argsort(assignments, kind='stable')
+        self._offsets = np.searchsorted(assignments[self._order], np.arange(self.nlist + 1))
+        self._sorted_vectors = self._vectors[self._order]
+        self._sorted_sq_norms = self._sq_norms[self._order]
+
+    def search_positions(self, queries: np.ndarray, k: int = 10, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the (approximate) k nearest positions for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            k (int): Number of neighbours.
+            nprobe (int | None): Cells scanned per query. Defaults to self.nprobe.
+
+        Returns:
+            tuple: Scores and positions, each of shape [Q, k], closest first.
+                Queries with fewer than k candidates are padded with -1
+                positions and -inf (cosine) or inf (L2) scores.
+        """
+        if not self.is_trained:
+            return super().search_positions(queries, k)
+        if self._order is None:
+            self._build_lists()
+
+        queries = self._prepare(queries)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        k = min(k, self._size)
+
+        # Nearest cells for every query at once
+        cell_scores = queries @ self.centroids.T
+        if self.metric == 'l2':
+            cell_scores -= 0.5 * np.einsum('ij,ij->i', self.centroids, self.centroids)
+        probes = np.argpartition(-cell_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_pos = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, cells in enumerate(probes):
+            slices = [np.arange(self._offsets[c], self._offsets[c + 1]) for c in cells]
+            candidates = np.concatenate(slices)
+            if len(candidates) == 0:
+                continue
+            scores = self._sorted_vectors[candidates] @ queries[q]
+            if self.metric == 'l2':
+                scores = 2.0 * scores - self._sorted_sq_norms[candidates]
+            top = min(k, len(candidates))
+            best = np.argpartition(-scores, top - 1)[:top]
+            all_scores[q, :top] = scores[best]
+            all_pos[q, :top] = self._order[candidates[best]]
+
+        all_scores, all_pos = _sort_top_k(all_scores, all_pos)
+        return self._finish(queries, all_scores), all_pos
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int | None = None) -> list:
+        """
+        Finds the (approximate) k nearest tracks for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            k (int): Number of neighbours.
+            nprobe (int | None): Cells scanned per query. Defaults to self.nprobe.
+
+        Returns:
+            list: For each query, a list of (track ID, score) tuples, closest first.
+        """
+        scores, positions = self.search_positions(queries, k, nprobe)
+        return [
+            [(self._ids[p], float(s)) for p, s in zip(row_pos, row_scores) if p >= 0]
+            for row_pos, row_scores in zip(positions, scores)
+        ]
+
+    def _state(self) -> dict:
+        state = super()._state()
+        state.update({
+            'nlist': np.array(self.nlist or 0),
+            'nprobe': np.array(self.nprobe),
+            'trained_size': np.array(self.trained_size)
+        })
+        if self.is_trained:
+            state['centroids'] = self.centroids
+            state['assignments'] = self._assignments[:self._size]
+        return state
+
+    def _restore(self, state: dict):
+        super()._restore(state)
+        self.nlist = int(state['nlist']) or None
+        self.nprobe = int(state['nprobe'])
+        self.trained_size = int(state['trained_size'])
+        if 'centroids' in state:
+            self.centroids = state['centroids']
+            self._assignments[:self._size] = state['assignments']
+
+def load_index(path: str) -> ExactIndex | IVFIndex:
+    """
+    Loads an index saved with save().
+
+    Args:
+        path (str): The .npz path.
+
+    Returns:
+        ExactIndex | IVFIndex: The index.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        state = {key: data[key] for key in data.files}
+    cls = IVFIndex if str(state['kind']) == 'ivf' else ExactIndex
+    index = cls(dim=int(state['dim']), metric=str(state['metric']))
+    index._restore(state)
+    return index
+
+def update_catalog_index(store, path: str = SIMILARITY_INDEX_PATH, metric: str = 'cosine') -> IVFIndex:
+    """
+    Brings the persisted catalog index up to date with an embedding store.
+
+    Only the store rows appended since the last update are added, so this is
+    cheap to call after every embedding run. Re-embedded tracks replace their
+    old vectors. The quantizer is retrained once the index has grown to four
+    times the size it was trained at.
+
+    Args:
+        store (EmbeddingStore): The catalog's embedding store.
+        path (str): The index path.
+        metric (str): Metric for a newly created index.
+
+    Returns:
+        IVFIndex: The updated index.
+    """
+    if os.path.exists(path):
+        index = load_index(path)
+    else:
+        index = IVFIndex(dim=store.dim, metric=metric)
+
+    if len(store) < index.synced_rows:
+        # The store was rewritten; start over
+        index = IVFIndex(dim=store.dim, metric=index.metric)
+    if len(store) == index.synced_rows:
+        return index
+
+    matrix = store.matrix()
+    for start in range(index.synced_rows, len(store), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(store))
+        index.add(store.ids[start:stop], matrix[start:stop])
+    index.synced_rows = len(store)
+    if index.is_trained and len(index) >= 4 * index.trained_size:
+        index.train(nlist=index._default_nlist(len(index)))
+    index.save(path)
+
+    print(f"{Style.BRIGHT}[SimilarityIndex]: {Style.NORMAL}{Fore.GREEN}Index at {path} now holds {len(index)} tracks.{Style.RESET_ALL}")
+    return index
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Level-of-detail tiles for drawing the map at catalog scale.
+
+The 2-D layout (see projection.update_catalog_layout) is cut into a quadtree
+pyramid: zoom level z splits the map's bounds into 2^z x 2^z tiles. Each
+tile holds at most TILE_CAPACITY points. Every track has a fixed pseudo-random
+priority (a hash of its ID), and a tile keeps its highest-priority tracks, so
+a track drawn at one zoom level is still drawn at every deeper level and
+panning or zooming never makes points flicker. Tiles at zoom levels up to
+AGGREGATE_ZOOM also carry the count and mean position of every k-means
+cluster (see clustering.py) they contain, to draw coarse views as clusters
+rather than samples.
+
+Tiles are small binary files, <tiles>/<z>/<x>/<y>.bin:
+    - a header: magic b'MMT1', point count, aggregate count (uint32 each)
+    - the points: POINT_DTYPE records (layout row, x, y, cluster)
+    - the aggregates: AGGREGATE_DTYPE records (cluster, count, mean x, mean y)
+A manifest.json next to them records the bounds and build settings.
+
+New layout rows only touch the tiles they fall in, so updates after an
+embedding run are cheap. TileSet.query reads only the tiles a viewport
+overlaps.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+from functools import lru_cache
+import json
+import shutil
+import struct
+import zlib
+import numpy as np
+from src.utils.config import config
+
+TILES_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['tiles_path'][1:])
+
+MAX_ZOOM = 8
+TILE_CAPACITY = 1024
+AGGREGATE_ZOOM = 5
+BOUNDS_MARGIN = 0.1  # Bounds are padded by this fraction so new tracks rarely fall outside
+
+TILE_MAGIC = b'MMT1'
+TILE_HEADER = struct.Struct('<4sII')
+POINT_DTYPE = np.dtype([('row', '<u4'), ('x', '<f4'), ('y', '<f4'), ('cluster', '<i2')])
+AGGREGATE_DTYPE = np.dtype([('cluster', '<i2'), ('count', '<u4'), ('x', '<f4'), ('y', '<f4')])
+
+def track_priorities(track_ids: list) -> np.ndarray:
+    """
+    Fixed pseudo-random priority of each track; lower values are drawn first.
+    """
+    return np.fromiter((zlib.crc32(t.encode()) for t in track_ids), dtype=np.uint32, count=len(track_ids))
+
+def encode_tile(points: np.ndarray, aggregates: np.ndarray) -> bytes:
+    """
+    Serializes a tile's points and aggregates.
+    """
+    return TILE_HEADER.pack(TILE_MAGIC, len(points), len(aggregates)) + points.tobytes() + aggregates.tobytes()
+
+def decode_tile(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Parses a tile written by encode_tile.
+
+    Returns:
+        tuple: The POINT_DTYPE points and AGGREGATE_DTYPE aggregates.
+    """
+    magic, n_points, n_aggregates = TILE_HEADER.unpack_from(data)
+    if magic != TILE_MAGIC:
+        raise ValueError("Not a map tile.")
+    offset = TILE_HEADER.size
+    points = np.frombuffer(data, POINT_DTYPE, n_points, offset)
+    aggregates = np.frombuffer(data, AGGREGATE_DTYPE, n_aggregates, offset + n_points * POINT_DTYPE.itemsize)
+    return points, aggregates
+
+def _tile_keys(positions: np.ndarray, bounds: tuple, zoom: int) -> np.ndarray:
+    """
+    Index (x * 2^z + y) of the zoom-level tile containing each position.
+    """
+    x0, y0, x1, y1 = bounds
+    n = 1 << zoom
+    tx = np.clip(((positions[:, 0] - x0) / (x1 - x0) * n).astype(np.int64), 0, n - 1)
+    ty = np.clip(((positions[:, 1] - y0) / (y1 - y0) * n).astype(np.int64), 0, n - 1)
+    return tx * n + ty
+
+class TileSet:
+    def __init__(self, path: str = TILES_PATH):
+        """
+        Opens a tile pyramid written by build_tiles or update_tiles.
+
+        Args:
+            path (str): The tiles directory.
+        """
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        self.bounds = tuple(self.manifest['bounds'])
+        self.max_zoom = self.manifest['max_zoom']
+        self.read_tile = lru_cache(maxsize=4096)(self._read_tile)
+
+    def tile_path(self, zoom: int, x: int, y: int) -> str:
+        return os.path.join(self.path, str(zoom), str(x), f"{y}.bin")
+
+    def _read_tile(self, zoom: int, x: int, y: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Reads one tile; missing tiles are empty.
+        """
+        try:
+            with open(self.tile_path(zoom, x, y), 'rb') as f:
+                return decode_tile(f.read())
+        except FileNotFoundError:
+            return np.empty(0, dtype=POINT_DTYPE), np.empty(0, dtype=AGGREGATE_DTYPE)
+
+    def zoom_for(self, width: float) -> int:
+        """
+        The zoom level at which about one tile spans a viewport of this width.
+        """
+        extent = self.bounds[2] - self.bounds[0]
+        return int(np.clip(np.floor(np.log2(extent / max(width, 1e-12))), 0, self.max_zoom))
+
+    def query(self, x0: float, y0: float, x1: float, y1: float, zoom: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Gathers what to draw in a viewport, reading only the tiles it overlaps.
+
+        Args:
+            x0, y0, x1, y1 (float): The viewport in layout coordinates.
+            zoom (int | None): The zoom level. Defaults to zoom_for the viewport width.
+
+        Returns:
+            tuple: The POINT_DTYPE points inside the viewport and the
+                AGGREGATE_DTYPE cluster aggregates of the overlapped tiles
+                (empty beyond AGGREGATE_ZOOM), merged across tiles.
+        """
+        zoom = self.zoom_for(x1 - x0) if zoom is None else min(zoom, self.max_zoom)
+        bx0, by0, bx1, by1 = self.bounds
+        n = 1 << zoom
+        first_x, last_x = (int(np.clip((v - bx0) / (bx1 - bx0) * n, 0, n - 1)) for v in (x0, x1))
+        first_y, last_y = (int(np.clip((v - by0) / (by1 - by0) * n, 0, n - 1)) for v in (y0, y1))
+
+        points, aggregates = [], []
+        for x in range(first_x, last_x + 1):
+            for y in range(first_y, last_y + 1):
+                tile_points, tile_aggregates = self.read_tile(zoom, x, y)
+                points.append(tile_points)
+                aggregates.append(tile_aggregates)
+        points = np.concatenate(points)
+        points = points[(points['x'] >= x0) & (points['x'] <= x1) & (points['y'] >= y0) & (points['y'] <= y1)]
+        return points, _merge_aggregates(np.concatenate(aggregates))
+
+def _merge_aggregates(aggregates: np.ndarray) -> np.ndarray:
+    """
+    Combines aggregates of the same cluster into count-weighted means.
+    """
+    if len(aggregates) == 0:
+        return aggregates
+    clusters, inverse = np.unique(aggregates['cluster'], return_inverse=True)
+    counts = np.bincount(inverse, weights=aggregates['count'])
+    merged = np.empty(len(clusters), dtype=AGGREGATE_DTYPE)
+    merged['cluster'] = clusters
+    merged['count'] = counts
+    merged['x'] = np.bincount(inverse, weights=aggregates['x'] * aggregates['count']) / counts
+    merged['y'] = np.bincount(inverse, weights=aggregates['y'] * aggregates['count']) / counts
+    return merged
+
+def _write_tile(path: str, points: np.ndarray, aggregates: np.ndarray):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_tile(points, aggregates))
+    os.replace(tmp_path, path)
+
+def _tile_contents(rows: np.ndarray, positions: np.ndarray, labels: np.ndarray, priorities: np.ndarray, with_aggregates: bool, capacity: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds one tile from every point that falls in it.
+    """
+    keep = np.argsort(priorities, kind='stable')[:capacity]
+    points = np.empty(len(keep), dtype=POINT_DTYPE)
+    points['row'] = rows[keep]
+    points['x'], points['y'] = positions[keep, 0], positions[keep, 1]
+    points['cluster'] = labels[keep]
+    if not with_aggregates:
+        return points, np.empty(0, dtype=AGGREGATE_DTYPE)
+    clusters, inverse = np.unique(labels, return_inverse=True)
+    counts = np.bincount(inverse)
+    aggregates = np.empty(len(clusters), dtype=AGGREGATE_DTYPE)
+    aggregates['cluster'] = clusters
+    aggregates['count'] = counts
+    aggregates['x'] = np.bincount(inverse, weights=positions[:, 0]) / counts
+    aggregates['y'] = np.bincount(inverse, weights=positions[:, 1]) / counts
+    return points, aggregates
+
+def _labels_digest(labels: np.ndarray) -> int:
+    """
+    Checksum of the cluster labels, to notice when a reclustering changed
+    the labels of tracks already tiled.
+    """
+    return zlib.crc32(np.ascontiguousarray(labels, dtype='<i2').tobytes())
+
+def _latest_rows(layout) -> np.ndarray:
+    """
+    The layout row holding each track's current position (re-embedded tracks
+    leave older rows behind).
+    """
+    return np.array(sorted(layout.row_of(t) for t in set(layout.ids)), dtype=np.int64)
+
+def build_tiles(layout, labels: np.ndarray | None = None, path: str = TILES_PATH, max_zoom: int = MAX_ZOOM, capacity: int = TILE_CAPACITY, aggregate_zoom: int = AGGREGATE_ZOOM) -> TileSet:
+    """
+    Builds the whole tile pyramid from a layout, replacing any existing one.
+
+    Args:
+        layout (EmbeddingStore): The map layout.
+        labels (np.ndarray | None): Cluster of every layout row (-1 if unknown).
+        path (str): The tiles directory.
+        max_zoom (int): Deepest zoom level.
+        capacity (int): Maximum points per tile.
+        aggregate_zoom (int): Deepest zoom level with cluster aggregates.
+
+    Returns:
+        TileSet: The built tiles.
+    """
+    rows = _latest_rows(layout)
+    positions = np.asarray(layout.matrix(), dtype=np.float32)[rows]
+    all_labels = np.full(len(layout), -1, dtype=np.int16) if labels is None else np.asarray(labels[:len(layout)], dtype=np.int16)
+    labels = all_labels[rows]
+    priorities = track_priorities([layout.ids[r] for r in rows])
+
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    # A square, padded bounding box keeps tiles square on screen
+    centre, half = (low + high) / 2, max(float((high - low).max()), 1e-6) * (0.5 + BOUNDS_MARGIN)
+    bounds = (float(centre[0] - half), float(centre[1] - half), float(centre[0] + half), float(centre[1] + half))
+
+    # Write into a fresh directory and swap it in, so readers never see a half-built pyramid
+    tmp_path = path.rstrip('/\\') + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    for zoom in range(max_zoom + 1):
+        keys = _tile_keys(positions, bounds, zoom)
+        # Sorted by tile, then priority, so each tile's kept points lead its run
+        order = np.lexsort((priorities, keys))
+        starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        for start, stop in zip(starts, np.append(starts[1:], len(order))):
+            members = order[start:stop] if zoom <= aggregate_zoom else order[start:min(stop, start + capacity)]
+            key = int(keys[members[0]])
+            points, aggregates = _tile_contents(rows[members], positions[members], labels[members], priorities[members], zoom <= aggregate_zoom, capacity)
+            _write_tile(os.path.join(tmp_path, str(zoom), str(key >> zoom), f"{key & ((1 << zoom) - 1)}.bin"), points, aggregates)
+
+    manifest = {
+        'bounds': bounds,
+        'max_zoom': max_zoom,
+        'capacity': capacity,
+        'aggregate_zoom': aggregate_zoom,
+        'synced_rows': len(layout),
+        'layout_inode': os.stat(layout.matrix_path).st_ino,
+        'labels_digest': _labels_digest(all_labels)
+    }
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    old_path = path.rstrip('/\\') + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return TileSet(path)
+
+def update_tiles(layout, labels: np.ndarray | None = None, path: str = TILES_PATH) -> TileSet:
+    """
+    Brings a tile pyramid up to date with a layout, rewriting only the tiles
+    that new layout rows fall in.
+
+    A tile keeps its highest-priority points, so merging its current points
+    with the new ones gives the same tile as a full rebuild would. The pyramid
+    is rebuilt instead when the layout was rewritten (e.g. after a projection
+    refit), when a track moved because it was re-embedded, when new tracks
+    fall outside the bounds, or when the labels of tiled tracks changed (e.g.
+    the clustering was first seeded, or refit).
+
+    Args:
+        layout (EmbeddingStore): The map layout.
+        labels (np.ndarray | None): Cluster of every layout row (-1 if unknown).
+        path (str): The tiles directory.
+
+    Returns:
+        TileSet: The updated tiles.
+    """
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return build_tiles(layout, labels, path)
+    tiles = TileSet(path)
+    manifest = tiles.manifest
+    synced = manifest['synced_rows']
+    if manifest['layout_inode'] != os.stat(layout.matrix_path).st_ino or len(layout) < synced:
+        return build_tiles(layout, labels, path, manifest['max_zoom'], manifest['capacity'], manifest['aggregate_zoom'])
+    labels = np.full(len(layout), -1, dtype=np.int16) if labels is None else np.asarray(labels[:len(layout)], dtype=np.int16)
+    if manifest.get('labels_digest') != _labels_digest(labels[:synced]):
+        return build_tiles(layout, labels, path, manifest['max_zoom'], manifest['capacity'], manifest['aggregate_zoom'])
+    if len(layout) == synced:
+        return tiles
+
+    new_ids = layout.ids[synced:]
+    positions = np.asarray(layout.matrix()[synced:], dtype=np.float32)
+    x0, y0, x1, y1 = tiles.bounds
+    moved = not set(new_ids).isdisjoint(layout.ids[:synced]) or len(set(new_ids)) < len(new_ids)
+    outside = np.any((positions[:, 0] < x0) | (positions[:, 0] > x1) | (positions[:, 1] < y0) | (positions[:, 1] > y1))
+    if moved or outside:
+        return build_tiles(layout, labels, path, manifest['max_zoom'], manifest['capacity'], manifest['aggregate_zoom'])
+
+    rows = np.arange(synced, len(layout), dtype=np.int64)
+    new_labels = labels[synced:]
+    for zoom in range(manifest['max_zoom'] + 1):
+        keys = _tile_keys(positions, tiles.bounds, zoom)
+        # Group the new rows by tile with one sort, as build_tiles does
+        order = np.argsort(keys, kind='stable')
+        starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        for start, stop in zip(starts, np.append(starts[1:], len(order))):
+            members = order[start:stop]
+            key = int(keys[members[0]])
+            x, y = key >> zoom, key & ((1 << zoom) - 1)
+            old_points, old_aggregates = tiles._read_tile(zoom, x, y)
+
+            merged_rows = np.concatenate([old_points['row'].astype(np.int64), rows[members]])
+            merged_positions = np.concatenate([np.stack([old_points['x'], old_points['y']], axis=1), positions[members]])
+            merged_labels = np.concatenate([old_points['cluster'], new_labels[members]])
+            priorities = track_priorities([layout.ids[r] for r in merged_rows])
+            points, _ = _tile_contents(merged_rows, merged_positions, merged_labels, priorities, False, manifest['capacity'])
+
+            aggregates = old_aggregates
+            if zoom <= manifest['aggregate_zoom']:
+                _, new_aggregates = _tile_contents(rows[members], positions[members], new_labels[members], priorities[len(old_points):], True, 0)
+                aggregates = _merge_aggregates(np.concatenate([old_aggregates, new_aggregates]))
+            _write_tile(tiles.tile_path(zoom, x, y), points, aggregates)
+
+    manifest['synced_rows'] = len(layout)
+    manifest['labels_digest'] = _labels_digest(labels)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    return TileSet(path)
+
+def update_catalog_tiles(layout=None, path: str = TILES_PATH):
+    """
+    Brings the catalog's map tiles up to date with its layout and clusters.
+
+    Args:
+        layout (EmbeddingStore | None): The map layout. Defaults to the saved one.
+        path (str): The tiles directory.
+
+    Returns:
+        TileSet | None: The tiles, or None if there is no layout yet.
+    """
+    from src.map.clustering import CLUSTERS_PATH, MiniBatchKMeans
+    from src.map.projection import LAYOUT_PATH
+    from src.storage.embedding_store import EmbeddingStore
+
+    if layout is None:
+        if not os.path.exists(LAYOUT_PATH + '.npy'):
+            return None
+        layout = EmbeddingStore(LAYOUT_PATH, dim=2)
+    if len(layout) == 0:
+        return None
+
+    # The clustering is row-aligned with the embedding store, as the layout is
+    labels = np.full(len(layout), -1, dtype=np.int16)
+    if os.path.exists(CLUSTERS_PATH):
+        assignments = MiniBatchKMeans.load(CLUSTERS_PATH).assignments[:len(layout)]
+        labels[:len(assignments)] = assignments
+    tiles = update_tiles(layout, labels, path)
+    print(f"{Style.BRIGHT}[Tiles]: {Style.NORMAL}{Fore.GREEN}Map tiles at {path} cover {tiles.manifest['synced_rows']} layout rows.{Style.RESET_ALL}")
+    return tiles
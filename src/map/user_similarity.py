@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Playlist- and user-level comparisons between sets of songs.
+
+A batch of song sets (playlists, or users' likes) is held as one stacked
+embedding matrix plus the offset at which each set starts, so every
+comparison runs as a handful of matrix operations over all sets at once:
+    - Summary vectors: each set's mean, element-wise max and covariance,
+      compared by cosine similarity.
+    - MMD: the maximum mean discrepancy between two sets' distributions under
+      an RBF kernel, estimated with random Fourier features so it costs one
+      projection of every track rather than a kernel over all track pairs.
+    - Chamfer: how close each song of one set is to its nearest song in the
+      other, averaged and symmetrized. Computed block by block so memory
+      stays bounded.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import numpy as np
+
+BLOCK_SIZE = 8192  # Tracks processed per block
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _cosine_matrix(vectors: np.ndarray) -> np.ndarray:
+    vectors = _normalize(vectors.reshape(len(vectors), -1))
+    return vectors @ vectors.T
+
+class SongSets:
+    def __init__(self, embeddings: np.ndarray, offsets: np.ndarray, names: list | None = None):
+        """
+        Initializes a batch of song sets.
+
+        Args:
+            embeddings (np.ndarray): The stacked embeddings of every set, shape [T, dim].
+            offsets (np.ndarray): Start row of each set plus the end, shape [N + 1].
+            names (list | None): Name of each set. Defaults to their indices.
+        """
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.offsets) - 1)]
+        if np.any(np.diff(self.offsets) == 0):
+            raise ValueError("Every song set needs at least one embedded track.")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.embeddings[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def set_of_row(self) -> np.ndarray:
+        """
+        The set index of every stacked row.
+        """
+        return np.repeat(np.arange(len(self)), self.sizes)
+
+    @classmethod
+    def from_list(cls, sets: list, names: list | None = None) -> 'SongSets':
+        """
+        Stacks a list of per-set embedding matrices.
+
+        Args:
+            sets (list): One [n_i, dim] matrix per set.
+            names (list | None): Name of each set.
+
+        Returns:
+            SongSets: The batch.
+        """
+        offsets = np.concatenate([[0], np.cumsum([len(s) for s in sets])])
+        return cls(np.concatenate(sets), offsets, names)
+
+    @classmethod
+    def from_collections(cls, names: list, catalog=None) -> 'SongSets':
+        """
+        Loads catalog collections (playlists or likes) as song sets. Tracks
+        without an embedding are left out, as are collections with none.
+
+        Args:
+            names (list): The collection names.
+            catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+
+        Returns:
+            SongSets: The batch.
+        """
+        if catalog is None:
+            from src.storage.track_catalog import TrackCatalog
+            catalog = TrackCatalog()
+
+        sets, kept = [], []
+        for name in names:
+            matrix, _ = catalog.get_embedding_matrix(catalog.collection_track_ids(name))
+            if len(matrix):
+                sets.append(matrix)
+                kept.append(name)
+        return cls.from_list(sets, kept)
+
+    def sample(self, max_size: int, seed: int = 0) -> 'SongSets':
+        """
+        Caps every set at max_size tracks by sampling without replacement.
+
+        Args:
+            max_size (int): Maximum tracks per set.
+            seed (int): Random seed.
+
+        Returns:
+            SongSets: The sampled batch (self if no set is larger).
+        """
+        if self.sizes.max() <= max_size:
+            return self
+        rng = np.random.default_rng(seed)
+        rows = [
+            start + np.sort(rng.choice(size, min(size, max_size), replace=False))
+            for start, size in zip(self.offsets[:-1], self.sizes)
+        ]
+        return SongSets.from_list([self.embeddings[r] for r in rows], self.names)
+
+    def means(self) -> np.ndarray:
+        """
+        Mean embedding of each set, shape [N, dim].
+        """
+        return np.add.reduceat(self.embeddings, self.offsets[:-1], axis=0) / self.sizes[:, np.newaxis]
+
+    def maxes(self) -> np.ndarray:
+        """
+        Element-wise max embedding of each set, shape [N, dim].
+        """
+        return np.maximum.reduceat(self.embeddings, self.offsets[:-1], axis=0)
+
+    def covariances(self) -> np.ndarray:
+        """
+        Covariance of each set's embeddings, shape [N, dim, dim].
+        """
+        centred = self.embeddings - np.repeat(self.means(), self.sizes, axis=0)
+        covariances = np.empty((len(self), self.embeddings.shape[1], self.embeddings.shape[1]), dtype=np.float32)
+        for i in range(len(self)):
+            block = centred[self.offsets[i]:self.offsets[i + 1]]
+            covariances[i] = block.T @ block / max(len(block) - 1, 1)
+        return covariances
+
+def summary_similarity(sets: SongSets, summary: str = 'mean') -> np.ndarray:
+    """
+    Cosine similarity between every pair of sets' summary vectors.
+
+    Args:
+        sets (SongSets): The song sets.
+        summary (str): 'mean', 'max' or 'covariance'.
+
+    Returns:
+        np.ndarray: Similarity matrix of shape [N, N].
+    """
+    if summary == 'mean':
+        return _cosine_matrix(sets.means())
+    if summary == 'max':
+        return _cosine_matrix(sets.maxes())
+    if summary == 'covariance':
+        return _cosine_matrix(sets.covariances())
+    raise ValueError(f"Unknown summary '{summary}', expected 'mean', 'max' or 'covariance'.")
+
+def median_bandwidth(embeddings: np.ndarray, sample_size: int = 2000, seed: int = 0) -> float:
+    """
+    The median pairwise distance of a sample, a standard RBF bandwidth choice.
+    """
+    rng = np.random.default_rng(seed)
+    sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), sample_size), replace=False)]
+    sq_norms = np.einsum('ij,ij->i', sample, sample)
+    sq_dist = sq_norms[:, np.newaxis] - 2.0 * (sample @ sample.T) + sq_norms
+    return float(np.sqrt(np.median(np.maximum(sq_dist[np.triu_indices(len(sample), 1)], 0.0))))
+
+def mmd_matrix(sets: SongSets, bandwidth: float | None = None, n_features: int = 2048, seed: int = 0) -> np.ndarray:
+    """
+    Squared maximum mean discrepancy between every pair of sets under an RBF
+    kernel, estimated with random Fourier features. Each set is mapped to the
+    mean of its tracks' features, and MMD^2 is the squared distance between
+    those means; all pairs come from one Gram matrix.
+
+    Args:
+        sets (SongSets): The song sets.
+        bandwidth (float | None): RBF length scale. Defaults to the median heuristic.
+        n_features (int): Random features; more gives a tighter estimate.
+        seed (int): Random seed.
+
+    Returns:
+        np.ndarray: MMD^2 matrix of shape [N, N] (0 on the diagonal, lower is more similar).
+    """
+    bandwidth = bandwidth or median_bandwidth(sets.embeddings, seed=seed)
+    rng = np.random.default_rng(seed)
+    dim = sets.embeddings.shape[1]
+    weights = (rng.standard_normal((dim, n_features)) / bandwidth).astype(np.float32)
+    phases = rng.uniform(0, 2 * np.pi, n_features).astype(np.float32)
+
+    # Mean feature vector of each set, a block of tracks at a time
+    feature_sums = np.zeros((len(sets), n_features), dtype=np.float64)
+    set_of_row = sets.set_of_row
+    for start in range(0, len(sets.embeddings), BLOCK_SIZE):
+        stop = start + BLOCK_SIZE
+        features = np.cos(sets.embeddings[start:stop] @ weights + phases)
+        groups = set_of_row[start:stop]
+        bounds = np.flatnonzero(np.diff(groups, prepend=-1))
+        feature_sums[groups[bounds]] += np.add.reduceat(features, bounds, axis=0)
+    means = feature_sums * np.sqrt(2.0 / n_features) / sets.sizes[:, np.newaxis]
+
+    gram = means @ means.T
+    sq_norms = np.diag(gram)
+    return np.maximum(sq_norms[:, np.newaxis] + sq_norms - 2.0 * gram, 0.0)
+
+def chamfer_matrix(sets: SongSets, max_set_size: int | None = 128, block_size: int = BLOCK_SIZE, seed: int = 0) -> np.ndarray:
+    """
+    Symmetric Chamfer similarity between every pair of sets: for each song,
+    the cosine similarity of its nearest song in the other set, averaged over
+    the set and then over both directions.
+
+    The cost is quadratic in the total number of tracks, so large sets are
+    sampled down to max_set_size first. Tracks are compared in blocks of
+    block_size against blocks of whole sets, so memory stays bounded.
+
+    Args:
+        sets (SongSets): The song sets.
+        max_set_size (int | None): Tracks sampled per set. None to use every track.
+        block_size (int): Tracks per block.
+        seed (int): Random seed for the sampling.
+
+    Returns:
+        np.ndarray: Similarity matrix of shape [N, N] (higher is more similar).
+    """
+    if max_set_size is not None:
+        sets = sets.sample(max_set_size, seed)
+    embeddings = _normalize(sets.embeddings)
+    offsets = sets.offsets
+    n = len(sets)
+
+    # Column blocks hold whole sets, so per-set maxima can be taken within a block
+    column_blocks, first = [], 0
+    while first < n:
+        last = first + 1
+        while last < n and offsets[last + 1] - offsets[first] <= block_size:
+            last += 1
+        column_blocks.append((first, last))
+        first = last
+
+    # directed[i, j]: mean over songs of set i of their best match in set j
+    directed = np.zeros((n, n), dtype=np.float64)
+    set_of_row = sets.set_of_row
+    for row_start in range(0, len(embeddings), block_size):
+        rows = embeddings[row_start:row_start + block_size]
+        groups = set_of_row[row_start:row_start + block_size]
+        bounds = np.flatnonzero(np.diff(groups, prepend=-1))
+        best = np.empty((len(rows), n), dtype=np.float32)
+        for first, last in column_blocks:
+            sims = rows @ embeddings[offsets[first]:offsets[last]].T
+            best[:, first:last] = np.maximum.reduceat(sims, offsets[first:last] - offsets[first], axis=1)
+        directed[groups[bounds]] += np.add.reduceat(best, bounds, axis=0)
+    directed /= sets.sizes[:, np.newaxis]
+    return (directed + directed.T) / 2.0
+
+def similarity_frame(sets: SongSets, method: str = 'mean', **kwargs) -> 'pd.DataFrame':
+    """
+    Compares every pair of song sets and labels the result with their names.
+
+    Args:
+        sets (SongSets): The song sets.
+        method (str): 'mean', 'max', 'covariance', 'mmd' or 'chamfer'.
+        **kwargs: Passed to mmd_matrix or chamfer_matrix.
+
+    Returns:
+        pd.DataFrame: The [N, N] matrix indexed by set name. MMD is a
+            distance; the other methods are similarities.
+    """
+    if method == 'mmd':
+        matrix = mmd_matrix(sets, **kwargs)
+    elif method == 'chamfer':
+        matrix = chamfer_matrix(sets, **kwargs)
+    else:
+        matrix = summary_similarity(sets, method)
+    import pandas as pd
+    return pd.DataFrame(matrix, index=sets.names, columns=sets.names)
+
+def compare_collections(names: list, method: str = 'mean', catalog=None, **kwargs) -> 'pd.DataFrame':
+    """
+    Compares catalog collections (playlists or users' likes) pairwise.
+
+    Args:
+        names (list): The collection names.
+        method (str): 'mean', 'max', 'covariance', 'mmd' or 'chamfer'.
+        catalog (TrackCatalog | None): The catalog. Defaults to the shared catalog.
+        **kwargs: Passed to mmd_matrix or chamfer_matrix.
+
+    Returns:
+        pd.DataFrame: The labelled [N, N] matrix.
+    """
+    return similarity_frame(SongSets.from_collections(names, catalog), method, **kwargs)
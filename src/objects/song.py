@@ -17,6 +17,7 @@ from colorama import Fore, Style
 import numpy as np
 import pandas as pd
 from typing import Tuple
+from src.objects.waveform_cache import WaveformHandle
 
 
 """
@@ -28,14 +29,20 @@ album: str
 duration: float
 spotify_url: str
 youtube_url: str
-waveform: np.ndarray
+waveform: WaveformHandle
 embedding: np.ndarray
 """
 class Song:
+    # A Song is a view into one row of a SongTable; it holds no data itself.
+    __slots__ = ('_table', '_row')
+
     def __init__(self, db_id: int, spotify_id: str, name: str, artists: list[str], album: str, duration: float, spotify_url: str, youtube_url: str | None, waveform: np.ndarray | None, embedding: np.ndarray | None):
         """
         Initializes a new instance of the Song class.
 
+        A standalone Song is backed by its own one-row SongTable. Songs taken
+        from a larger SongTable (table[i]) are views created with Song.view.
+
         Args:
         - db_id: int
             The unique identifier of the song in the database.
@@ -50,24 +57,95 @@ class Song:
         - duration: float
             The duration of the song.
         - spotify_url: str
-            The Spotify URL of the song.
+            The Spotify URL of the song (derived from spotify_id).
         - youtube_url: str
             The YouTube URL of the song.
         - waveform: np.ndarray
-            The waveform of the song.
+            The 16 kHz mono waveform of the song, saved to the waveform cache.
         - embedding: np.ndarray
             The embedding of the song.
         """
-        self.db_id = db_id
-        self.spotify_id = spotify_id
-        self.name = name
-        self.artists = artists
-        self.album = album
-        self.duration = duration
-        self.spotify_url = spotify_url
-        self.youtube_url = youtube_url
-        self.waveform = waveform
-        self.embedding = embedding
+        from src.objects.song_table import SongTable
+        table = SongTable.from_records([{
+            'db_id': db_id,
+            'spotify_id': spotify_id,
+            'name': name,
+            'artists': artists,
+            'album': album,
+            'duration': duration,
+            'youtube_url': youtube_url,
+            'waveform': waveform,
+            'embedding': embedding
+        }])
+        self._table = table
+        self._row = 0
+
+    @classmethod
+    def view(cls, table, row: int) -> 'Song':
+        """
+        Creates a Song view of a SongTable row without copying any data.
+
+        Args:
+        - table: SongTable
+            The table holding the song.
+        - row: int
+            The row of the song in the table.
+
+        Returns:
+        - Song
+        """
+        song = cls.__new__(cls)
+        song._table = table
+        song._row = row
+        return song
+
+    @property
+    def db_id(self) -> int:
+        return int(self._table.db_ids[self._row])
+
+    @property
+    def spotify_id(self) -> str:
+        return self._table.spotify_ids[self._row]
+
+    @property
+    def name(self) -> str:
+        return self._table.names[self._row]
+
+    @property
+    def artists(self) -> list[str]:
+        from src.objects.song_table import ARTIST_SEPARATOR
+        artists = self._table.artists[self._row]
+        return artists.split(ARTIST_SEPARATOR) if artists else []
+
+    @property
+    def album(self) -> str:
+        return self._table.albums[self._row]
+
+    @property
+    def duration(self) -> float:
+        return float(self._table.durations[self._row])
+
+    @property
+    def spotify_url(self) -> str:
+        from src.objects.song_table import SPOTIFY_TRACK_URL
+        return SPOTIFY_TRACK_URL + self.spotify_id
+
+    @property
+    def youtube_url(self) -> str | None:
+        return self._table.youtube_urls[self._row]
+
+    @property
+    def waveform(self) -> WaveformHandle:
+        """
+        A lazy handle to the song's 16 kHz waveform. Samples are decoded or
+        memory-mapped on first access (handle.load() or np.asarray(handle))
+        and held in the process-wide, byte-capped waveform cache.
+        """
+        return WaveformHandle(self.spotify_id)
+
+    @property
+    def embedding(self) -> np.ndarray | None:
+        return self._table.get_embedding(self._row)
 
     def __str__(self) -> str:
         """
@@ -87,7 +165,7 @@ class Song:
         - embedding: np.ndarray
             The new embedding of the song.
         """
-        self.embedding = embedding
+        self._table.set_embedding(self._row, embedding)
     
     def update_waveform(self, waveform: np.ndarray):
         """
@@ -95,11 +173,10 @@ class Song:
 
         Args:
         - waveform: np.ndarray
-            The new waveform of the song.
+            The new 16 kHz mono waveform of the song.
         """
-        self.waveform = waveform
+        self.waveform.store(waveform)
 
-    @classmethod
     def to_dict(self) -> dict:
         """
         Converts the Song object to a dictionary.
@@ -121,7 +198,6 @@ class Song:
             'embedding': self.embedding
         }
     
-    @classmethod
     def to_pd_series(self) -> pd.Series:
         """
         Converts the Song object to a Pandas Series.
@@ -130,4 +206,4 @@ class Song:
         - pd.Series
             A Pandas Series representation of the Song object.
         """
-        return pd.Series(self.to_dict())
\ No newline at end of file
+        return pd.Series(self.to_dict())
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+This script contains the SongTable class, a compact struct-of-arrays
+collection of songs.
+
+Strings are dictionary-encoded into a single UTF-8 buffer per column, numbers
+live in typed NumPy arrays and embeddings in one contiguous float32 matrix
+(which may be a memory-mapped EmbeddingStore matrix). Waveforms are not held
+at all; Song.waveform hands out lazy handles (see waveform_cache.py). A 1M-track catalog's
+metadata takes tens of MB instead of the GBs a list of Song objects would.
+Individual rows are exposed as lightweight Song views (see song.py).
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import math
+import numpy as np
+import pandas as pd
+from src.objects.waveform_cache import WaveformHandle
+
+EMBEDDING_DIM = 128
+ARTIST_SEPARATOR = '\x1f'  # Unit separator, never part of an artist name
+SPOTIFY_TRACK_URL = "https://open.spotify.com/track/"
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+class StringColumn:
+    """
+    A dictionary-encoded string column.
+
+    Each distinct string is stored once, UTF-8 encoded, in a shared byte
+    buffer; rows hold an int32 code into it (-1 for missing values).
+    """
+    __slots__ = ('codes', '_data', '_offsets', '_vocab')
+
+    def __init__(self, codes: np.ndarray, data: np.ndarray, offsets: np.ndarray):
+        self.codes = codes
+        self._data = data
+        self._offsets = offsets
+        self._vocab = None
+
+    @classmethod
+    def from_values(cls, values) -> 'StringColumn':
+        """
+        Interns an iterable of strings (None/NaN for missing values).
+        """
+        values = list(values)
+        lookup = {}
+        codes = np.empty(len(values), dtype=np.int32)
+        chunks = []
+        offsets = [0]
+        for i, value in enumerate(values):
+            if _is_missing(value):
+                codes[i] = -1
+                continue
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(lookup)
+                encoded = str(value).encode('utf-8')
+                chunks.append(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            codes[i] = code
+        offset_dtype = np.int32 if offsets[-1] < 2**31 else np.int64
+        return cls(codes, np.frombuffer(b''.join(chunks), dtype=np.uint8), np.array(offsets, dtype=offset_dtype))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def _decode(self, code: int) -> str:
+        return self._data[self._offsets[code]:self._offsets[code + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, i: int) -> str | None:
+        code = self.codes[i]
+        return None if code < 0 else self._decode(code)
+
+    def vocabulary(self) -> list:
+        """
+        Decodes every distinct string once (cached until the column changes).
+        """
+        if self._vocab is None:
+            self._vocab = [self._decode(c) for c in range(len(self._offsets) - 1)]
+        return self._vocab
+
+    def values(self) -> list:
+        """
+        Decodes the column into a list of strings (None for missing values).
+        """
+        vocab = self.vocabulary()
+        return [vocab[c] if c >= 0 else None for c in self.codes.tolist()]
+
+    def code_of(self, value: str) -> int:
+        """
+        Finds the code of a string, or -1 if it isn't in the column's vocabulary.
+        """
+        encoded = value.encode('utf-8')
+        lengths = np.diff(self._offsets)
+        for code in np.flatnonzero(lengths == len(encoded)):
+            if self._data[self._offsets[code]:self._offsets[code + 1]].tobytes() == encoded:
+                return int(code)
+        return -1
+
+    def __setitem__(self, i: int, value: str | None):
+        if _is_missing(value):
+            self.codes[i] = -1
+            return
+        code = self.code_of(value)
+        if code < 0:
+            encoded = np.frombuffer(value.encode('utf-8'), dtype=np.uint8)
+            self._data = np.concatenate([self._data, encoded])
+            self._offsets = np.append(self._offsets, self._offsets[-1] + len(encoded))
+            self._vocab = None
+            code = len(self._offsets) - 2
+        self.codes[i] = code
+
+    def take(self, indices: np.ndarray) -> 'StringColumn':
+        """
+        Selects rows, sharing the vocabulary buffer with this column.
+        """
+        return StringColumn(self.codes[indices], self._data, self._offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self._data.nbytes + self._offsets.nbytes
+
+class SongTable:
+    def __init__(self, db_ids: np.ndarray, spotify_ids: StringColumn, names: StringColumn, artists: StringColumn,
+                 albums: StringColumn, durations: np.ndarray, youtube_urls: StringColumn,
+                 embeddings: np.ndarray | None = None, embedding_rows: np.ndarray | None = None):
+        """
+        Initializes a new instance of the SongTable class.
+
+        Prefer the from_* constructors over calling this directly.
+
+        Args:
+        - db_ids: np.ndarray
+            int64 database identifiers, one per song.
+        - spotify_ids, names, artists, albums, youtube_urls: StringColumn
+            Interned string columns. Artists are joined by ARTIST_SEPARATOR.
+        - durations: np.ndarray
+            float32 durations in seconds.
+        - embeddings: np.ndarray | None
+            Embedding matrix of shape [num_rows, 128], possibly memory-mapped.
+        - embedding_rows: np.ndarray | None
+            int32 row of each song in `embeddings`, or -1 if it has none.
+        """
+        self.db_ids = db_ids
+        self.spotify_ids = spotify_ids
+        self.names = names
+        self.artists = artists
+        self.albums = albums
+        self.durations = durations
+        self.youtube_urls = youtube_urls
+        if embeddings is None:
+            embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        if embedding_rows is None:
+            embedding_rows = np.full(len(db_ids), -1, dtype=np.int32)
+        self.embeddings = embeddings
+        self.embedding_rows = embedding_rows
+
+    def __len__(self) -> int:
+        return len(self.db_ids)
+
+    def __getitem__(self, i: int):
+        """
+        Returns a lightweight Song view of row i.
+        """
+        from src.objects.song import Song
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Row {i} out of range for SongTable of length {len(self)}.")
+        return Song.view(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_records(cls, records: list) -> 'SongTable':
+        """
+        Builds a table from dictionaries with Song.to_dict keys.
+
+        Args:
+        - records: list[dict]
+            Song dictionaries; 'waveform' and 'embedding' may be None. Given
+            waveforms are written to the decoded waveform cache on disk.
+
+        Returns:
+        - SongTable
+        """
+        table = cls(
+            db_ids=np.array([r['db_id'] for r in records], dtype=np.int64),
+            spotify_ids=StringColumn.from_values(r['spotify_id'] for r in records),
+            names=StringColumn.from_values(r['name'] for r in records),
+            artists=StringColumn.from_values(ARTIST_SEPARATOR.join(r['artists']) for r in records),
+            albums=StringColumn.from_values(r['album'] for r in records),
+            durations=np.array([r['duration'] for r in records], dtype=np.float32),
+            youtube_urls=StringColumn.from_values(r.get('youtube_url') for r in records),
+        )
+        embedded = [i for i, r in enumerate(records) if r.get('embedding') is not None]
+        if embedded:
+            table.embeddings = np.stack([np.asarray(records[i]['embedding'], dtype=np.float32) for i in embedded])
+            table.embedding_rows[embedded] = np.arange(len(embedded))
+        for r in records:
+            if r.get('waveform') is not None:
+                WaveformHandle(r['spotify_id']).store(r['waveform'])
+        return table
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, embeddings: np.ndarray | None = None, embedding_ids: list | None = None) -> 'SongTable':
+        """
+        Builds a table from a playlist TSV dataframe in one pass per column.
+
+        Args:
+        - df: pd.DataFrame
+            Rows in the playlist TSV format ('Track ID', 'Track Name', 'Artists',
+            'Album', 'Song Length (s)', optionally 'YouTube Link').
+        - embeddings: np.ndarray | None
+            Embedding matrix, e.g. an EmbeddingStore's memory-mapped matrix.
+        - embedding_ids: list | None
+            The track ID of each row of `embeddings`.
+
+        Returns:
+        - SongTable
+        """
+        track_ids = df['Track ID'].astype(str)
+        artists = df['Artists'].fillna('').astype(str).str.replace(', ', ARTIST_SEPARATOR, regex=False)
+        table = cls(
+            db_ids=np.arange(len(df), dtype=np.int64),
+            spotify_ids=StringColumn.from_values(track_ids),
+            names=StringColumn.from_values(df['Track Name']),
+            artists=StringColumn.from_values(artists),
+            albums=StringColumn.from_values(df['Album'] if 'Album' in df.columns else [None] * len(df)),
+            durations=df['Song Length (s)'].to_numpy(dtype=np.float32),
+            youtube_urls=StringColumn.from_values(df['YouTube Link'] if 'YouTube Link' in df.columns else [None] * len(df)),
+        )
+        if embeddings is not None:
+            table.attach_embeddings(embeddings, embedding_ids)
+        return table
+
+    def attach_embeddings(self, embeddings: np.ndarray, embedding_ids: list):
+        """
+        Points the table at an embedding matrix without copying it.
+
+        Args:
+        - embeddings: np.ndarray
+            Matrix of shape [num_rows, 128], e.g. EmbeddingStore.matrix().
+        - embedding_ids: list
+            The track ID of each row of `embeddings`. Later rows win on duplicates.
+        """
+        row_of = pd.Series(np.arange(len(embedding_ids)), index=pd.Index(embedding_ids, dtype=object))
+        row_of = row_of[~row_of.index.duplicated(keep='last')]
+        rows = row_of.reindex(self.spotify_ids.values()).to_numpy()
+        self.embeddings = embeddings
+        self.embedding_rows = np.where(np.isnan(rows), -1, rows).astype(np.int32)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Converts the table to a playlist TSV-format dataframe.
+
+        Returns:
+        - pd.DataFrame
+        """
+        track_ids = self.spotify_ids.values()
+        return pd.DataFrame({
+            'Track ID': track_ids,
+            'Track Name': self.names.values(),
+            'Track Url': [SPOTIFY_TRACK_URL + t for t in track_ids],
+            'Artists': [a.replace(ARTIST_SEPARATOR, ', ') if a is not None else None for a in self.artists.values()],
+            'Album': self.albums.values(),
+            'Song Length (s)': self.durations,
+            'YouTube Link': self.youtube_urls.values(),
+        })
+
+    def take(self, indices: np.ndarray) -> 'SongTable':
+        """
+        Selects rows by index. String vocabularies and the embedding matrix
+        are shared with this table, not copied.
+
+        Args:
+        - indices: np.ndarray
+            Row indices to keep.
+
+        Returns:
+        - SongTable
+        """
+        indices = np.asarray(indices)
+        return SongTable(
+            db_ids=self.db_ids[indices],
+            spotify_ids=self.spotify_ids.take(indices),
+            names=self.names.take(indices),
+            artists=self.artists.take(indices),
+            albums=self.albums.take(indices),
+            durations=self.durations[indices],
+            youtube_urls=self.youtube_urls.take(indices),
+            embeddings=self.embeddings,
+            embedding_rows=self.embedding_rows[indices],
+        )
+
+    def filter(self, mask: np.ndarray) -> 'SongTable':
+        """
+        Selects the rows where a boolean mask is True.
+
+        Args:
+        - mask: np.ndarray
+            Boolean array of length len(self).
+
+        Returns:
+        - SongTable
+        """
+        return self.take(np.flatnonzero(mask))
+
+    def equals(self, column: str, value: str) -> np.ndarray:
+        """
+        Vectorized equality test on a string column.
+
+        Args:
+        - column: str
+            One of 'spotify_ids', 'names', 'albums', 'youtube_urls'.
+        - value: str
+            The value to compare against.
+
+        Returns:
+        - np.ndarray
+            Boolean mask of matching rows.
+        """
+        col = getattr(self, column)
+        code = col.code_of(value)
+        return col.codes == code if code >= 0 else np.zeros(len(self), dtype=bool)
+
+    def has_artist(self, artist: str) -> np.ndarray:
+        """
+        Vectorized test for songs credited to an artist.
+
+        The test runs once per distinct artist string, not once per song.
+
+        Returns:
+        - np.ndarray
+            Boolean mask of matching rows.
+        """
+        matches = np.array([artist in a.split(ARTIST_SEPARATOR) for a in self.artists.vocabulary()], dtype=bool)
+        codes = self.artists.codes
+        return (codes >= 0) & np.append(matches, False)[codes]
+
+    def duration_between(self, low: float, high: float) -> np.ndarray:
+        """
+        Vectorized duration range test, in seconds (inclusive).
+
+        Returns:
+        - np.ndarray
+            Boolean mask of matching rows.
+        """
+        return (self.durations >= low) & (self.durations <= high)
+
+    def has_embedding(self) -> np.ndarray:
+        """
+        Returns:
+        - np.ndarray
+            Boolean mask of rows that have an embedding.
+        """
+        return self.embedding_rows >= 0
+
+    def embedding_matrix(self) -> np.ndarray:
+        """
+        Gathers the embeddings of the rows that have one, in row order.
+
+        Returns:
+        - np.ndarray
+            float32 matrix of shape [has_embedding().sum(), 128].
+        """
+        rows = self.embedding_rows[self.embedding_rows >= 0]
+        return np.asarray(self.embeddings[rows], dtype=np.float32)
+
+    def get_embedding(self, i: int) -> np.ndarray | None:
+        row = self.embedding_rows[i]
+        return None if row < 0 else self.embeddings[row]
+
+    def set_embedding(self, i: int, embedding: np.ndarray | None):
+        """
+        Sets the embedding of row i.
+
+        The vector is appended to the table's matrix (copying a memory-mapped
+        matrix into memory), so this is meant for occasional updates. Bulk
+        embeddings belong in an EmbeddingStore attached with attach_embeddings.
+        """
+        if embedding is None:
+            self.embedding_rows[i] = -1
+            return
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        self.embeddings = np.concatenate([self.embeddings, embedding])
+        self.embedding_rows[i] = len(self.embeddings) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate resident size of the metadata columns, in bytes.
+        Memory-mapped embeddings are not counted.
+        """
+        total = self.db_ids.nbytes + self.durations.nbytes + self.embedding_rows.nbytes
+        total += sum(c.nbytes for c in (self.spotify_ids, self.names, self.artists, self.albums, self.youtube_urls))
+        if not isinstance(self.embeddings, np.memmap):
+            total += self.embeddings.nbytes
+        return total
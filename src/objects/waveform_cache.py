@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Lazy waveform handles backed by a process-wide LRU cache with a byte budget.
+
+A WaveformHandle only knows which song it belongs to. The first time its
+samples are needed, the downloaded audio is decoded once to 16 kHz mono
+float32 and saved next to it as sp_id_<id>.16k.npy. Every later access
+memory-maps that file. Loaded arrays are kept in a shared LRU that evicts the
+least recently used waveforms once the budget is exceeded. Code can iterate
+over many songs and touch their waveforms freely while resident memory stays
+capped.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import threading
+from collections import OrderedDict
+from typing import Callable
+import numpy as np
+from src.utils.config import config
+
+WAVEFORM_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['audio_destination_path'][1:])
+CACHE_BUDGET_BYTES = int(config['settings']['waveform_cache_mb'] * 1024 * 1024)
+SAMPLE_RATE = 16000
+
+class WaveformCache:
+    def __init__(self, budget_bytes: int):
+        """
+        Initializes a new instance of the WaveformCache class.
+
+        Args:
+            budget_bytes (int): Maximum total size of the cached arrays.
+        """
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, loader: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Returns the cached array for a key, loading it on a miss.
+
+        Args:
+            key (str): The cache key.
+            loader (Callable): Loads the array when it isn't cached.
+
+        Returns:
+            np.ndarray: The array.
+        """
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return array
+            self.misses += 1
+        # Load outside the lock so slow decodes don't block other threads
+        array = loader()
+        self.put(key, array)
+        return array
+
+    def put(self, key: str, array: np.ndarray):
+        """
+        Adds an array to the cache, evicting least recently used entries to
+        stay within the budget. Arrays larger than the budget aren't cached.
+
+        Args:
+            key (str): The cache key.
+            array (np.ndarray): The array.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if array.nbytes > self.budget_bytes:
+                return
+            self._entries[key] = array
+            self._bytes += array.nbytes
+            while self._bytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def discard(self, key: str):
+        """
+        Removes a key from the cache if present.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Process-wide cache shared by every WaveformHandle
+waveform_cache = WaveformCache(CACHE_BUDGET_BYTES)
+
+def decode_to_16k(path: str) -> np.ndarray:
+    """
+    Decodes an audio file to 16 kHz mono float32 in [-1.0, 1.0].
+
+    Args:
+        path (str): The path to the audio file.
+
+    Returns:
+        np.ndarray: The samples.
+    """
+    import resampy
+    from src.embeddings.vgg.vggish_input import wav_read
+
+    data, sr = wav_read(path)
+    samples = data / 32768.0
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        samples = resampy.resample(samples, sr, SAMPLE_RATE)
+    return samples.astype(np.float32)
+
+class WaveformHandle:
+    __slots__ = ('spotify_id', 'source_path', 'cache_path')
+
+    def __init__(self, spotify_id: str, source_path: str | None = None, waveform_dir: str = WAVEFORM_PATH):
+        """
+        Initializes a lazy handle to a song's waveform. Nothing is read until
+        the samples are accessed.
+
+        Args:
+            spotify_id (str): The Spotify ID of the song.
+            source_path (str | None): The downloaded audio. Defaults to sp_id_<id>.mp3.
+            waveform_dir (str): Directory holding the audio and decoded waveforms.
+        """
+        self.spotify_id = spotify_id
+        self.source_path = source_path or os.path.join(waveform_dir, f"sp_id_{spotify_id}.mp3")
+        self.cache_path = os.path.join(waveform_dir, f"sp_id_{spotify_id}.16k.npy")
+
+    def __repr__(self) -> str:
+        return f"WaveformHandle({self.spotify_id!r})"
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether there is audio to load, decoded or not.
+        """
+        return os.path.exists(self.cache_path) or os.path.exists(self.source_path)
+
+    def _load(self) -> np.ndarray:
+        if not os.path.exists(self.cache_path):
+            samples = decode_to_16k(self.source_path)
+            tmp_path = self.cache_path + '.tmp.npy'
+            np.save(tmp_path, samples)
+            os.replace(tmp_path, self.cache_path)
+        return np.load(self.cache_path, mmap_mode='r')
+
+    def load(self) -> np.ndarray:
+        """
+        Returns the 16 kHz mono samples, decoding them on first access.
+
+        Returns:
+            np.ndarray: Read-only float32 samples (memory-mapped).
+        """
+        return waveform_cache.get(self.cache_path, self._load)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.load()
+        return array if dtype is None else array.astype(dtype)
+
+    def store(self, waveform: np.ndarray):
+        """
+        Replaces the decoded waveform with the given 16 kHz mono samples.
+
+        Args:
+            waveform (np.ndarray): The new samples.
+        """
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp.npy'
+        np.save(tmp_path, np.asarray(waveform, dtype=np.float32))
+        os.replace(tmp_path, self.cache_path)
+        waveform_cache.discard(self.cache_path)
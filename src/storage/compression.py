@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Compressed embedding storage, for holding very large catalogs in memory.
+
+A float32 embedding takes 512 bytes. Two codecs shrink it:
+    - ScalarQuantizer (128 bytes): every value is clipped to a range and
+      mapped linearly to 0-255, as in the released AudioSet embeddings (see
+      vggish_postprocess). The default range is VGGish's own
+      [QUANTIZE_MIN_VAL, QUANTIZE_MAX_VAL]; fit() can set it per dimension
+      from data instead.
+    - ProductQuantizer (m bytes, 16 by default): the vector is split into m
+      sub-vectors, and each is stored as the index of its nearest entry in a
+      256-entry codebook trained with k-means on that subspace.
+
+CompressedIndex searches the codes without decompressing the corpus.
+Product-quantized codes use asymmetric distance computation (ADC): the query
+stays uncompressed, a [m, 256] table of its distances to every codebook
+entry is computed once, and each corpus vector is then scored with m table
+lookups. For larger query batches it is cheaper to decode each block of
+codes and score it with one matrix multiply, which gives the same scores.
+Optionally, the top candidates are re-scored against the full
+vectors (e.g. the memory-mapped embedding store) to recover recall.
+
+The index holds each vector's row in the embedding store (4 bytes) rather
+than its track ID, so results are resolved to IDs through the store.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import numpy as np
+from src.embeddings.vgg import vggish_params
+from src.map.clustering import kmeans_plus_plus
+from src.map.similarity_index import METRICS, _merge_top_k, _sort_top_k
+from src.utils.config import config
+
+COMPRESSED_INDEX_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['compressed_index_path'][1:])
+
+BLOCK_SIZE = 65536  # Codes scored per block
+LOOKUP_MAX_QUERIES = 8  # Larger product-quantized batches decode each block and use one matrix multiply
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class ScalarQuantizer:
+    kind = 'scalar'
+
+    def __init__(self, min_val: float | np.ndarray = vggish_params.QUANTIZE_MIN_VAL, max_val: float | np.ndarray = vggish_params.QUANTIZE_MAX_VAL):
+        """
+        Initializes an 8-bit scalar quantizer.
+
+        Args:
+            min_val (float | np.ndarray): Lower clipping bound, shared or per dimension.
+            max_val (float | np.ndarray): Upper clipping bound, shared or per dimension.
+        """
+        self.min_val = np.asarray(min_val, dtype=np.float32)
+        self.max_val = np.asarray(max_val, dtype=np.float32)
+        self.scale = (self.max_val - self.min_val) / 255.0
+
+    @property
+    def code_size(self) -> int:
+        return self.min_val.size if self.min_val.ndim else vggish_params.EMBEDDING_SIZE
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, percentile: float = 0.1) -> 'ScalarQuantizer':
+        """
+        Sets a per-dimension range from data, ignoring the extreme tails.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim].
+            percentile (float): Percent of values clipped at each end.
+
+        Returns:
+            ScalarQuantizer: The quantizer.
+        """
+        low, high = np.percentile(vectors, [percentile, 100 - percentile], axis=0)
+        return cls(low, np.maximum(high, low + 1e-6))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Quantizes vectors to uint8, rounding to the nearest level.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim].
+
+        Returns:
+            np.ndarray: uint8 codes of shape [n, dim].
+        """
+        clipped = np.clip(np.asarray(vectors, dtype=np.float32), self.min_val, self.max_val)
+        return np.rint((clipped - self.min_val) / self.scale).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Maps codes back to approximate float32 vectors.
+        """
+        return codes.astype(np.float32) * self.scale + self.min_val
+
+    def score_tables(self, queries: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Folds the dequantization into the queries: q.x = (q * scale).code + q.min_val.
+
+        Returns:
+            tuple: The scaled queries [Q, dim] and per-query offsets [Q].
+        """
+        scaled = queries * self.scale
+        offsets = queries @ np.broadcast_to(self.min_val, queries.shape[1:])
+        return scaled.astype(np.float32), offsets.astype(np.float32)
+
+    def _state(self) -> dict:
+        return {'min_val': self.min_val, 'max_val': self.max_val}
+
+    @classmethod
+    def _from_state(cls, state: dict) -> 'ScalarQuantizer':
+        return cls(state['min_val'], state['max_val'])
+
+class ProductQuantizer:
+    kind = 'product'
+
+    def __init__(self, dim: int = vggish_params.EMBEDDING_SIZE, m: int = 16, n_centroids: int = 256):
+        """
+        Initializes an untrained product quantizer.
+
+        Args:
+            dim (int): Embedding dimension, divisible by m.
+            m (int): Sub-vectors per vector; also the code size in bytes.
+            n_centroids (int): Codebook entries per subspace (at most 256).
+        """
+        if dim % m:
+            raise ValueError(f"Dimension {dim} is not divisible into {m} sub-vectors.")
+        if not 0 < n_centroids <= 256:
+            raise ValueError("n_centroids must be between 1 and 256.")
+        self.dim = dim
+        self.m = m
+        self.n_centroids = n_centroids
+        self.sub_dim = dim // m
+        self.codebooks = None  # [m, n_centroids, sub_dim]
+
+    @property
+    def code_size(self) -> int:
+        return self.m
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.m, self.sub_dim)
+
+    @staticmethod
+    def _nearest(points: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+        scores = points @ codebook.T
+        scores *= -2.0
+        scores += np.einsum('ij,ij->i', codebook, codebook)
+        return scores.argmin(axis=1)
+
+    def train(self, vectors: np.ndarray, sample_size: int = 32768, iterations: int = 15, seed: int = 0) -> 'ProductQuantizer':
+        """
+        Trains one codebook per subspace with k-means on a sample.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim], n >= n_centroids.
+            sample_size (int): Training vectors sampled.
+            iterations (int): Lloyd iterations per codebook.
+            seed (int): Random seed.
+
+        Returns:
+            ProductQuantizer: self.
+        """
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))], dtype=np.float32)
+        if len(sample) < self.n_centroids:
+            raise ValueError(f"Need at least {self.n_centroids} vectors to train, got {len(sample)}.")
+        subspaces = self._split(sample)
+
+        self.codebooks = np.empty((self.m, self.n_centroids, self.sub_dim), dtype=np.float32)
+        for j in range(self.m):
+            points = np.ascontiguousarray(subspaces[:, j])
+            codebook = kmeans_plus_plus(points, self.n_centroids, seed + j)
+            for _ in range(iterations):
+                labels = self._nearest(points, codebook)
+                counts = np.bincount(labels, minlength=self.n_centroids)
+                filled = counts > 0
+                order = np.argsort(labels, kind='stable')
+                starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+                codebook[filled] = np.add.reduceat(points[order], starts, axis=0) / counts[filled, np.newaxis]
+            self.codebooks[j] = codebook
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Encodes vectors as the nearest codebook entry of each sub-vector.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim].
+
+        Returns:
+            np.ndarray: uint8 codes of shape [n, m].
+        """
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            subspaces = self._split(vectors[start:start + BLOCK_SIZE])
+            for j in range(self.m):
+                codes[start:start + len(subspaces), j] = self._nearest(subspaces[:, j], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Reconstructs approximate float32 vectors from codes.
+        """
+        return self.codebooks[np.arange(self.m), codes].reshape(len(codes), self.dim)
+
+    def distance_tables(self, queries: np.ndarray, metric: str) -> np.ndarray:
+        """
+        Computes each query's score against every codebook entry; a corpus
+        vector's score is the sum of m entries of its query's table.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim].
+            metric (str): 'cosine' (inner products) or 'l2' (negated squared distances).
+
+        Returns:
+            np.ndarray: Tables of shape [Q, m, n_centroids]; higher is closer.
+        """
+        subspaces = self._split(queries)
+        tables = np.einsum('qjd,jcd->qjc', subspaces, self.codebooks)
+        if metric == 'l2':
+            tables *= 2.0
+            tables -= np.einsum('jcd,jcd->jc', self.codebooks, self.codebooks)
+            tables -= np.einsum('qjd,qjd->qj', subspaces, subspaces)[:, :, np.newaxis]
+        return tables
+
+    def _state(self) -> dict:
+        return {'codebooks': self.codebooks}
+
+    @classmethod
+    def _from_state(cls, state: dict) -> 'ProductQuantizer':
+        m, n_centroids, sub_dim = state['codebooks'].shape
+        pq = cls(m * sub_dim, m, n_centroids)
+        pq.codebooks = state['codebooks']
+        return pq
+
+CODECS = {'scalar': ScalarQuantizer, 'product': ProductQuantizer}
+
+class CompressedIndex:
+    def __init__(self, codec: ScalarQuantizer | ProductQuantizer, metric: str = 'cosine'):
+        """
+        Initializes an empty index over compressed vectors.
+
+        Args:
+            codec (ScalarQuantizer | ProductQuantizer): A fitted codec.
+            metric (str): 'cosine' (similarity, higher is closer) or 'l2' (distance, lower is closer).
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}.")
+        self.codec = codec
+        self.metric = metric
+        # Buffers grow geometrically; the first self._size entries are in use
+        self._rows = np.empty(0, dtype=np.uint32)  # Embedding store row of each vector
+        self._codes = np.empty((0, codec.code_size), dtype=np.uint8)
+        self._sq_norms = np.empty(0, dtype=np.float32)  # Of the decoded vectors; scalar codes only
+        self._size = 0
+        self.synced_rows = 0  # Embedding store rows already added
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def rows(self) -> np.ndarray:
+        """
+        The embedding store row of every vector, in index order.
+        """
+        return self._rows[:self._size]
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes[:self._size]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the store rows, codes and norms.
+        """
+        return self._rows.nbytes + self._codes.nbytes + self._sq_norms.nbytes
+
+    def reserve(self, capacity: int):
+        """
+        Grows the buffers to hold at least `capacity` vectors without reallocating.
+        """
+        if capacity <= len(self._rows):
+            return
+        self._rows = np.resize(self._rows, capacity)
+        self._codes = np.resize(self._codes, (capacity, self.codec.code_size))
+        if self.codec.kind == 'scalar':
+            self._sq_norms = np.resize(self._sq_norms, capacity)
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        # Product codes are trained on normalized vectors for cosine; scalar
+        # codes keep the raw values their range was chosen for
+        if self.metric == 'cosine' and self.codec.kind == 'product':
+            return _normalize(vectors)
+        return vectors
+
+    def train(self, vectors: np.ndarray, sample_size: int = 32768, seed: int = 0):
+        """
+        Trains a product quantizer's codebooks on a sample of vectors. Scalar
+        quantizers need no training.
+
+        Args:
+            vectors (np.ndarray): Matrix of shape [n, dim] (may be memory-mapped).
+            sample_size (int): Training vectors sampled.
+            seed (int): Random seed.
+        """
+        if self.codec.kind != 'product':
+            return
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))
+        self.codec.train(self._prepare(vectors[rows]), sample_size, seed=seed)
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray):
+        """
+        Compresses and appends vectors.
+
+        Args:
+            rows (np.ndarray): The vectors' rows in the embedding store.
+            vectors (np.ndarray): Matrix of shape [len(rows), dim].
+        """
+        codes = self.codec.encode(self._prepare(vectors))
+        start, stop = self._size, self._size + len(codes)
+        if stop > len(self._rows):
+            self.reserve(max(stop, 2 * len(self._rows)))
+        self._rows[start:stop] = rows
+        self._codes[start:stop] = codes
+        if self.codec.kind == 'scalar':
+            decoded = self.codec.decode(codes)
+            self._sq_norms[start:stop] = np.einsum('ij,ij->i', decoded, decoded)
+        self._size = stop
+
+    def _score_block(self, queries: np.ndarray, tables, start: int, stop: int) -> np.ndarray:
+        """
+        Scores queries against codes [start, stop); higher is closer.
+        """
+        codes = self.codes[start:stop]
+        if self.codec.kind == 'product' and tables is not None:
+            # m table lookups per code
+            scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+            for j in range(self.codec.m):
+                scores += tables[:, j, codes[:, j]]
+            return scores
+        if self.codec.kind == 'product':
+            # Same scores as the tables give, but one matrix multiply serves the whole batch
+            decoded = self.codec.decode(codes)
+            scores = queries @ decoded.T
+            if self.metric == 'l2':
+                scores *= 2.0
+                scores -= np.einsum('ij,ij->i', decoded, decoded)
+                scores -= np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+            return scores
+
+        scaled, offsets = tables
+        scores = scaled @ codes.T.astype(np.float32)
+        scores += offsets[:, np.newaxis]
+        if self.metric == 'cosine':
+            scores /= np.sqrt(np.maximum(self._sq_norms[start:stop], 1e-12))
+        else:
+            scores *= 2.0
+            scores -= self._sq_norms[start:stop]
+        return scores
+
+    def search_rows(self, queries: np.ndarray, k: int = 10, rerank: np.ndarray | None = None, rerank_factor: int = 4, block_size: int = BLOCK_SIZE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the approximate k nearest embedding store rows for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            k (int): Number of neighbours.
+            rerank (np.ndarray | None): Full vectors, row-aligned with the store
+                (e.g. the store's memory map). If given, the top k * rerank_factor
+                candidates are re-scored exactly.
+            rerank_factor (int): Candidates re-scored per neighbour.
+            block_size (int): Codes scored per block.
+
+        Returns:
+            tuple: Scores and store rows, each of shape [Q, min(k, len(self))],
+                closest first. Scores are cosine similarities or L2 distances.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.metric == 'cosine':
+            queries = _normalize(queries)
+        k = min(k, len(self))
+        shortlist = min(k * rerank_factor, len(self)) if rerank is not None else k
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        index_rows = self.rows.astype(np.int64)
+
+        if self.codec.kind == 'product':
+            tables = self.codec.distance_tables(queries, self.metric) if len(queries) <= LOOKUP_MAX_QUERIES else None
+        else:
+            tables = self.codec.score_tables(queries)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_pos = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            scores = self._score_block(queries, tables, start, stop)
+            best_scores, best_pos = _merge_top_k(best_scores, best_pos, scores, np.arange(start, stop), shortlist)
+
+        if rerank is not None:
+            # Read only the shortlisted rows, in order, from the full vectors
+            rows = np.unique(index_rows[best_pos])
+            full = np.asarray(rerank[rows], dtype=np.float32)
+            full = _normalize(full) if self.metric == 'cosine' else full
+            lookup = np.searchsorted(rows, index_rows[best_pos])
+            scores = np.einsum('qkd,qd->qk', full[lookup], queries)
+            if self.metric == 'l2':
+                scores = 2.0 * scores - np.einsum('qkd,qkd->qk', full[lookup], full[lookup])
+            best_scores = np.empty((len(queries), 0), dtype=np.float32)
+            best_scores, best_pos = _merge_top_k(best_scores, best_pos[:, :0], scores, best_pos, k)
+
+        best_scores, best_pos = _sort_top_k(best_scores, best_pos)
+        if self.metric == 'l2':
+            q_norms = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+            # Product tables already include ||q||^2
+            if self.codec.kind == 'product' and rerank is None:
+                q_norms = 0.0
+            best_scores = np.sqrt(np.maximum(q_norms - best_scores, 0.0))
+        return best_scores, index_rows[best_pos]
+
+    def search(self, queries: np.ndarray, ids: list, k: int = 10, rerank: np.ndarray | None = None, rerank_factor: int = 4) -> list:
+        """
+        Finds the approximate k nearest tracks for each query.
+
+        Args:
+            queries (np.ndarray): Matrix of shape [Q, dim] (or one vector).
+            ids (list): The track ID of every store row (EmbeddingStore.ids).
+            k (int): Number of neighbours.
+            rerank (np.ndarray | None): Full vectors to re-score candidates against (see search_rows).
+            rerank_factor (int): Candidates re-scored per neighbour.
+
+        Returns:
+            list: For each query, a list of (track ID, score) tuples, closest first.
+        """
+        scores, rows = self.search_rows(queries, k, rerank, rerank_factor)
+        return [
+            [(ids[r], float(s)) for r, s in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def save(self, path: str = COMPRESSED_INDEX_PATH):
+        """
+        Saves the index to a .npz file, replacing any existing one by renaming it into place.
+
+        Args:
+            path (str): The destination path.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            codec=np.array(self.codec.kind),
+            metric=np.array(self.metric),
+            rows=self.rows,
+            codes=self.codes,
+            sq_norms=self._sq_norms[:self._size],
+            synced_rows=np.array(self.synced_rows),
+            **self.codec._state()
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = COMPRESSED_INDEX_PATH) -> 'CompressedIndex':
+        """
+        Loads an index saved with save().
+
+        Args:
+            path (str): The .npz path.
+
+        Returns:
+            CompressedIndex: The index.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            state = {key: data[key] for key in data.files}
+        index = cls(CODECS[str(state['codec'])]._from_state(state), str(state['metric']))
+        index._rows = state['rows']
+        index._codes = state['codes']
+        index._sq_norms = state['sq_norms']
+        index._size = len(index._rows)
+        index.synced_rows = int(state['synced_rows'])
+        return index
+
+def compress_catalog_store(store, codec: str = 'product', path: str = COMPRESSED_INDEX_PATH, metric: str = 'cosine', m: int = 16) -> CompressedIndex:
+    """
+    Builds (or extends) a compressed index of the catalog's embedding store.
+
+    A persisted index only has the rows appended since it was built added to
+    it, with its existing codec. It is rebuilt if the store was rewritten or
+    was saved in the older format that held track IDs.
+
+    Args:
+        store (EmbeddingStore): The catalog's embedding store.
+        codec (str): 'scalar' or 'product', for a new index.
+        path (str): The index path.
+        metric (str): Metric for a new index.
+        m (int): Sub-vectors per vector for a new product quantizer.
+
+    Returns:
+        CompressedIndex: The index.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {tuple(CODECS)}.")
+    index = None
+    if os.path.exists(path):
+        try:
+            index = CompressedIndex.load(path)
+        except KeyError:
+            index = None  # Saved before indexes held store rows
+    if index is not None and len(store) < index.synced_rows:
+        index = None
+    matrix = store.matrix()
+    if index is None:
+        index = CompressedIndex(ProductQuantizer(store.dim, m) if codec == 'product' else ScalarQuantizer(), metric)
+        index.train(matrix)
+    elif len(store) == index.synced_rows:
+        return index
+
+    index.reserve(len(index) + len(store) - index.synced_rows)
+    for start in range(index.synced_rows, len(store), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(store))
+        index.add(np.arange(start, stop), matrix[start:stop])
+    index.synced_rows = len(store)
+    index.save(path)
+
+    ratio = len(index) * store.dim * np.dtype(np.float32).itemsize / max(index.nbytes, 1)
+    print(f"{Style.BRIGHT}[Compression]: {Style.NORMAL}{Fore.GREEN}Compressed {len(index)} embeddings with {index.codec.kind} quantization ({index.nbytes / 2**20:.1f} MB, {ratio:.1f}x smaller than float32).{Style.RESET_ALL}")
+    return index
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Binary, memory-mappable storage for embedding matrices.
+
+A store is a pair of files sharing a path prefix:
+    - <prefix>.npy: a contiguous float32 (or float16) matrix, one row per
+      embedding, in standard .npy format so np.load(mmap_mode='r') reads it
+      without copying.
+    - <prefix>.ids: the row-ID index, one track ID per line, in row order.
+
+The .npy header is written with fixed padding so rows can be appended in
+place. The row count in the header is updated last, so a crash mid-append
+leaves the store at its previous length. Appends and promotes hold an
+exclusive lock on <prefix>.lock, so several processes can append to one store.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import fcntl
+import json
+from contextlib import contextmanager
+import numpy as np
+from src.utils.config import config
+
+EMBEDDING_STORE_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['embedding_store_path'][1:])
+
+EMBEDDING_DIM = 128
+_MAGIC = b'\x93NUMPY\x01\x00'
+_HEADER_SIZE = 128  # Total bytes before the data, a multiple of 64 as .npy recommends
+
+def _header(dtype: np.dtype, rows: int, dim: int) -> bytes:
+    """
+    Builds a fixed-size .npy v1.0 header.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows, dim)})
+    pad = _HEADER_SIZE - len(_MAGIC) - 2 - len(header) - 1
+    if pad < 0:
+        raise ValueError(f"Embedding store header too long for shape ({rows}, {dim}).")
+    header = (header + ' ' * pad + '\n').encode('latin1')
+    return _MAGIC + len(header).to_bytes(2, 'little') + header
+
+@contextmanager
+def _locked(prefix: str):
+    """
+    Holds an exclusive lock on <prefix>.lock, shared by every process
+    writing to the store at prefix.
+    """
+    with open(prefix + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _read_header(f) -> tuple[np.dtype, int, int, int]:
+    """
+    Reads an .npy header.
+
+    Returns:
+        tuple: The dtype, row count, dimension and data offset.
+    """
+    np.lib.format.read_magic(f)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    return dtype, shape[0], shape[1], f.tell()
+
+class EmbeddingStore:
+    def __init__(self, prefix: str, dim: int = EMBEDDING_DIM, dtype: str = 'float32'):
+        """
+        Opens (creating if needed) an embedding store.
+
+        Args:
+            prefix (str): Path prefix of the .npy and .ids files.
+            dim (int): Embedding dimension, used when creating a new store.
+            dtype (str): 'float32' or 'float16', used when creating a new store.
+        """
+        self.prefix = prefix
+        self.matrix_path = prefix + '.npy'
+        self.ids_path = prefix + '.ids'
+        self._matrix = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        with _locked(prefix):
+            if os.path.exists(self.matrix_path):
+                self._open()
+                self._recover()
+            else:
+                self.dtype, self.dim, self._rows = np.dtype(dtype), dim, 0
+                self._ids = []
+                self._offset = _HEADER_SIZE
+                with open(self.matrix_path, 'wb') as f:
+                    f.write(_header(self.dtype, 0, dim))
+                open(self.ids_path, 'w').close()
+                self._inode = os.stat(self.matrix_path).st_ino
+                self._row_of = {}
+
+    def _open(self):
+        """
+        Reads the header and the committed row IDs from disk.
+        """
+        with open(self.matrix_path, 'rb') as f:
+            self.dtype, self._rows, self.dim, self._offset = _read_header(f)
+            self._inode = os.fstat(f.fileno()).st_ino
+        with open(self.ids_path, 'r') as f:
+            self._ids = f.read().splitlines()[:self._rows]
+        self._row_of = {track_id: i for i, track_id in enumerate(self._ids)}
+        self._matrix = None
+
+    def _recover(self):
+        """
+        Drops any rows or IDs written past the committed row count.
+        """
+        expected = self._offset + self._rows * self.dim * self.dtype.itemsize
+        if os.path.getsize(self.matrix_path) > expected:
+            with open(self.matrix_path, 'r+b') as f:
+                f.truncate(expected)
+        if len(self._ids) != self._rows or os.path.getsize(self.ids_path) != sum(len(i) + 1 for i in self._ids):
+            with open(self.ids_path, 'w') as f:
+                f.writelines(i + '\n' for i in self._ids)
+
+    def reload(self):
+        """
+        Picks up rows appended by another process since the store was opened,
+        or reopens the store if it was replaced by promote().
+        """
+        with open(self.matrix_path, 'rb') as f:
+            _, rows, _, _ = _read_header(f)
+            replaced = os.fstat(f.fileno()).st_ino != self._inode
+        if replaced:
+            self._open()
+            return
+        if rows <= self._rows:
+            return
+        with open(self.ids_path, 'r') as f:
+            new_ids = f.read().splitlines()[self._rows:rows]
+        for i, track_id in enumerate(new_ids, start=self._rows):
+            self._ids.append(track_id)
+            self._row_of[track_id] = i
+        self._rows = rows
+        self._matrix = None
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self._row_of
+
+    @property
+    def ids(self) -> list:
+        """
+        The track ID of every row, in row order.
+        """
+        return self._ids
+
+    def row_of(self, track_id: str) -> int | None:
+        """
+        Finds the latest row holding a track's embedding.
+
+        Args:
+            track_id (str): The track ID.
+
+        Returns:
+            int | None: The row index, or None if the track isn't stored.
+        """
+        return self._row_of.get(track_id)
+
+    def append(self, ids: list, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Appends embeddings to the store.
+
+        Appending an ID that is already stored adds a new row and points the
+        ID at it; the old row is left in place.
+
+        Args:
+            ids (list): The track IDs, one per row.
+            embeddings (np.ndarray): Matrix of shape [len(ids), dim].
+
+        Returns:
+            np.ndarray: The row indices the embeddings were written to.
+        """
+        embeddings = np.ascontiguousarray(np.atleast_2d(embeddings), dtype=self.dtype)
+        if embeddings.shape != (len(ids), self.dim):
+            raise ValueError(f"Expected embeddings of shape ({len(ids)}, {self.dim}), got {embeddings.shape}.")
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        with _locked(self.prefix):
+            # Another process may have appended (or promoted a new store) since
+            # this one last looked, so the write offset comes from disk
+            self.reload()
+            self._recover()
+            start = self._rows
+            with open(self.matrix_path, 'r+b') as f:
+                f.seek(self._offset + start * self.dim * self.dtype.itemsize)
+                f.write(embeddings.tobytes())
+                f.flush()
+                with open(self.ids_path, 'a') as id_file:
+                    id_file.writelines(str(i) + '\n' for i in ids)
+                # Commit by bumping the row count in the header
+                f.seek(0)
+                f.write(_header(self.dtype, start + len(ids), self.dim))
+
+        for i, track_id in enumerate(ids):
+            self._ids.append(str(track_id))
+            self._row_of[str(track_id)] = start + i
+        self._rows += len(ids)
+        self._matrix = None
+        return np.arange(start, self._rows)
+
+    def matrix(self) -> np.ndarray:
+        """
+        Memory-maps the full embedding matrix (read-only, zero-copy).
+
+        Returns:
+            np.ndarray: Matrix of shape [len(self), dim].
+        """
+        if self._rows == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        if self._matrix is None:
+            self._matrix = np.load(self.matrix_path, mmap_mode='r')
+        return self._matrix
+
+    def get(self, ids: list) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Gathers the embeddings of the given track IDs.
+
+        Args:
+            ids (list): The track IDs to look up.
+
+        Returns:
+            tuple: A tuple containing:
+                - np.ndarray: Matrix of the found embeddings, in input order.
+                - np.ndarray: Boolean mask of which input IDs were found.
+        """
+        rows = np.array([self._row_of.get(str(i), -1) for i in ids], dtype=np.int64)
+        found = rows >= 0
+        return np.asarray(self.matrix()[rows[found]]), found
+
+    @classmethod
+    def staging(cls, prefix: str, dim: int = EMBEDDING_DIM, dtype: str = 'float32') -> 'EmbeddingStore':
+        """
+        Starts an empty store at <prefix>.tmp that can be appended to
+        incrementally and then moved over <prefix> with promote().
+
+        Args:
+            prefix (str): Path prefix the store will be promoted to.
+            dim (int): Embedding dimension.
+            dtype (str): 'float32' or 'float16'.
+
+        Returns:
+            EmbeddingStore: The empty staging store.
+        """
+        tmp_prefix = prefix + '.tmp'
+        for path in (tmp_prefix + '.npy', tmp_prefix + '.ids', tmp_prefix + '.versions'):
+            if os.path.exists(path):
+                os.remove(path)
+        return cls(tmp_prefix, dim=dim, dtype=dtype)
+
+    def promote(self, prefix: str) -> 'EmbeddingStore':
+        """
+        Moves this store over the store at prefix by renaming it into place.
+
+        Args:
+            prefix (str): Path prefix of the store to replace.
+
+        Returns:
+            EmbeddingStore: The store reopened at its new prefix.
+        """
+        # The two renames are not atomic together, so readers should reopen
+        # the store after a rewrite rather than race it. Writers take the
+        # lock, and reload() notices the new file.
+        with _locked(prefix):
+            os.replace(self.ids_path, prefix + '.ids')
+            os.replace(self.matrix_path, prefix + '.npy')
+            # Sidecar versions are row-aligned, so the old ones can't outlive the old rows
+            if os.path.exists(self.prefix + '.versions'):
+                os.replace(self.prefix + '.versions', prefix + '.versions')
+            elif os.path.exists(prefix + '.versions'):
+                os.remove(prefix + '.versions')
+        if os.path.exists(self.prefix + '.lock'):
+            os.remove(self.prefix + '.lock')
+        return EmbeddingStore(prefix)
+
+    @classmethod
+    def write(cls, prefix: str, ids: list, embeddings: np.ndarray, dtype: str = 'float32') -> 'EmbeddingStore':
+        """
+        Writes a complete store, replacing any existing one by renaming it into place.
+
+        Args:
+            prefix (str): Path prefix of the .npy and .ids files.
+            ids (list): The track IDs, one per row.
+            embeddings (np.ndarray): Matrix of shape [len(ids), dim].
+            dtype (str): 'float32' or 'float16'.
+
+        Returns:
+            EmbeddingStore: The written store.
+        """
+        embeddings = np.asarray(embeddings).reshape(len(ids), -1)
+        store = cls.staging(prefix, dim=embeddings.shape[1], dtype=dtype)
+        store.append(ids, embeddings)
+        return store.promote(prefix)
+
+def sidecar_prefix(tsv_path: str) -> str:
+    """
+    Returns the embedding store prefix that sits next to a playlist TSV.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+
+    Returns:
+        str: The TSV path without its extension, suffixed with '.embeddings'.
+    """
+    return os.path.splitext(tsv_path)[0] + '.embeddings'
+
+def sidecar_versions(store: EmbeddingStore) -> dict:
+    """
+    Reads the model version and audio fingerprint recorded for each row of a
+    sidecar store (<prefix>.versions, one tab-separated line per row).
+
+    Args:
+        store (EmbeddingStore): The sidecar store.
+
+    Returns:
+        dict: (model version, audio fingerprint) of each track's latest row,
+            keyed by track ID. Tracks whose latest row has no record (e.g. it
+            was migrated from a legacy TSV column) are left out.
+    """
+    path = store.prefix + '.versions'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()[:len(store)]
+    versions = {}
+    for track_id, line in zip(store.ids, lines):
+        version, _, fingerprint = line.partition('\t')
+        if version:
+            versions[track_id] = (version, fingerprint or None)
+        else:
+            versions.pop(track_id, None)
+    return versions
+
+def record_sidecar_versions(store: EmbeddingStore, rows: np.ndarray, model_versions: list, audio_fingerprints: list):
+    """
+    Records the model version and audio fingerprint of rows just appended to
+    a sidecar store. Earlier rows without a record are marked unknown.
+
+    Args:
+        store (EmbeddingStore): The sidecar store.
+        rows (np.ndarray): The rows append() returned.
+        model_versions (list): The model version of each row (None if unknown).
+        audio_fingerprints (list): The audio fingerprint of each row (None if unknown).
+    """
+    if len(rows) == 0:
+        return
+    path = store.prefix + '.versions'
+    lines = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    start = int(rows[0])
+    new_lines = [f"{v or ''}\t{fp or ''}" for v, fp in zip(model_versions, audio_fingerprints)]
+    if len(lines) == start:
+        with open(path, 'a') as f:
+            f.writelines(line + '\n' for line in new_lines)
+        return
+    # Rows from before versions were recorded, or left by an interrupted run
+    lines = lines[:start] + ['\t'] * (start - len(lines)) + new_lines
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+    os.replace(path + '.tmp', path)
+
+def load_tsv_embeddings(tsv_path: str) -> tuple[list, np.ndarray]:
+    """
+    Memory-maps the embeddings stored next to a playlist TSV.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+
+    Returns:
+        tuple: The track IDs and the embedding matrix, row-aligned.
+    """
+    store = EmbeddingStore(sidecar_prefix(tsv_path))
+    return store.ids, store.matrix()
+
+def migrate_tsv_embeddings(tsv_path: str) -> str:
+    """
+    Moves a legacy inline 'embeddings' TSV column into the TSV's sidecar store.
+
+    The column held each embedding as a Python list literal. Rows without an
+    embedding are left out of the store, and the column is dropped from the TSV.
+    The model that made the embeddings isn't known, so they count as stale.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+
+    Returns:
+        str: The sidecar store prefix.
+    """
+    import pandas as pd
+
+    prefix = sidecar_prefix(tsv_path)
+    if 'embeddings' not in pd.read_csv(tsv_path, sep='\t', nrows=0).columns:
+        return prefix
+
+    df = pd.read_csv(tsv_path, sep='\t', dtype={'Track ID': str})
+    has_embedding = df['embeddings'].notna()
+    ids = df.loc[has_embedding, 'Track ID'].tolist()
+    matrix = np.array([json.loads(e) for e in df.loc[has_embedding, 'embeddings']], dtype=np.float32)
+    EmbeddingStore.write(prefix, ids, matrix.reshape(len(ids), -1))
+    if os.path.exists(prefix + '.versions'):
+        os.remove(prefix + '.versions')
+    df.drop(columns=['embeddings']).to_csv(tsv_path, sep='\t', index=False)
+    return prefix
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Lease-based queue of tracks to download and embed, shared by any number of
+worker processes (see queue_worker.py).
+
+The queue is a SQLite database, so workers on other machines only need it on
+a shared filesystem with working file locks. Each track has at most one job:
+    - pending: waiting for a worker
+    - leased: held by a worker until its lease expires; workers heartbeat to
+      extend it, and an expired lease is handed to the next worker that asks
+    - done: embedded; the embedding waits in the queue to be committed
+    - committed: the embedding was written to the track catalog
+    - failed: gave up after the maximum number of attempts
+
+A result is only accepted from the worker holding the current lease, so a
+worker that stalls past its lease and comes back can't overwrite the result
+of the worker that took over, and a crashed worker's tracks are re-queued
+rather than lost. Results are moved into the catalog by commit_results,
+which holds the queue's write lock throughout so only one process commits
+at a time.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import uuid
+from typing import NamedTuple
+import numpy as np
+from src.utils.tsv_reader import TrackRecord
+from src.utils.config import config
+
+JOB_QUEUE_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['job_queue_path'][1:])
+LEASE_SECONDS = config['settings']['job_lease_s']
+MAX_ATTEMPTS = config['settings']['job_max_attempts']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    track_id      TEXT PRIMARY KEY,
+    name          TEXT NOT NULL,
+    artists       TEXT,
+    duration      REAL,
+    state         TEXT NOT NULL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    lease_owner   TEXT,
+    lease_token   TEXT,
+    lease_expires REAL,
+    embedding     BLOB,
+    model_version TEXT,
+    audio_fingerprint TEXT,
+    youtube_url   TEXT,
+    error         TEXT,
+    enqueued_at   REAL NOT NULL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, lease_expires);
+"""
+
+class Job(NamedTuple):
+    track: TrackRecord
+    token: str
+    attempts: int
+
+class JobQueue:
+    def __init__(self, db_path: str = JOB_QUEUE_PATH, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        """
+        Opens (creating if needed) the job queue.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            lease_seconds (float): How long a lease lasts without a heartbeat.
+            max_attempts (int): Leases a job gets before it's marked failed.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Transactions are managed explicitly so leases can take the write lock up front
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()  # Worker heartbeats share the connection from another thread
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs a block in a transaction that takes the database's write lock up
+        front, so no other process can lease, complete or commit the same jobs
+        in between.
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def enqueue(self, records: list) -> int:
+        """
+        Queues tracks for embedding. A track that is already pending, leased or
+        done isn't queued again; a committed or failed one is reset to pending.
+
+        Args:
+            records (list): The TrackRecords to embed.
+
+        Returns:
+            int: The number of tracks newly queued.
+        """
+        now = time.time()
+        with self._transaction():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                """
+                INSERT INTO jobs (track_id, name, artists, duration, state, enqueued_at, updated_at)
+                VALUES (?, ?, ?, ?, 'pending', ?, ?)
+                ON CONFLICT(track_id) DO UPDATE SET
+                    name=excluded.name, artists=excluded.artists, duration=excluded.duration,
+                    state='pending', attempts=0, lease_owner=NULL, lease_token=NULL, lease_expires=NULL,
+                    embedding=NULL, error=NULL, enqueued_at=excluded.enqueued_at, updated_at=excluded.updated_at
+                WHERE jobs.state IN ('committed', 'failed')
+                """,
+                [(r.track_id, r.track_name, r.artists, float(r.song_length), now, now) for r in records]
+            )
+            queued = self.conn.total_changes - before
+        return queued
+
+    def lease(self, owner: str, count: int) -> list:
+        """
+        Leases up to `count` jobs: pending ones first, then ones whose lease
+        has expired. Jobs that have used up their attempts are marked failed.
+
+        Args:
+            owner (str): Identifies the worker, for status reports.
+            count (int): Maximum number of jobs to lease.
+
+        Returns:
+            list: The leased Jobs. Empty if there's nothing to do right now.
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE jobs SET state='failed', error=COALESCE(error, 'lease expired'), lease_token=NULL, updated_at=? "
+                "WHERE state='leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            rows = self.conn.execute(
+                "SELECT track_id, name, artists, duration, attempts FROM jobs "
+                "WHERE state='pending' OR (state='leased' AND lease_expires < ?) "
+                "ORDER BY state DESC, enqueued_at LIMIT ?",
+                (now, count)
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET state='leased', attempts=attempts+1, lease_owner=?, lease_token=?, lease_expires=?, updated_at=? WHERE track_id=?",
+                [(owner, token, now + self.lease_seconds, now, r[0]) for r in rows]
+            )
+        return [
+            Job(TrackRecord(track_id, name, None, artists, None, duration, None, None), token, attempts + 1)
+            for track_id, name, artists, duration, attempts in rows
+        ]
+
+    def heartbeat(self, jobs: list) -> set:
+        """
+        Extends the leases of jobs that are still held.
+
+        Args:
+            jobs (list): The Jobs being worked on.
+
+        Returns:
+            set: The track IDs whose lease was lost to another worker.
+        """
+        if not jobs:
+            return set()
+        now = time.time()
+        lost = set()
+        with self._transaction():
+            for job in jobs:
+                cur = self.conn.execute(
+                    "UPDATE jobs SET lease_expires=?, updated_at=? WHERE track_id=? AND lease_token=? AND state='leased'",
+                    (now + self.lease_seconds, now, job.track.track_id, job.token)
+                )
+                if cur.rowcount == 0:
+                    lost.add(job.track.track_id)
+        return lost
+
+    def complete(self, job: Job, embedding: np.ndarray, model_version: str, audio_fingerprint: str | None = None, youtube_url: str | None = None) -> bool:
+        """
+        Stores a job's embedding, if the job's lease is still held.
+
+        Returns:
+            bool: Whether the result was accepted. False means the lease
+                expired and the track was handed to another worker.
+        """
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            cur = self.conn.execute(
+                "UPDATE jobs SET state='done', embedding=?, model_version=?, audio_fingerprint=?, youtube_url=?, error=NULL, "
+                "lease_token=NULL, lease_expires=NULL, updated_at=? WHERE track_id=? AND lease_token=? AND state='leased'",
+                (blob, model_version, audio_fingerprint, youtube_url, time.time(), job.track.track_id, job.token)
+            )
+        return cur.rowcount == 1
+
+    def fail(self, job: Job, error: str) -> bool:
+        """
+        Gives a job back after an error: it's retried by the next lease, or
+        marked failed once it has used up its attempts.
+
+        Returns:
+            bool: Whether the lease was still held.
+        """
+        state = 'failed' if job.attempts >= self.max_attempts else 'pending'
+        with self._lock:
+            cur = self.conn.execute(
+                "UPDATE jobs SET state=?, error=?, lease_token=NULL, lease_expires=NULL, updated_at=? "
+                "WHERE track_id=? AND lease_token=? AND state='leased'",
+                (state, error, time.time(), job.track.track_id, job.token)
+            )
+        return cur.rowcount == 1
+
+    def release(self, jobs: list):
+        """
+        Returns unfinished jobs to the queue without using up an attempt,
+        e.g. when a worker is shutting down.
+        """
+        with self._transaction():
+            self.conn.executemany(
+                "UPDATE jobs SET state='pending', attempts=MAX(attempts - 1, 0), lease_token=NULL, lease_expires=NULL, updated_at=? "
+                "WHERE track_id=? AND lease_token=? AND state='leased'",
+                [(time.time(), job.track.track_id, job.token) for job in jobs]
+            )
+
+    def commit_results(self, catalog, duplicates=None, limit: int = 1000) -> int:
+        """
+        Moves finished embeddings into the track catalog.
+
+        The queue's write lock is held from reading the results until they are
+        marked committed, so concurrent committers can't both write them. If
+        the process dies in between, the results stay 'done' and are committed
+        again by the next call; the catalog then points at the newer copy.
+
+        Args:
+            catalog (TrackCatalog): The catalog to write to.
+            duplicates (DuplicateIndex | None): If given, each track is checked
+                against it for near-duplicates (see dedupe.py) and added to it.
+            limit (int): Maximum number of results moved per transaction.
+
+        Returns:
+            int: The number of embeddings committed.
+        """
+        committed = 0
+        while True:
+            with self._transaction():
+                rows = self.conn.execute(
+                    "SELECT track_id, duration, embedding, model_version, audio_fingerprint, youtube_url FROM jobs "
+                    "WHERE state='done' ORDER BY updated_at LIMIT ?",
+                    (limit,)
+                ).fetchall()
+                if rows:
+                    self._commit_rows(catalog, duplicates, rows)
+                    now = time.time()
+                    self.conn.executemany(
+                        "UPDATE jobs SET state='committed', embedding=NULL, updated_at=? WHERE track_id=? AND state='done'",
+                        [(now, r[0]) for r in rows]
+                    )
+            committed += len(rows)
+            if len(rows) < limit:
+                return committed
+
+    @staticmethod
+    def _commit_rows(catalog, duplicates, rows: list):
+        # Another process may have appended to the store since it was opened
+        catalog.store.reload()
+        track_ids = [r[0] for r in rows]
+        embeddings = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+        for version in {r[3] for r in rows}:
+            mask = np.array([r[3] == version for r in rows])
+            catalog.set_embeddings(
+                [t for t, m in zip(track_ids, mask) if m],
+                embeddings[mask],
+                version,
+                [r[4] for r, m in zip(rows, mask) if m]
+            )
+        with catalog.conn:
+            catalog.conn.executemany(
+                "UPDATE tracks SET youtube_url=COALESCE(?, youtube_url) WHERE track_id=?",
+                [(r[5], r[0]) for r in rows]
+            )
+        if duplicates is not None:
+            matches = {}
+            for (track_id, duration, *_), embedding in zip(rows, embeddings):
+                match = duplicates.query(embedding, duration, exclude=track_id)
+                matches[track_id] = match[0] if match else None
+                if match is None:
+                    duplicates.add(track_id, embedding, duration)
+            catalog.set_duplicates(matches)
+
+    def counts(self) -> dict:
+        """
+        Counts the jobs in each state, with expired leases counted separately.
+
+        Returns:
+            dict: Number of jobs keyed by state.
+        """
+        counts = {state: 0 for state in ('pending', 'leased', 'expired', 'done', 'committed', 'failed')}
+        with self._lock:
+            counts.update(self.conn.execute(
+                "SELECT CASE WHEN state='leased' AND lease_expires < ? THEN 'expired' ELSE state END, COUNT(*) FROM jobs GROUP BY 1",
+                (time.time(),)
+            ).fetchall())
+        return counts
+
+    def workers(self) -> dict:
+        """
+        Counts the live leases held by each worker.
+
+        Returns:
+            dict: Number of leased jobs keyed by worker.
+        """
+        with self._lock:
+            return dict(self.conn.execute(
+                "SELECT lease_owner, COUNT(*) FROM jobs WHERE state='leased' AND lease_expires >= ? GROUP BY lease_owner",
+                (time.time(),)
+            ).fetchall())
+
+    def failures(self, limit: int = 20) -> list:
+        """
+        Lists failed jobs with their last error.
+
+        Returns:
+            list: (track ID, name, attempts, error) for the most recent failures.
+        """
+        with self._lock:
+            return self.conn.execute(
+                "SELECT track_id, name, attempts, error FROM jobs WHERE state='failed' ORDER BY updated_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Streaming, row-wise results log for embedding runs.
+
+Each completed track is appended as one TSV row holding its metadata and a
+reference to its embedding's row in an EmbeddingStore, rather than the whole
+dataframe being written once at the end of the run. The log is written to
+<path>.partial, fsynced periodically, and atomically renamed to <path> when
+the run finishes. Consumers such as the map builder can follow it with
+tail_results while a sync is still running.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import time
+
+STORE_PREFIX_MARKER = '# store='
+
+def results_path_for(tsv_path: str) -> str:
+    """
+    Returns the results log path for a playlist TSV.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+
+    Returns:
+        str: The TSV path with its extension replaced by '.results.tsv'.
+    """
+    return os.path.splitext(tsv_path)[0] + '.results.tsv'
+
+def _clean(value) -> str:
+    # Tabs and newlines would break the row structure
+    return '' if value is None else str(value).replace('\t', ' ').replace('\n', ' ')
+
+class ResultWriter:
+    def __init__(self, path: str, columns: list, store_prefix: str, fsync_every: int = 64, fsync_interval: float = 5.0):
+        """
+        Starts a new results log at <path>.partial.
+
+        Args:
+            path (str): The final path of the results log.
+            columns (list): The column names, in order.
+            store_prefix (str): The EmbeddingStore the 'Embedding Row' column refers to.
+            fsync_every (int): Fsync after this many rows.
+            fsync_interval (float): Fsync at least this often, in seconds, while rows arrive.
+        """
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.columns = list(columns)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.rows_written = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(self.partial_path, 'w')
+        self._file.write(f"{STORE_PREFIX_MARKER}{store_prefix}\n")
+        self._file.write('\t'.join(self.columns) + '\n')
+        self._sync()
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed run leaves its .partial log behind for inspection
+        if exc_type is None:
+            self.finalize()
+        else:
+            self.close()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def write(self, row: dict):
+        """
+        Appends one completed row. Missing columns are written empty.
+
+        Args:
+            row (dict): Values keyed by column name.
+        """
+        self._file.write('\t'.join(_clean(row.get(c)) for c in self.columns) + '\n')
+        # Flush every row so tailing readers see it; fsync less often
+        self._file.flush()
+        self.rows_written += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+
+    def close(self):
+        """
+        Closes the log without finalizing it.
+        """
+        if not self._file.closed:
+            self._sync()
+            self._file.close()
+
+    def finalize(self) -> str:
+        """
+        Fsyncs the log and atomically renames it to its final path.
+
+        Returns:
+            str: The final path.
+        """
+        self.close()
+        os.replace(self.partial_path, self.path)
+        return self.path
+
+def tail_results(path: str, poll_interval: float = 0.5, timeout: float | None = None):
+    """
+    Follows a results log, yielding rows as they are written.
+
+    Works whether the run is in progress (<path>.partial) or finished
+    (<path>). Stops once the log has been finalized and fully read, or when
+    no new rows arrive for `timeout` seconds.
+
+    Args:
+        path (str): The final path of the results log.
+        poll_interval (float): Seconds to wait between polls for new rows.
+        timeout (float | None): Give up after this many idle seconds.
+
+    Yields:
+        dict: One row keyed by column name, plus 'store_prefix'.
+    """
+    partial_path = path + '.partial'
+    position = 0
+    leftover = ''
+    columns = None
+    store_prefix = None
+    idle_since = time.monotonic()
+
+    while True:
+        finished = not os.path.exists(partial_path) and os.path.exists(path)
+        source = path if finished else partial_path
+        try:
+            with open(source, 'r') as f:
+                f.seek(position)
+                chunk = f.read()
+                position = f.tell()
+        except FileNotFoundError:
+            # Not started yet, or renamed between the check and the open
+            chunk = ''
+            finished = False
+
+        lines = (leftover + chunk).split('\n')
+        leftover = lines.pop()  # Incomplete last line, if any
+        for line in lines:
+            if store_prefix is None and line.startswith(STORE_PREFIX_MARKER):
+                store_prefix = line[len(STORE_PREFIX_MARKER):]
+            elif columns is None:
+                columns = line.split('\t')
+            else:
+                row = dict(zip(columns, line.split('\t')))
+                row['store_prefix'] = store_prefix
+                yield row
+
+        if chunk:
+            idle_since = time.monotonic()
+        elif finished:
+            return
+        elif timeout is not None and time.monotonic() - idle_since > timeout:
+            return
+        else:
+            time.sleep(poll_interval)
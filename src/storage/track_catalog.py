@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Central catalog of every track the application has seen.
+
+Tracks are keyed by Spotify track ID and hold their metadata, metrics,
+YouTube link, audio path and a reference to its row in the catalog's
+embedding store (see embedding_store.py). Playlists and liked songs are stored
+as lightweight membership lists that point into the catalog, so a track
+shared by many playlists or users is downloaded and embedded only once.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from colorama import Fore, Style
+import sqlite3
+import time
+import numpy as np
+from src.storage.embedding_store import EmbeddingStore, EMBEDDING_STORE_PATH
+from src.utils.tsv_reader import TrackRecord, records_from_frame
+from src.utils.config import config
+debug = config['settings']['debug']
+
+CATALOG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', config['paths']['catalog_path'][1:])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id    TEXT PRIMARY KEY,
+    name        TEXT NOT NULL,
+    url         TEXT,
+    artists     TEXT,
+    album       TEXT,
+    duration    REAL,
+    metrics     TEXT,
+    youtube_url TEXT,
+    audio_path  TEXT,
+    embedding_row INTEGER,
+    audio_fingerprint TEXT,
+    model_version TEXT,
+    duplicate_of TEXT,
+    updated_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS collections (
+    name       TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    collection TEXT NOT NULL REFERENCES collections(name) ON DELETE CASCADE,
+    track_id   TEXT NOT NULL REFERENCES tracks(track_id),
+    position   INTEGER NOT NULL,
+    added_at   TEXT,
+    PRIMARY KEY (collection, track_id)
+);
+CREATE INDEX IF NOT EXISTS memberships_track ON memberships(track_id);
+"""
+
+class TrackCatalog:
+    def __init__(self, db_path: str = CATALOG_PATH, store_prefix: str = EMBEDDING_STORE_PATH):
+        """
+        Opens (creating if needed) the track catalog.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            store_prefix (str): Path prefix of the catalog's embedding store.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self.store = EmbeddingStore(store_prefix)
+        self._add_missing_columns()
+        self._migrate_blob_embeddings()
+
+    def _add_missing_columns(self):
+        """
+        Adds columns introduced after a catalog was first created.
+        """
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(tracks)")]
+        for column, sql_type in (('embedding_row', 'INTEGER'), ('audio_fingerprint', 'TEXT'), ('model_version', 'TEXT'), ('duplicate_of', 'TEXT')):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE tracks ADD COLUMN {column} {sql_type}")
+
+    def _migrate_blob_embeddings(self):
+        """
+        Moves embeddings from the old inline BLOB column into the embedding store.
+        """
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(tracks)")]
+        if 'embedding' not in columns:
+            return
+        rows = self.conn.execute("SELECT track_id, embedding FROM tracks WHERE embedding IS NOT NULL").fetchall()
+        if rows:
+            ids = [r[0] for r in rows]
+            matrix = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            store_rows = self.store.append(ids, matrix)
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE tracks SET embedding_row=?, embedding=NULL WHERE track_id=?",
+                    [(int(row), track_id) for row, track_id in zip(store_rows, ids)]
+                )
+            print(f"{Style.BRIGHT}[TrackCatalog]: {Style.NORMAL}{Fore.CYAN}Moved {len(rows)} inline embeddings to {self.store.matrix_path}.{Style.RESET_ALL}")
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        self.conn.close()
+
+    def upsert_tracks(self, df: 'pd.DataFrame'):
+        """
+        Inserts or updates track metadata from a playlist TSV dataframe.
+
+        Download and embedding columns of existing tracks are left untouched.
+
+        Args:
+            df (pd.DataFrame): Rows in the playlist TSV format.
+        """
+        self.upsert_records(records_from_frame(df))
+
+    def upsert_records(self, records: list):
+        """
+        Inserts or updates track metadata from TrackRecords (see tsv_reader.py).
+
+        Download and embedding columns of existing tracks are left untouched.
+
+        Args:
+            records (list): The TrackRecords to upsert.
+        """
+        now = time.time()
+        rows = [
+            (r.track_id, r.track_name, r.track_url, r.artists, r.album, float(r.song_length), r.metrics, now)
+            for r in records
+        ]
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO tracks (track_id, name, url, artists, album, duration, metrics, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(track_id) DO UPDATE SET
+                    name=excluded.name, url=excluded.url, artists=excluded.artists,
+                    album=excluded.album, duration=excluded.duration,
+                    metrics=COALESCE(excluded.metrics, tracks.metrics), updated_at=excluded.updated_at
+                """,
+                rows
+            )
+
+    def set_collection(self, name: str, kind: str, track_ids: list, added_at: list | None = None):
+        """
+        Replaces the membership list of a playlist or likes collection.
+
+        Args:
+            name (str): The collection name (e.g. the playlist's TSV name or 'likes').
+            kind (str): 'playlist', 'likes' or 'baseline'.
+            track_ids (list): The collection's track IDs, in order.
+            added_at (list | None): Optional timestamps matching track_ids.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO collections (name, kind, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET kind=excluded.kind, updated_at=excluded.updated_at",
+                (name, kind, time.time())
+            )
+            self.conn.execute("DELETE FROM memberships WHERE collection = ?", (name,))
+            self._insert_memberships(name, track_ids, added_at, 0)
+
+    def extend_collection(self, name: str, track_ids: list, added_at: list | None = None, start: int = 0):
+        """
+        Appends tracks to an existing collection's membership list, so a large
+        collection can be written chunk by chunk after set_collection(name, kind, []).
+
+        Args:
+            name (str): The collection name.
+            track_ids (list): The track IDs to append, in order.
+            added_at (list | None): Optional timestamps matching track_ids.
+            start (int): The position of the first appended track.
+        """
+        with self.conn:
+            self._insert_memberships(name, track_ids, added_at, start)
+
+    def _insert_memberships(self, name: str, track_ids: list, added_at: list | None, start: int):
+        if added_at is None:
+            added_at = [None] * len(track_ids)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO memberships (collection, track_id, position, added_at) VALUES (?, ?, ?, ?)",
+            [(name, str(tid), i, at) for i, (tid, at) in enumerate(zip(track_ids, added_at), start=start)]
+        )
+
+    def collection_track_ids(self, name: str) -> list:
+        """
+        Retrieves the track IDs of a collection, in order.
+
+        Args:
+            name (str): The collection name.
+
+        Returns:
+            list: The collection's track IDs.
+        """
+        cur = self.conn.execute("SELECT track_id FROM memberships WHERE collection = ? ORDER BY position", (name,))
+        return [r[0] for r in cur]
+
+    def missing_embeddings(self, track_ids: list) -> list:
+        """
+        Filters track IDs down to those the catalog has no embedding for.
+
+        Args:
+            track_ids (list): The track IDs to check.
+
+        Returns:
+            list: The IDs without an embedding, in input order.
+        """
+        embedded = self.embedding_rows(track_ids)
+        return [str(t) for t in track_ids if str(t) not in embedded]
+
+    def set_download(self, track_id: str, audio_path: str, youtube_url: str | None = None):
+        """
+        Records where a track's audio was downloaded from and to.
+
+        Args:
+            track_id (str): The Spotify track ID.
+            audio_path (str): Path to the downloaded audio file.
+            youtube_url (str | None): The YouTube link the audio came from.
+        """
+        with self.conn:
+            self.conn.execute(
+                "UPDATE tracks SET audio_path=?, youtube_url=COALESCE(?, youtube_url), updated_at=? WHERE track_id=?",
+                (audio_path, youtube_url, time.time(), track_id)
+            )
+
+    def set_embedding(self, track_id: str, embedding: np.ndarray, model_version: str | None = None, audio_fingerprint: str | None = None) -> int:
+        """
+        Appends a track's embedding to the store and points the track at it.
+
+        Args:
+            track_id (str): The Spotify track ID.
+            embedding (np.ndarray): The 128-d embedding.
+            model_version (str | None): Version of the model that produced the embedding.
+            audio_fingerprint (str | None): Fingerprint of the audio file that was embedded.
+
+        Returns:
+            int: The store row the embedding was written to.
+        """
+        return int(self.set_embeddings([track_id], np.atleast_2d(embedding), model_version, [audio_fingerprint])[0])
+
+    def set_embeddings(self, track_ids: list, embeddings: np.ndarray, model_version: str | None = None, audio_fingerprints: list | None = None) -> np.ndarray:
+        """
+        Appends many embeddings to the store in one write.
+
+        Args:
+            track_ids (list): The Spotify track IDs.
+            embeddings (np.ndarray): Matrix of shape [len(track_ids), 128].
+            model_version (str | None): Version of the model that produced the embeddings.
+            audio_fingerprints (list | None): Fingerprints of the embedded audio files.
+
+        Returns:
+            np.ndarray: The store rows the embeddings were written to.
+        """
+        if audio_fingerprints is None:
+            audio_fingerprints = [None] * len(track_ids)
+        rows = self.store.append([str(t) for t in track_ids], embeddings)
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE tracks SET embedding_row=?, model_version=?, audio_fingerprint=?, updated_at=? WHERE track_id=?",
+                [(int(row), model_version, fp, now, str(track_id)) for row, fp, track_id in zip(rows, audio_fingerprints, track_ids)]
+            )
+        return rows
+
+    def stale_embeddings(self, track_ids: list, model_version: str, audio_fingerprints: dict | None = None) -> list:
+        """
+        Filters track IDs down to those that need (re-)embedding.
+
+        A track is stale if it has no embedding, if its embedding was made by a
+        different model version, or if its audio file no longer matches the
+        fingerprint recorded when it was embedded.
+
+        Args:
+            track_ids (list): The track IDs to check.
+            model_version (str): The current model version.
+            audio_fingerprints (dict | None): Current audio fingerprints keyed by track ID.
+                Tracks without an entry are not checked for audio changes.
+
+        Returns:
+            list: The stale IDs, in input order.
+        """
+        audio_fingerprints = audio_fingerprints or {}
+        ids = [str(t) for t in track_ids]
+        state = self.embedding_versions(ids)
+
+        stale = []
+        for track_id in ids:
+            if track_id not in state:
+                stale.append(track_id)
+                continue
+            version, fingerprint = state[track_id]
+            current = audio_fingerprints.get(track_id)
+            if version != model_version or (current is not None and fingerprint != current):
+                stale.append(track_id)
+        return stale
+
+    def embedding_versions(self, track_ids: list) -> dict:
+        """
+        Looks up the model version and audio fingerprint of the given tracks' embeddings.
+
+        Args:
+            track_ids (list): The track IDs to look up.
+
+        Returns:
+            dict: (model version, audio fingerprint) keyed by track ID. Tracks without an embedding are omitted.
+        """
+        versions = {}
+        ids = [str(t) for t in track_ids]
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            cur = self.conn.execute(
+                f"SELECT track_id, model_version, audio_fingerprint FROM tracks WHERE embedding_row IS NOT NULL AND track_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            versions.update((r[0], (r[1], r[2])) for r in cur)
+        return versions
+
+    def embedding_rows(self, track_ids: list) -> dict:
+        """
+        Looks up the embedding store rows of the given tracks.
+
+        Args:
+            track_ids (list): The track IDs to look up.
+
+        Returns:
+            dict: Store row keyed by track ID. Tracks without an embedding are omitted.
+        """
+        rows = {}
+        ids = [str(t) for t in track_ids]
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            cur = self.conn.execute(
+                f"SELECT track_id, embedding_row FROM tracks WHERE embedding_row IS NOT NULL AND track_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            rows.update(cur)
+        return rows
+
+    def get_embedding_matrix(self, track_ids: list) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Gathers the embeddings of the given tracks into one matrix.
+
+        Args:
+            track_ids (list): The track IDs to look up.
+
+        Returns:
+            tuple: A tuple containing:
+                - np.ndarray: float32 matrix of the found embeddings, in input order.
+                - np.ndarray: Boolean mask of which input IDs were found.
+        """
+        rows_of = self.embedding_rows(track_ids)
+        rows = np.array([rows_of.get(str(t), -1) for t in track_ids], dtype=np.int64)
+        found = rows >= 0
+        return np.asarray(self.store.matrix()[rows[found]], dtype=np.float32), found
+
+    def get_embeddings(self, track_ids: list) -> dict:
+        """
+        Retrieves the embeddings of the given tracks.
+
+        Args:
+            track_ids (list): The track IDs to look up.
+
+        Returns:
+            dict: float32 np.ndarray embeddings keyed by track ID. Tracks without
+                an embedding are omitted.
+        """
+        rows_of = self.embedding_rows(track_ids)
+        matrix = self.store.matrix()
+        return {track_id: np.asarray(matrix[row], dtype=np.float32) for track_id, row in rows_of.items()}
+
+    def embedded_tracks(self) -> tuple[list, np.ndarray, np.ndarray]:
+        """
+        Lists every track that has an embedding, in store row order.
+
+        Returns:
+            tuple: A tuple containing:
+                - list: The track IDs.
+                - np.ndarray: Their durations in seconds (NaN if unknown).
+                - np.ndarray: Their embedding store rows.
+        """
+        rows = self.conn.execute(
+            "SELECT track_id, duration, embedding_row FROM tracks WHERE embedding_row IS NOT NULL ORDER BY embedding_row"
+        ).fetchall()
+        if not rows:
+            return [], np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+        ids, durations, store_rows = zip(*rows)
+        return list(ids), np.array(durations, dtype=np.float64), np.array(store_rows, dtype=np.int64)
+
+    def stale_records(self, model_version: str) -> list:
+        """
+        Lists every track without an embedding from the given model version.
+
+        Args:
+            model_version (str): The current model version.
+
+        Returns:
+            list: TrackRecords (see tsv_reader.py) of the tracks to (re-)embed.
+        """
+        cur = self.conn.execute(
+            "SELECT track_id, name, url, artists, album, duration, metrics FROM tracks "
+            "WHERE embedding_row IS NULL OR model_version IS NOT ? ORDER BY track_id",
+            (model_version,)
+        )
+        return [TrackRecord(*row, None) for row in cur]
+
+    def set_duplicates(self, duplicate_of: dict):
+        """
+        Marks tracks as near-duplicates of other tracks (see dedupe.py).
+
+        Args:
+            duplicate_of (dict): The canonical track ID keyed by duplicate track ID.
+                A None value clears the mark.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE tracks SET duplicate_of=? WHERE track_id=?",
+                [(canonical, str(track_id)) for track_id, canonical in duplicate_of.items()]
+            )
+
+    def duplicate_track_ids(self) -> dict:
+        """
+        Lists the tracks marked as near-duplicates.
+
+        Returns:
+            dict: The canonical track ID keyed by duplicate track ID.
+        """
+        return dict(self.conn.execute("SELECT track_id, duplicate_of FROM tracks WHERE duplicate_of IS NOT NULL"))
+
+    def track_names(self, track_ids: list) -> dict:
+        """
+        Looks up the names and artists of tracks.
+
+        Args:
+            track_ids (list): The track IDs to look up.
+
+        Returns:
+            dict: (name, artists) tuples keyed by track ID. Unknown tracks are omitted.
+        """
+        names = {}
+        ids = [str(t) for t in track_ids]
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            cur = self.conn.execute(
+                f"SELECT track_id, name, artists FROM tracks WHERE track_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            names.update((r[0], (r[1], r[2])) for r in cur)
+        return names
+
+    def stats(self) -> dict:
+        """
+        Summarizes the catalog contents.
+
+        Returns:
+            dict: Counts of tracks, embedded tracks, duplicates, collections and memberships.
+        """
+        q = lambda sql: self.conn.execute(sql).fetchone()[0]
+        return {
+            'tracks': q("SELECT COUNT(*) FROM tracks"),
+            'embedded': q("SELECT COUNT(*) FROM tracks WHERE embedding_row IS NOT NULL"),
+            'duplicates': q("SELECT COUNT(*) FROM tracks WHERE duplicate_of IS NOT NULL"),
+            'collections': q("SELECT COUNT(*) FROM collections"),
+            'memberships': q("SELECT COUNT(*) FROM memberships"),
+        }
+
+if __name__ == "__main__":
+    catalog = TrackCatalog()
+    print(f"{Style.BRIGHT}[TrackCatalog]: {Style.NORMAL}{Fore.CYAN}{catalog.stats()}{Style.RESET_ALL}")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+The application configuration (config/config.json).
+
+The file is parsed once per process, on first import, and every module
+shares the same dictionary.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import json
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
+with open(CONFIG_PATH, 'r') as f:
+    config = json.load(f)
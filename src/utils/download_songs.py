@@ -14,18 +14,17 @@ sys.path.insert(0, str(project_root))
 from colorama import Fore, Style
 import asyncio
 import os
-import json
 import pandas as pd
 from typing import Tuple
-from src.utils.ytdl_handler import find_best_link, download_one_by_url, download_best
+from src.utils.ytdl_handler import find_best_link, download_one_by_url
+from src.utils.tsv_reader import records_from_frame
+from src.utils import metrics
 import tqdm
+from src.utils.config import config
 
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "config", "config.json")
-with open(CONFIG_PATH, "r") as f:
-    config = json.load(f)
-
-AUDIO_DEST_PATH = os.path.join(os.path.dirname(__file__), "..", "..", config["paths"]["audio_destination_path"])
+AUDIO_DEST_PATH = os.path.join(os.path.dirname(__file__), "..", "..", config["paths"]["audio_destination_path"][1:])
 YT_LINKS_PATH   = os.path.join(os.path.dirname(__file__), "..", "..", config['paths']['yt_links_path'])
+DOWNLOAD_CONCURRENCY = config['settings']['download_concurrency']
 
 def search_for_existing_link(song_info):
     """
@@ -153,41 +152,78 @@ async def download_songs_batch(songs_batch, start_index: int, pbar):
     tasks = [download_song(song, start_index + i, pbar) for i, song in enumerate(songs_batch)]
     return await asyncio.gather(*tasks)
 
-async def download_songs(frame: pd.DataFrame):
+async def download_songs(tracks, concurrency: int = DOWNLOAD_CONCURRENCY) -> tuple[dict, dict]:
     """
-    Asynchronously downloads songs based on information in the provided
-    DataFrame. This function processes each song in the DataFrame concurrently,
-    searching for the best link and downloading the song if a suitable link is 
-    found. As each song is saved based on its Spotify ID, nothing needs to be
-    returned.
+    Asynchronously downloads songs, searching for the best link for each and
+    downloading it if a suitable one is found. Each song is saved based on its
+    Spotify ID.
+
+    Tracks are pulled lazily by a fixed pool of workers, so only `concurrency`
+    downloads (and coroutines) exist at any time no matter how many tracks
+    are passed in.
 
     Args:
-        frame (pd.DataFrame): DataFrame containing columns 'Track Name', 'Artists', 
-                              'Song Length (s)', and the index as Spotify IDs.
+        tracks (Iterable[TrackRecord] | pd.DataFrame): The songs to download,
+            as TrackRecords (see tsv_reader.py) or a dataframe in the playlist
+            TSV format.
+        concurrency (int): Maximum number of songs downloaded at once.
+
+    Returns:
+        tuple: A tuple containing:
+            - dict: (audio path, YouTube link) keyed by the Spotify ID of each
+              song that was downloaded successfully.
+            - dict: Why each other song wasn't downloaded, keyed by Spotify ID.
+              A failed download doesn't stop the others.
     """
-    async def process_song(row):
-        spotify_id = row['Track ID']
-        search_query = f"{row['Track Name']} by {row['Artists']}"
-        success, file_path = await download_best(
-            search_query=search_query,
-            target_length=row['Song Length (s)'],
-            threshold=5, # Allow a 5-second deviation from the target length
-            sp_id=spotify_id
-        )
-        return success, file_path
+    if isinstance(tracks, pd.DataFrame):
+        tracks = records_from_frame(tracks)
+    total = len(tracks) if hasattr(tracks, '__len__') else None
+    pending = iter(tracks)
+    downloaded, failed = {}, {}
+    handed_out = 0
 
     # Create a progress bar
-    pbar = tqdm.tqdm(total=len(frame), desc="Downloading songs")
-
-    # Process songs concurrently
-    tasks = [process_song(row) for _, row in frame.iterrows()]
-    results = await asyncio.gather(*tasks)
+    pbar = tqdm.tqdm(total=total, desc="Downloading songs")
+
+    async def worker():
+        nonlocal handed_out
+        # Workers share one iterator, so each track is handed out exactly once
+        for track in pending:
+            handed_out += 1
+            if total is not None:
+                metrics.gauge('download_queue_depth', total - handed_out)
+            search_query = f"{track.track_name} by {track.artists}"
+            try:
+                url = await find_best_link(
+                    search_query=search_query,
+                    target_length=track.song_length,
+                    threshold=5 # Allow a 5-second deviation from the target length
+                )
+            except Exception as e:
+                print(f"Failed to find a link for {search_query}: {e}")
+                url = None
+            if url is None:
+                failed[track.track_id] = 'no YouTube match found'
+                status = 'not found'
+            else:
+                try:
+                    await download_one_by_url(track.track_id, url)
+                except Exception as e:
+                    # yt-dlp gives up after its retries; the track shouldn't take the rest with it
+                    print(f"Failed to download {search_query} from {url}: {e}")
+                    failed[track.track_id] = f"download failed: {e}"
+                    status = 'failed'
+                else:
+                    downloaded[track.track_id] = (os.path.join(AUDIO_DEST_PATH, f"sp_id_{track.track_id}.mp3"), url)
+                    status = 'downloaded'
+            metrics.counter('downloads_total', status=status)
+            pbar.update(1)
 
-    # Update progress bar
-    pbar.update(len(results))
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
     pbar.close()
 
     print(f"{Fore.GREEN}Finished downloading songs.{Style.RESET_ALL}")
+    return downloaded, failed
 
 # if __name__ == "__main__":
 #     asyncio.run(download_songs())
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Counters, gauges, latency histograms and trace spans for the pipeline stages.
+
+Collection is off by default, and while it's off every call returns after a
+single flag check, so instrumented code runs at full speed. Once enabled
+(see enable), metrics can be:
+    - served in the Prometheus text format at http://<host>:<port>/metrics
+    - written periodically to a file: Prometheus text for a '.prom' path (for
+      node_exporter's textfile collector), otherwise one JSON snapshot per line
+    - traced: every finished span is written as one JSON line, with its parent
+      span, so a slow track can be followed through search, download, decode
+      and inference
+
+Usage:
+    with metrics.span('inference'):
+        sess.run(...)
+
+    @metrics.timed('download')
+    async def download_one_by_url(...): ...
+
+    metrics.gauge('download_queue_depth', len(pending))
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import threading
+import time
+
+PREFIX = 'musicmap_'
+
+# Latency buckets in seconds, from decoding a clip to a slow download
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float('inf'))
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> float
+_gauges = {}      # (name, labels) -> float
+_histograms = {}  # (name, labels) -> Histogram
+_trace_file = None
+_exporter = None
+_server = None
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        """
+        Counts observations into cumulative-style buckets, like a Prometheus histogram.
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimates a quantile by interpolating within its bucket, as
+        Prometheus' histogram_quantile does.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-2]
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def is_enabled() -> bool:
+    return _enabled
+
+def enable(trace_path: str | None = None):
+    """
+    Starts collecting metrics.
+
+    Args:
+        trace_path (str | None): If given, finished spans are appended to this file as JSON lines.
+    """
+    global _enabled, _trace_file
+    if trace_path is not None and _trace_file is None:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+        _trace_file = open(trace_path, 'a', buffering=1)
+    _enabled = True
+
+def disable():
+    """
+    Stops collecting metrics and closes the trace file. Collected values are kept.
+    """
+    global _enabled, _trace_file
+    _enabled = False
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+
+def reset():
+    """
+    Forgets every collected value.
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+def counter(name: str, value: float = 1, **labels):
+    """
+    Adds to a counter, e.g. counter('tracks_total', status='failed').
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name: str, value: float, **labels):
+    """
+    Sets a gauge, e.g. the number of tracks waiting to be downloaded.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def gauge_add(name: str, value: float, **labels):
+    """
+    Adds to a gauge (negative values subtract).
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    """
+    Records a value, usually a duration in seconds, in a histogram.
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+    def __init__(self, name: str, labels: dict):
+        """
+        Times a block of code. On exit the duration is recorded in the
+        <name>_seconds histogram, failures in <name>_errors_total, and the
+        <name>_in_progress gauge tracks how many are running.
+        """
+        self.name = name
+        self.labels = labels
+        self.span_id = next(_span_ids)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        gauge_add(f"{self.name}_in_progress", 1, **self.labels)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        gauge_add(f"{self.name}_in_progress", -1, **self.labels)
+        observe(f"{self.name}_seconds", duration, **self.labels)
+        if exc_type is not None:
+            counter(f"{self.name}_errors_total", **self.labels)
+        if _trace_file is not None:
+            record = {
+                'span': self.name,
+                'id': self.span_id,
+                'parent': self.parent.span_id if self.parent is not None else None,
+                'start': round(self.wall_start, 6),
+                'duration_s': round(duration, 6),
+                'labels': self.labels,
+                'error': exc_type.__name__ if exc_type is not None else None,
+                'thread': threading.current_thread().name
+            }
+            with _lock:
+                if _trace_file is not None:
+                    _trace_file.write(json.dumps(record) + '\n')
+        return False
+
+def span(name: str, **labels) -> Span | _NoopSpan:
+    """
+    Returns a context manager that times the block it wraps (see Span).
+    Spans nest across threads and coroutines through a context variable.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, labels)
+
+def timed(name: str, **labels):
+    """
+    Decorates a function or coroutine function so each call runs in a span.
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await fn(*args, **kwargs)
+                with Span(name, labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (f'{k}="{_escape(v)}"' for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def prometheus_text() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (h.buckets, list(h.counts), h.count, h.sum)) for key, h in _histograms.items())
+
+    lines, typed = [], set()
+    def declare(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, 'counter')
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {_format_number(value)}")
+    for (name, labels), value in gauges:
+        declare(name, 'gauge')
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {_format_number(value)}")
+    for (name, labels), (buckets, counts, count, total) in histograms:
+        declare(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, (('le', _format_number(bound)),))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {_format_number(total)}")
+        lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+def snapshot() -> dict:
+    """
+    Returns every metric as a JSON-serializable dict, with the p50/p90/p99 of each histogram.
+    """
+    def name_of(key: tuple) -> str:
+        return key[0] + _format_labels(key[1])
+
+    with _lock:
+        return {
+            'timestamp': round(time.time(), 3),
+            'counters': {name_of(k): v for k, v in sorted(_counters.items())},
+            'gauges': {name_of(k): v for k, v in sorted(_gauges.items())},
+            'histograms': {
+                name_of(k): {
+                    'count': h.count,
+                    'sum': round(h.sum, 6),
+                    'p50': h.quantile(0.5),
+                    'p90': h.quantile(0.9),
+                    'p99': h.quantile(0.99)
+                } for k, h in sorted(_histograms.items())
+            }
+        }
+
+def write(path: str):
+    """
+    Writes the metrics to a file: a '.prom' path is replaced atomically with
+    the Prometheus text format, anything else gets a JSON snapshot appended.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if path.endswith('.prom'):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(prometheus_text())
+        os.replace(tmp_path, path)
+    else:
+        with open(path, 'a') as f:
+            f.write(json.dumps(snapshot()) + '\n')
+
+class _Exporter(threading.Thread):
+    def __init__(self, path: str, interval: float):
+        super().__init__(name='metrics-exporter', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write(self.path)
+
+def start_exporter(path: str, interval: float = 10.0):
+    """
+    Writes the metrics to a file (see write) every `interval` seconds until stop() is called.
+    """
+    global _exporter
+    if _exporter is not None:
+        return
+    _exporter = _Exporter(path, interval)
+    _exporter.start()
+
+def serve(port: int, host: str = '127.0.0.1'):
+    """
+    Serves the metrics at http://<host>:<port>/metrics in a background thread.
+    Only this machine can scrape them unless host is set to another interface
+    (e.g. '0.0.0.0' for all of them).
+    """
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+
+def stop():
+    """
+    Stops the exporter and server, writing the exporter's file one last time,
+    and closes the trace file.
+    """
+    global _exporter, _server
+    if _exporter is not None:
+        _exporter.stopped.set()
+        _exporter.join()
+        write(_exporter.path)
+        _exporter = None
+    if _server is not None:
+        _server.shutdown()
+        _server = None
+    disable()
+
+def stage_summary() -> list:
+    """
+    Summarizes each timed stage.
+
+    Returns:
+        list: (stage, count, total seconds, p50, p90, p99) for each span, slowest total first.
+    """
+    rows = []
+    for name, h in snapshot()['histograms'].items():
+        if '_seconds' in name:
+            rows.append((name.replace('_seconds', ''), h['count'], h['sum'], h['p50'], h['p90'], h['p99']))
+    return sorted(rows, key=lambda row: -row[2])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+"""
+Chunked reader for playlist and catalog TSVs.
+
+Reads a TSV in bounded-size chunks and yields each chunk as a list of
+TrackRecord named tuples, rather than loading the whole file into a dataframe
+and walking it with iterrows (which builds a pd.Series per row). Memory use
+depends on the chunk size rather than the file size, so exports with hundreds
+of thousands of rows can be streamed through the download and embed stages.
+"""
+
+import os, sys
+from pathlib import Path
+
+# Add the project root to the Python path
+project_root = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from typing import Iterator, NamedTuple
+
+DEFAULT_CHUNK_SIZE = 10000
+
+class TrackRecord(NamedTuple):
+    track_id: str
+    track_name: str
+    track_url: str | None
+    artists: str
+    album: str | None
+    song_length: float
+    metrics: str | None
+    added_at: str | None
+
+# TSV column for each TrackRecord field
+RECORD_COLUMNS = {
+    'track_id': 'Track ID',
+    'track_name': 'Track Name',
+    'track_url': 'Track Url',
+    'artists': 'Artists',
+    'album': 'Album',
+    'song_length': 'Song Length (s)',
+    'metrics': 'Metrics',
+    'added_at': 'Added At'
+}
+REQUIRED_COLUMNS = ['Track ID', 'Track Name', 'Artists', 'Song Length (s)']
+
+def _none_if_missing(values: list) -> list:
+    # NaN != NaN, and pandas reads empty cells as NaN
+    return [None if v != v else v for v in values]
+
+def records_from_frame(df: 'pd.DataFrame') -> list:
+    """
+    Converts a dataframe in the playlist TSV format to TrackRecords.
+
+    Optional columns that are absent or empty become None.
+
+    Args:
+        df (pd.DataFrame): Rows in the playlist TSV format.
+
+    Returns:
+        list: One TrackRecord per row, in order.
+    """
+    columns = []
+    for field, column in RECORD_COLUMNS.items():
+        if column not in df.columns:
+            columns.append([None] * len(df))
+        elif field == 'track_id':
+            columns.append(df[column].astype(str).tolist())
+        elif field == 'song_length':
+            columns.append(df[column].astype(float).tolist())
+        else:
+            columns.append(_none_if_missing(df[column].tolist()))
+    return list(map(TrackRecord._make, zip(*columns)))
+
+def read_track_chunks(tsv_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[list]:
+    """
+    Reads a playlist TSV in chunks of TrackRecords.
+
+    Only the columns TrackRecord holds are parsed; legacy columns such as an
+    inline 'embeddings' column are skipped.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+        chunk_size (int): Maximum number of records per chunk.
+
+    Yields:
+        list: Up to chunk_size TrackRecords, in file order.
+
+    Raises:
+        ValueError: If the TSV is missing a required column.
+    """
+    import pandas as pd
+
+    header = pd.read_csv(tsv_path, sep='\t', nrows=0).columns
+    missing = [c for c in REQUIRED_COLUMNS if c not in header]
+    if missing:
+        raise ValueError(f"{tsv_path} is missing required columns: {', '.join(missing)}")
+
+    usecols = [c for c in RECORD_COLUMNS.values() if c in header]
+    reader = pd.read_csv(
+        tsv_path,
+        sep='\t',
+        usecols=usecols,
+        dtype={'Track ID': str, 'Metrics': str, 'Added At': str},
+        chunksize=chunk_size
+    )
+    with reader:
+        for chunk in reader:
+            yield records_from_frame(chunk)
+
+def iter_tracks(tsv_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[TrackRecord]:
+    """
+    Iterates over the rows of a playlist TSV one TrackRecord at a time,
+    reading it in chunks behind the scenes.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+        chunk_size (int): Number of rows read at a time.
+
+    Yields:
+        TrackRecord: Each row, in file order.
+    """
+    for chunk in read_track_chunks(tsv_path, chunk_size):
+        yield from chunk
+
+def count_rows(tsv_path: str) -> int:
+    """
+    Counts the data rows of a TSV without parsing it, e.g. to size a progress bar.
+
+    Args:
+        tsv_path (str): The path to the TSV file.
+
+    Returns:
+        int: The number of rows, excluding the header.
+    """
+    lines, last = 0, b''
+    with open(tsv_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # A missing trailing newline still ends a row
+    if last and last != b'\n':
+        lines += 1
+    return max(lines - 1, 0)
@@ -13,22 +13,19 @@ sys.path.insert(0, str(project_root))
 
 from colorama import Fore, Style
 import time
-import json
 import asyncio
 from typing import Tuple
 import yt_dlp
 import contextlib
 import subprocess
 from src.utils.log_suppression import SuppressLogger
-
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.json')
-
-with open(CONFIG_PATH, 'r') as f:
-    config = json.load(f)
+from src.utils import metrics
+from src.utils.config import config
 debug = config['settings']['debug']
 
 AUDIO_DEST_PATH = os.path.join(os.path.dirname(__file__), "..", "..") + config['paths']['audio_destination_path']
 
+@metrics.timed('youtube_search')
 async def find_best_link(search_query: str, target_length: float, threshold: int) -> str:
     ydl_opts = {
         'quiet': True,
@@ -80,8 +77,10 @@ async def find_best_link(search_query: str, target_length: float, threshold: int
         return best_url
     else:
         print(f"{Fore.RED}[ytdlp]: {Style.DIM}No video found within threshold.{Style.RESET_ALL}")
+        metrics.counter('youtube_search_misses_total')
         return None
     
+@metrics.timed('download')
 async def download_one_by_url(sp_id: int, url: str):
     p = os.path.join(AUDIO_DEST_PATH, f"sp_id_{sp_id}")
     # print(p)
@@ -115,6 +114,7 @@ async def download_one_by_url(sp_id: int, url: str):
                     await loop.run_in_executor(None, lambda: ydl.download([u]))
                     break
                 except yt_dlp.DownloadError as e:
+                    metrics.counter('download_retries_total')
                     print(f"{Fore.RED}[ytdlp]: {Style.DIM}Download failed. Retrying...{Style.RESET_ALL}")
                     time.sleep(5)
                     if attempt == 4:
@@ -125,8 +125,11 @@ async def download_one_by_url(sp_id: int, url: str):
     if not debug:
         with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
             sys.stdout = f
-            await download_youtube_audio()
-        sys.stdout = sys.__stdout__
+            try:
+                await download_youtube_audio()
+            finally:
+                # Restored even when the download fails, or later prints hit the closed file
+                sys.stdout = sys.__stdout__
     else:
         await download_youtube_audio()
     